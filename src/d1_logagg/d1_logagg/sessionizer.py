@@ -0,0 +1,360 @@
+'''
+Assign sessions to the DataONE log records on disk, before they are shipped to Elastic Search
+
+Requires python 3
+
+This script reads the JSON lines written by d1logprocessor, in the order they were
+written, which is the order of dateLogged. A sessionId is added to each read event
+and every record is written to the output log, the file Filebeat is configured to
+ship. The events then land in the eventlog index already sessionized and are skipped
+by the computeSessions pass of d1metricses.
+
+The events of an IP address belong to the same session while less than 60 minutes
+separate consecutive events, as in d1_metrics.sessionizer.
+
+New sessionIds are reserved in blocks from the session_id_allocator table of the
+metrics database, shared with d1metricses compute, so the two never assign the same
+sessionId. This requires the d1_metrics package and its configuration file.
+
+The position reached in the input log, the live session of each IP address and the
+sessionIds left in the reserved block are kept in a small JSON checkpoint file, so
+each run continues where the previous one stopped, including across rotations of the
+input log. A run that is interrupted between writing records and saving the
+checkpoint writes those records again on the next run.
+
+Records flagged by logstash as failing to parse are not known here. The logstash
+pipeline should set their sessionId to -1 as computeSessions does.
+
+The events are not in the eventlog index yet when they are sessionized here, so the
+cached aggregations and the session watermark of the service are updated once they
+are indexed, by running after Filebeat shipped them:
+
+  d1metricses watermark
+'''
+
+import os
+import argparse
+import logging
+import datetime
+import glob
+import json
+import tempfile
+
+from d1_logagg import eventprocessor
+
+try:
+  from d1_metrics import common
+  from d1_metrics import metricselasticsearch
+  from d1_metrics import sessionizer as metricssessionizer
+except ImportError:
+  metricssessionizer = None
+
+APP_LOG = eventprocessor.APP_LOG
+DEFAULT_OUTPUT = "d1logagg-sessions.log"
+DEFAULT_CHECKPOINT = "d1logagg-sessions.checkpoint"
+SESSION_TTL_MINUTES = 60 #Longest gap between two events of a session
+CHECKPOINT_EVERY = 10000 #Records written between checkpoint saves
+F_SESSIONID = "sessionId"
+F_IPADDR = "ipAddress"
+F_EVENT = "event"
+SEARCH_REQUEST_PREFIX = "/cn/v2/query/solr/"
+
+
+def parseDateLogged(dstring):
+  try:
+    return datetime.datetime.strptime(dstring, "%Y-%m-%dT%H:%M:%S.%fZ")
+  except ValueError:
+    return datetime.datetime.strptime(dstring, "%Y-%m-%dT%H:%M:%SZ")
+
+
+class Checkpoint(object):
+  '''
+  Position in the input log and live sessions, saved between runs.
+  '''
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.inode = None
+    self.offset = 0
+    # (next, end) sessionIds left in the reserved block
+    self.reserved = None
+    # iterator of the sessionIds for new sessions, set before assigning sessions
+    self.session_ids = None
+    # ip -> [dateLogged string of the last event, sessionId]
+    self.sessions = {}
+
+
+  def load(self):
+    '''
+    Load the checkpoint file if it exists
+
+    Returns:
+      True if a checkpoint was loaded
+    '''
+    if not os.path.exists(self.fname):
+      return False
+    with open(self.fname, "r") as f:
+      data = json.load(f)
+    self.inode = data.get("inode")
+    self.offset = data.get("offset", 0)
+    if data.get("reserved") is not None:
+      self.reserved = tuple(data["reserved"])
+    self.sessions = data.get("sessions", {})
+    return True
+
+
+  def save(self):
+    '''
+    Replace the checkpoint file atomically
+    '''
+    if self.session_ids is not None:
+      self.reserved = self.session_ids.remaining()
+    data = {
+      "inode": self.inode,
+      "offset": self.offset,
+      "reserved": self.reserved,
+      "sessions": self.sessions,
+    }
+    directory = os.path.dirname(os.path.abspath(self.fname))
+    handle, temporary_name = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+      with os.fdopen(handle, "w") as f:
+        json.dump(data, f)
+      os.replace(temporary_name, self.fname)
+    except Exception:
+      os.unlink(temporary_name)
+      raise
+
+
+  def expire(self, tstamp):
+    '''
+    Drop the sessions that no event logged after tstamp can continue
+
+    Args:
+      tstamp: datetime
+    '''
+    oldest = tstamp - datetime.timedelta(minutes=SESSION_TTL_MINUTES)
+    expired = [ip for ip, session in self.sessions.items() if parseDateLogged(session[0]) < oldest]
+    for ip in expired:
+      del self.sessions[ip]
+
+
+  def assignSession(self, ip_address, dstring):
+    '''
+    sessionId of a read event, continuing the live session of the address or starting a new one.
+    Records are not strictly in order, an event older than the last one of the session is part of it.
+
+    Args:
+      ip_address: IP address of the event
+      dstring: dateLogged of the event
+
+    Returns:
+      sessionId
+    '''
+    session = self.sessions.get(ip_address)
+    if session is None:
+      session = [dstring, next(self.session_ids)]
+      self.sessions[ip_address] = session
+      return session[1]
+    delta = parseDateLogged(dstring) - parseDateLogged(session[0])
+    # A record older than the last event of the session belongs to it, the last event is kept
+    if delta.total_seconds() <= 0:
+      return session[1]
+    if (delta.total_seconds() / 60) > SESSION_TTL_MINUTES:
+      session[1] = next(self.session_ids)
+    session[0] = dstring
+    return session[1]
+
+
+def sessionizeRecord(checkpoint, line):
+  '''
+  Add the session of a record of the input log
+
+  Args:
+    checkpoint: Checkpoint holding the live sessions
+    line: JSON line of the record
+
+  Returns:
+    the line to write, unchanged for records that are not read events
+  '''
+  try:
+    record = json.loads(line)
+  except ValueError:
+    logging.getLogger(APP_LOG).debug("Bad json: %s", line)
+    return line
+  if record.get(F_EVENT) != "read" or F_SESSIONID in record:
+    return line
+  dstring = record.get(eventprocessor.LOG_DATE_FIELD)
+  ip_address = record.get(F_IPADDR)
+  if dstring is None or ip_address is None:
+    return line
+  record[F_SESSIONID] = checkpoint.assignSession(ip_address, dstring)
+  if record.get("request", "").startswith(SEARCH_REQUEST_PREFIX):
+    record["searchevent"] = True
+  return json.dumps(record)
+
+
+def getInputFiles(log_file_name, checkpoint):
+  '''
+  Input log files to read, oldest first, with the offset to start reading each of them.
+
+  The rotated logs newer than the file of the checkpoint are read after it, so records
+  written before a rotation are not missed.
+
+  Args:
+    log_file_name: input log file
+    checkpoint: Checkpoint
+
+  Returns:
+    list of (file name, offset)
+  '''
+  L = logging.getLogger(APP_LOG)
+  rotated = []
+  for fname in glob.glob(log_file_name + ".*"):
+    suffix = fname[len(log_file_name) + 1:]
+    if suffix.isdigit():
+      rotated.append((int(suffix), fname))
+  # highest suffix is the oldest
+  fnames = [fname for suffix, fname in sorted(rotated, reverse=True)]
+  if os.path.exists(log_file_name):
+    fnames.append(log_file_name)
+  if checkpoint.inode is None:
+    if os.path.exists(log_file_name):
+      return [(log_file_name, 0)]
+    return []
+  for i, fname in enumerate(fnames):
+    if os.stat(fname).st_ino == checkpoint.inode:
+      return [(fname, checkpoint.offset)] + [(newer, 0) for newer in fnames[i + 1:]]
+  L.warning("Log file of the checkpoint not found. Starting from the start of %s", log_file_name)
+  if os.path.exists(log_file_name):
+    return [(log_file_name, 0)]
+  return []
+
+
+def getSessionIdAllocator(config_file, index_name=None, reserved=None):
+  '''
+  sessionIds reserved in blocks in the metrics database, see d1_metrics.sessionizer
+
+  Args:
+    config_file: configuration file of the Elastic Search and metrics database connections
+    index_name: name of the event index, the configured index if None
+    reserved: (next, end) sessionIds left from a previous block
+
+  Returns:
+    iterator of sessionIds
+  '''
+  if metricssessionizer is None:
+    raise ValueError("The d1_metrics package is required to reserve sessionIds")
+  elastic = metricselasticsearch.MetricsElasticSearch(config_file)
+  elastic.connect()
+  return metricssessionizer.getSessionIdAllocator(config_file, elastic, index_name, reserved=reserved)
+
+
+def sessionizeLog(log_file_name, output_file_name, checkpoint_file_name, session_ids, test_only=False):
+  '''
+  Main method. Copy the new records of the input log to the output log with their sessions.
+
+  Args:
+    log_file_name: Name of the log file written by d1logprocessor
+    output_file_name: Name of the log file shipped by Filebeat
+    checkpoint_file_name: Name of the checkpoint file
+    session_ids: callable returning the iterator of the sessionIds for new sessions, given the
+      (next, end) sessionIds left in the checkpoint, see getSessionIdAllocator
+    test_only: Show the starting point but don't write anything
+
+  Returns:
+    number of records written
+  '''
+  L = logging.getLogger(APP_LOG)
+  log_file_name = os.path.abspath(log_file_name)
+  checkpoint = Checkpoint(checkpoint_file_name)
+  if not checkpoint.load():
+    L.warning("Checkpoint not found. Starting from zero.")
+  input_files = getInputFiles(log_file_name, checkpoint)
+  for fname, offset in input_files:
+    L.info("Start %s at %d", fname, offset)
+  if test_only:
+    return 0
+  checkpoint.session_ids = session_ids(checkpoint.reserved)
+  logger = eventprocessor.getOutputLogger(os.path.abspath(output_file_name))
+  counter = 0
+  for fname, offset in input_files:
+    with open(fname, "rb") as f:
+      checkpoint.inode = os.fstat(f.fileno()).st_ino
+      checkpoint.offset = offset
+      f.seek(offset)
+      for raw_line in f:
+        # a partial line is still being written, leave it for the next run
+        if not raw_line.endswith(b"\n"):
+          break
+        line = raw_line.decode().strip()
+        checkpoint.offset += len(raw_line)
+        if line == "":
+          continue
+        logger.info(sessionizeRecord(checkpoint, line))
+        counter += 1
+        if counter % CHECKPOINT_EVERY == 0:
+          checkpoint.save()
+  if len(checkpoint.sessions) > 0:
+    last_dstring = max(session[0] for session in checkpoint.sessions.values())
+    checkpoint.expire(parseDateLogged(last_dstring))
+  checkpoint.save()
+  L.info("Wrote %d records, %d live sessions, sessionIds left %s",
+         counter, len(checkpoint.sessions), checkpoint.reserved)
+  return counter
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('-l', '--log_level',
+                      action='count',
+                      default=0,
+                      help='Set logging level, multiples for more detailed.')
+  parser.add_argument('-f', '--log_source',
+                      default=eventprocessor.DEFAULT_LOG,
+                      help="Log written by d1logprocessor")
+  parser.add_argument('-o', '--log_dest',
+                      default=DEFAULT_OUTPUT,
+                      help="Log destination, shipped by Filebeat")
+  parser.add_argument('-k', '--checkpoint',
+                      default=DEFAULT_CHECKPOINT,
+                      help="Checkpoint file")
+  parser.add_argument('-c', '--config',
+                      default=None,
+                      help="d1_metrics configuration file of the Elastic Search and metrics database "
+                           "connections, reserving the sessionIds.")
+  parser.add_argument('-i', '--index',
+                      default=None,
+                      help="Event index the sessionIds are reserved for, the configured index by default.")
+  parser.add_argument('-t','--test',
+                      default=False,
+                      action='store_true',
+                      help="Show the starting point but don't write anything.")
+
+  args = parser.parse_args()
+  # Setup logging verbosity
+  levels = [logging.WARNING, logging.INFO, logging.DEBUG]
+  level = levels[min(len(levels) - 1, args.log_level)]
+  eventprocessor.setupLogger(level=level)
+  if metricssessionizer is None:
+    logging.getLogger(APP_LOG).error("The d1_metrics package is required to reserve sessionIds")
+    return 1
+  config_file = args.config
+  if config_file is None:
+    config_file = common.DEFAULT_CONFIG_FILE
+
+  def sessionIds(reserved):
+    return getSessionIdAllocator(config_file, index_name=args.index, reserved=reserved)
+
+  sessionizeLog(args.log_source,
+                args.log_dest,
+                args.checkpoint,
+                session_ids=sessionIds,
+                test_only=args.test)
+  return 0
+
+
+if __name__ == "__main__":
+  import sys
+  sys.exit(main())
@@ -76,6 +76,7 @@ setup(
   # for example:
   # $ pip install -e .[dev,test]
   extras_require={
+    'sessions': ['d1_metrics'],
   },
 
   # If there are data files included in your packages that need to be
@@ -95,7 +96,8 @@ setup(
   # pip to create the appropriate form of executable for the target platform.
   entry_points={
     'console_scripts': [
-      'd1logprocessor = d1_logagg.eventprocessor:main'
+      'd1logprocessor = d1_logagg.eventprocessor:main',
+      'd1logsessionizer = d1_logagg.sessionizer:main',
     ]
   },
 )
\ No newline at end of file
@@ -0,0 +1,274 @@
+'''
+Cache of Elastic Search composite aggregation buckets for closed months.
+
+Events of a month stop changing once the month is over and sessionization has caught
+up, so the buckets of a monthly (or daily) composite aggregation for such a month can
+be stored and reused. A month is considered closed SETTLE_DAYS after its end.
+
+Cached months are stored in the aggregate_month_cache table, keyed by a hash of the
+entity type and the ES search and aggregation bodies. Requests then only query ES for
+the partial months at the ends of the requested range, the open months, and closed
+months that are not cached yet or were invalidated.
+
+Months are invalidated by the batch jobs that change events after ingest:
+sessionization invalidates every month from its first unprocessed event, and portal
+re-tagging invalidates all the months of the portal.
+'''
+import datetime
+import hashlib
+import json
+import logging
+
+from d1_metrics import telemetry
+from d1_metrics.metricsdatabase import MetricsDatabase
+from d1_metrics.metricselasticsearch import MetricsElasticSearch
+
+SETTLE_DAYS = 3                       # Days after the end of a month before it is cached
+CACHED_INTERVALS = ("month", "day")   # date_histogram intervals with buckets inside a month
+
+
+def monthStart(date):
+  return datetime.datetime(date.year, date.month, 1)
+
+
+def nextMonth(date):
+  return datetime.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+def getCacheKey(entity_type, search_query, aggregation_query):
+  '''
+  Key identifying the aggregations of an entity, independent of the date range.
+
+  Args:
+    entity_type: repository, portal, user
+    search_query: the ES search body
+    aggregation_query: the ES aggregation body
+
+  Returns:
+    hex digest
+  '''
+  body = json.dumps([entity_type, search_query, aggregation_query], sort_keys=True)
+  return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+def getDateHistogramSource(aggregation_query, agg_name="pid_list"):
+  '''
+  Find the date_histogram source of a composite aggregation
+
+  Returns:
+    (name, interval) of the source or (None, None)
+  '''
+  for source in aggregation_query[agg_name]["composite"]["sources"]:
+    name, definition = next(iter(source.items()))
+    if "date_histogram" in definition:
+      return name, definition["date_histogram"].get("interval")
+  return None, None
+
+
+class MonthlyAggregateCache(object):
+  '''
+  Stores and reuses the composite aggregation buckets of closed months.
+  '''
+
+  def __init__(self, config_file=None, settle_days=SETTLE_DAYS):
+    self._L = logging.getLogger(self.__class__.__name__)
+    self._config_file = config_file
+    self._settle_days = settle_days
+
+
+  def _getDatabase(self):
+    # A new instance per operation, the connections come from the shared pool
+    return MetricsDatabase(self._config_file)
+
+
+  def isClosed(self, month, now=None):
+    if now is None:
+      now = datetime.datetime.utcnow()
+    return nextMonth(month) + datetime.timedelta(days=self._settle_days) <= now
+
+
+  def getMonths(self, cache_key, months):
+    '''
+    Retrieve cached months
+
+    Args:
+      cache_key: key of the aggregations
+      months: list of month start datetimes
+
+    Returns:
+      dictionary of month start datetime to list of buckets
+    '''
+    if len(months) == 0:
+      return {}
+    sql = "SELECT month, buckets FROM aggregate_month_cache WHERE cache_key = %s AND month = ANY(%s);"
+    database = self._getDatabase()
+    with database.pooledCursor() as csr:
+      csr.execute(sql, (cache_key, [month.date() for month in months]))
+      rows = csr.fetchall()
+    cached = {}
+    for month, buckets in rows:
+      cached[datetime.datetime(month.year, month.month, 1)] = json.loads(buckets)
+    return cached
+
+
+  def storeMonths(self, cache_key, entity_type, entity_id, month_buckets):
+    '''
+    Store the buckets of closed months
+
+    Args:
+      cache_key: key of the aggregations
+      entity_type: repository, portal, user
+      entity_id: identifier of the entity
+      month_buckets: dictionary of month start datetime to list of buckets
+    '''
+    if len(month_buckets) == 0:
+      return
+    sql = "INSERT INTO aggregate_month_cache (cache_key, entity_type, entity_id, month, buckets) " \
+          "VALUES (%s, %s, %s, %s, %s) ON CONFLICT (cache_key, month) DO UPDATE " \
+          "SET buckets=excluded.buckets, computed_at=now()"
+    database = self._getDatabase()
+    with database.pooledConnection() as conn:
+      with conn.cursor() as csr:
+        for month, buckets in month_buckets.items():
+          csr.execute(sql, (cache_key, entity_type, entity_id, month.date(), json.dumps(buckets)))
+      conn.commit()
+    self._L.debug("Cached %d months for %s %s", len(month_buckets), entity_type, entity_id)
+
+
+  def invalidateSince(self, since):
+    '''
+    Remove the cached months from the month of since onwards, for all the entities
+
+    Args:
+      since: datetime of the earliest changed event
+    '''
+    sql = "DELETE FROM aggregate_month_cache WHERE month >= %s;"
+    database = self._getDatabase()
+    with database.pooledConnection() as conn:
+      with conn.cursor() as csr:
+        csr.execute(sql, (monthStart(since).date(),))
+        self._L.info("Invalidated %d cached months since %s", csr.rowcount, since.isoformat())
+      conn.commit()
+
+
+  def invalidateEntity(self, entity_type, entity_id):
+    '''
+    Remove all the cached months of an entity
+
+    Args:
+      entity_type: repository, portal, user
+      entity_id: identifier of the entity
+    '''
+    sql = "DELETE FROM aggregate_month_cache WHERE entity_type = %s AND entity_id = %s;"
+    database = self._getDatabase()
+    with database.pooledConnection() as conn:
+      with conn.cursor() as csr:
+        csr.execute(sql, (entity_type, entity_id))
+        self._L.info("Invalidated %d cached months of %s %s", csr.rowcount, entity_type, entity_id)
+      conn.commit()
+
+
+  def getRanges(self, start_date, end_date, cached_months, cacheable_months):
+    '''
+    Ranges of the request that have to be retrieved from ES
+
+    Returns:
+      list of (range_start, range_end, end_inclusive)
+    '''
+    ranges = []
+    range_start = start_date
+    for month in cacheable_months:
+      if month in cached_months:
+        if range_start < month:
+          ranges.append((range_start, month, False))
+        range_start = nextMonth(month)
+    ranges.append((range_start, end_date, True))
+    return ranges
+
+
+  def compositeAggregations(self, metrics_elastic_search, entity_type, entity_id, start_date, end_date,
+                            search_query, aggregation_query, agg_name="pid_list"):
+    '''
+    Equivalent of MetricsElasticSearch.iterate_composite_aggregations_sliced using the cached
+    buckets of closed months.
+
+    Args:
+      metrics_elastic_search: connected MetricsElasticSearch
+      entity_type: repository, portal, user
+      entity_id: identifier of the entity, used for invalidation
+      start_date: datetime
+      end_date: datetime, included
+      search_query: the ES search body
+      aggregation_query: the ES aggregation body
+      agg_name: name of the composite aggregation
+
+    Returns:
+      ES response structure with the buckets of agg_name for the whole range
+    '''
+    source_name, interval = getDateHistogramSource(aggregation_query, agg_name=agg_name)
+    if source_name is None or interval not in CACHED_INTERVALS:
+      return metrics_elastic_search.iterate_composite_aggregations_sliced(start_date, end_date,
+                                                                          search_query=search_query,
+                                                                          aggregation_query=aggregation_query,
+                                                                          agg_name=agg_name)
+
+    cache_key = getCacheKey(entity_type, search_query, aggregation_query)
+    now = datetime.datetime.utcnow()
+    cacheable_months = []
+    month = monthStart(start_date)
+    if month < start_date:
+      month = nextMonth(month)
+    while nextMonth(month) <= end_date and self.isClosed(month, now=now):
+      cacheable_months.append(month)
+      month = nextMonth(month)
+
+    try:
+      cached_months = self.getMonths(cache_key, cacheable_months)
+    except Exception as e:
+      self._L.warning("Aggregate cache unavailable: %s", e)
+      return metrics_elastic_search.iterate_composite_aggregations_sliced(start_date, end_date,
+                                                                          search_query=search_query,
+                                                                          aggregation_query=aggregation_query,
+                                                                          agg_name=agg_name)
+    self._L.debug("%d of %d closed months cached for %s %s", len(cached_months), len(cacheable_months),
+                  entity_type, entity_id)
+    telemetry.recordCache("aggregate_month", hits=len(cached_months),
+                          misses=len(cacheable_months) - len(cached_months))
+
+    responses = []
+    for range_start, range_end, end_inclusive in self.getRanges(start_date, end_date, cached_months,
+                                                                cacheable_months):
+      responses.append(
+        metrics_elastic_search.iterate_composite_aggregations_sliced(range_start, range_end,
+                                                                     search_query=search_query,
+                                                                     aggregation_query=aggregation_query,
+                                                                     agg_name=agg_name,
+                                                                     date_end_inclusive=end_inclusive))
+
+    fetched_buckets = []
+    for response in responses:
+      fetched_buckets.extend(response["aggregations"][agg_name]["buckets"])
+
+    # Store the closed months that were retrieved, including the ones without events
+    new_months = {}
+    for month in cacheable_months:
+      if month not in cached_months:
+        new_months[month] = []
+    if len(new_months) > 0:
+      for bucket in fetched_buckets:
+        month = monthStart(datetime.datetime.utcfromtimestamp(bucket["key"][source_name] / 1000))
+        if month in new_months:
+          new_months[month].append(bucket)
+      try:
+        self.storeMonths(cache_key, entity_type, entity_id, new_months)
+      except Exception as e:
+        self._L.warning("Unable to store aggregates in cache: %s", e)
+
+    bucket_lists = [fetched_buckets, ]
+    for month in cached_months:
+      bucket_lists.append(cached_months[month])
+    aggregations = responses[-1]
+    aggregations["hits"]["total"] = sum(response["hits"]["total"] for response in responses)
+    aggregations["aggregations"][agg_name]["buckets"] = MetricsElasticSearch.mergeCompositeBuckets(
+      aggregation_query, bucket_lists, agg_name=agg_name)
+    return aggregations
@@ -31,8 +31,10 @@ from aiohttp import ClientSession
 from collections import OrderedDict
 
 from d1_metrics import common
+from d1_metrics import telemetry
+from d1_metrics.aggregatecache import MonthlyAggregateCache
 from d1_metrics.solrclient import SolrClient
-from d1_metrics.metricsdatabase import MetricsDatabase
+from d1_metrics.metricsdatabase import MetricsDatabase, METADATA_PORTAL_INDEX_UPDATED
 from d1_metrics.metricselasticsearch import MetricsElasticSearch
 
 from d1_metrics_service import pid_resolution
@@ -306,6 +308,22 @@ def handlePortalJob(seriesId=""):
 
         logger.info("Running update job for " + seriesId)
         updateIndex(seriesId=seriesId, PID_List=portal_DIF, operation="add")
+
+        # The aggregations cached for the portal no longer match the index
+        try:
+            MonthlyAggregateCache().invalidateEntity("portal", seriesId)
+        except Exception as e:
+            logger.error("Unable to invalidate the aggregate cache for " + seriesId + ": " + str(e))
+
+        # Changes the version of the data served by the service, and so the ETag of the responses
+        try:
+            metrics_database = MetricsDatabase()
+            with metrics_database.pooledConnection():
+                metrics_database.setMetadataValue(METADATA_PORTAL_INDEX_UPDATED,
+                                                  datetime.datetime.utcnow().isoformat())
+        except Exception as e:
+            logger.error("Unable to record the portal index update for " + seriesId + ": " + str(e))
+
         storePortalHash(seriesId=seriesId,hashVal=portal_metadata["hash"], updateEntry=updateHash)
 
     t_delta = time.time() - t_start
@@ -945,6 +963,11 @@ def main():
         "-m", "--mode", default="regular", help="Arg to indicate the type of run. eg. nightly job"
     )
 
+    parser.add_argument(
+        "-T", "--textfile", default=None,
+        help="Write Prometheus metrics of the run to this file, for the textfile collector"
+    )
+
     args = parser.parse_args()
 
     # Setup logging verbosity
@@ -965,7 +988,18 @@ def main():
             print("Running regular job")
         if mode == "new":
             print("Running new job")
-        performRegularPortalChecks(mode=mode)
+        t_start = time.time()
+        succeeded = False
+        try:
+            performRegularPortalChecks(mode=mode)
+            succeeded = True
+        finally:
+            if args.textfile is not None:
+                telemetry.recordJob("es_eventlog_sync_" + mode, t_start, succeeded=succeeded)
+                try:
+                    telemetry.writeTextfile(args.textfile)
+                except OSError as e:
+                    logging.error("Unable to write the metrics to " + args.textfile + ": " + str(e))
 
     return
 
@@ -17,12 +17,19 @@ Example, sessions with 1000 or more events::
 
 
 import argparse
+import datetime
 import json
 import logging
 import os
 import sys
+import time
+from dateutil import parser as dateparser
+from d1_metrics import aggregatecache
 from d1_metrics import common
+from d1_metrics import metricsdatabase
 from d1_metrics import metricselasticsearch
+from d1_metrics import sessionizer
+from d1_metrics import telemetry
 
 
 def esCheck(args):
@@ -163,9 +170,96 @@ def esComputeSessions(args):
 
   '''
   _L = logging.getLogger(sys._getframe().f_code.co_name + "()")
+  t_start = time.time()
   elastic = metricselasticsearch.MetricsElasticSearch(args.config)
   elastic.connect()
-  elastic.computeSessions(dry_run=args.dryrun)
+  try:
+    if args.workers > 1:
+      processed, first_processed, last_processed = sessionizer.computeSessionsParallel(
+        args.config, args.workers, dry_run=args.dryrun, rescan=args.rescan)
+    else:
+      session_ids = sessionizer.getSessionIdAllocator(args.config, elastic)
+      database = metricsdatabase.MetricsDatabase(args.config)
+      computer = sessionizer.Sessionizer(elastic, session_ids=session_ids, database=database, rescan=args.rescan)
+      computer.computeSessions(dry_run=args.dryrun)
+      first_processed, last_processed = computer.first_processed, computer.last_processed
+  except Exception:
+    writeTelemetry(args, "compute_sessions", t_start, succeeded=False)
+    raise
+  if first_processed is not None:
+    recordSessionChanges(args.config, first_processed, last_processed)
+  writeTelemetry(args, "compute_sessions", t_start)
+
+
+def esRecordSessionWatermark(args):
+  '''
+  Record the events indexed already sessionized, e.g. by d1logsessionizer, since the
+  session watermark. Run after they are shipped.
+  Args:
+    args:
+
+  Returns:
+
+  '''
+  _L = logging.getLogger(sys._getframe().f_code.co_name + "()")
+  elastic = metricselasticsearch.MetricsElasticSearch(args.config)
+  elastic.connect()
+  last_sessionized = elastic.getLastSessionizedEventDatetime()
+  if last_sessionized is None:
+    _L.info("No sessionized events")
+    return
+  metrics_database = metricsdatabase.MetricsDatabase(args.config)
+  with metrics_database.pooledConnection():
+    watermark = metrics_database.getMetadataValue(metricsdatabase.METADATA_SESSION_WATERMARK)
+  if watermark is None:
+    # Unknown what changed, invalidate all the cached months
+    first_changed = datetime.datetime(1970, 1, 1, tzinfo=last_sessionized.tzinfo)
+  else:
+    first_changed = dateparser.parse(watermark)
+    if last_sessionized <= first_changed:
+      _L.info("No events sessionized after the watermark %s", watermark)
+      return
+  _L.info("Events sessionized up to %s", last_sessionized.isoformat())
+  if not args.dryrun:
+    recordSessionChanges(args.config, first_changed, last_sessionized)
+
+
+def recordSessionChanges(config_file, first_changed, last_changed):
+  '''
+  Invalidate the cached aggregations of the sessions that changed and record the
+  session watermark, used by the service for the ETag of the responses.
+
+  Args:
+    config_file: configuration file of the metrics database
+    first_changed: datetime of the first event sessionized
+    last_changed: datetime of the last event sessionized
+  '''
+  _L = logging.getLogger(sys._getframe().f_code.co_name + "()")
+  # Sessions of events older than the first one may change, as far back as the session duration
+  since = first_changed - datetime.timedelta(minutes=metricselasticsearch.MetricsElasticSearch.SESSION_TTL_MINUTES)
+  try:
+    aggregatecache.MonthlyAggregateCache(config_file).invalidateSince(since)
+  except Exception as e:
+    _L.error("Unable to invalidate the aggregate cache: %s", e)
+  metrics_database = metricsdatabase.MetricsDatabase(config_file)
+  try:
+    with metrics_database.pooledConnection():
+      metrics_database.setMetadataValue(metricsdatabase.METADATA_SESSION_WATERMARK, last_changed.isoformat())
+  except Exception as e:
+    _L.error("Unable to record the session watermark: %s", e)
+
+
+def writeTelemetry(args, job, t_start, succeeded=True):
+  '''
+  Write the metrics of the run to the textfile given by --textfile, if any.
+  '''
+  if args.textfile is None:
+    return
+  telemetry.recordJob(job, t_start, succeeded=succeeded)
+  try:
+    telemetry.writeTextfile(args.textfile)
+  except OSError as e:
+    logging.error("Unable to write the metrics to %s: %s", args.textfile, e)
 
 
 def main():
@@ -176,6 +270,7 @@ def main():
     "searches": esGetSearches,
     "sessions": esGetSessions,
     "compute": esComputeSessions,
+    "watermark": esRecordSessionWatermark,
   }
   parser = argparse.ArgumentParser(description=__doc__,
     formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -209,6 +304,16 @@ def main():
   parser.add_argument("-Y","--dryrun",
                       action="store_true",
                       help="Dry run - don't make any changes.")
+  parser.add_argument("-W","--workers",
+                      default=1,
+                      type=int,
+                      help="Number of processes computing sessions, each for a partition of the IP addresses (1)")
+  parser.add_argument("-R","--rescan",
+                      action="store_true",
+                      help="Compute the sessions from the first unprocessed event instead of the checkpoint.")
+  parser.add_argument("-T","--textfile",
+                      default=None,
+                      help="Write Prometheus metrics of the run to this file, for the textfile collector")
   parser.add_argument('command',
                       nargs='?',
                       default="check",
@@ -1,14 +1,19 @@
 import logging
 import psycopg2
+import psycopg2.pool
 import configparser
 import collections
+import contextlib
 import json
+import threading
+import time
 
 try:
     from cPickle import dumps, loads, HIGHEST_PROTOCOL as PICKLE_PROTOCOL
 except ImportError:
     from pickle import dumps, loads, HIGHEST_PROTOCOL as PICKLE_PROTOCOL
 from d1_metrics import common
+from d1_metrics import telemetry
 from d1_metrics.metricselasticsearch import MetricsElasticSearch
 import requests
 from d1_metrics import solrclient
@@ -22,13 +27,30 @@ DEFAULT_DB_CONFIG = {
     "user": "metrics",
     "password": ""
 }
+DEFAULT_POOL_CONFIG = {
+    "pool_minconn": 1,      # connections opened when the pool is created
+    "pool_maxconn": 10,     # maximum connections held by the pool of a process
+    "pool_timeout": 30,     # seconds to wait for a free connection
+}
 SOLR_RESERVED_CHAR_LIST = [
   '+', '-', '&', '|', '!', '(', ')', '{', '}', '[', ']', '^', '"', '~', '*',
   '?', ':'
 ]
+# Keys of the db_metadata values recording when the data served by the service last changed
+METADATA_SESSION_WATERMARK = "session_watermark"
+METADATA_PORTAL_INDEX_UPDATED = "portal_index_updated"
+# Key prefix of the checkpoints of the sessionizer, see d1_metrics.sessionizer
+METADATA_SESSION_CHECKPOINT = "session_checkpoint"
+
 SOLR_QUERY_URL = "https://cn-secondary.dataone.org/cn/v2/query/solr/"
 CN_URL = "https://cn-secondary.dataone.org/cn/v2/query"
 
+# Connection pools shared by the MetricsDatabase instances of a process, keyed by the
+# connection settings. Each entry is (pool, semaphore) where the semaphore bounds the
+# number of connections that can be borrowed at the same time.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
 
 class MetricsDatabase(object):
     '''
@@ -40,6 +62,7 @@ class MetricsDatabase(object):
         self.conn = None
         self.solr_query_url = SOLR_QUERY_URL
         self._config = DEFAULT_DB_CONFIG
+        self._pool_config = dict(DEFAULT_POOL_CONFIG)
         if not config_file is None:
             self.loadConfig(config_file)
 
@@ -59,6 +82,8 @@ class MetricsDatabase(object):
         config.read(config_file)
         for key, value in iter(self._config.items()):
             self._config[key] = config.get(CONFIG_DATABASE_SECTION, key, fallback=value)
+        for key, value in iter(self._pool_config.items()):
+            self._pool_config[key] = config.getint(CONFIG_DATABASE_SECTION, key, fallback=value)
         return self._config
 
 
@@ -123,6 +148,100 @@ class MetricsDatabase(object):
         return self.conn.cursor()
 
 
+    def _getPool(self):
+        '''
+        Retrieve the connection pool for the configured database, creating it if necessary.
+
+        Returns:
+          tuple of (ThreadedConnectionPool, semaphore bounding the borrowed connections)
+        '''
+        key = tuple(sorted(self._config.items()))
+        with _POOLS_LOCK:
+            entry = _POOLS.get(key)
+            if entry is None:
+                self._L.info("Creating connection pool for {user}@{host}:{port}/{dbname}".format(**self._config))
+                connection_pool = psycopg2.pool.ThreadedConnectionPool(self._pool_config["pool_minconn"],
+                                                                       self._pool_config["pool_maxconn"],
+                                                                       **self._config)
+                entry = (connection_pool, threading.BoundedSemaphore(self._pool_config["pool_maxconn"]))
+                _POOLS[key] = entry
+        return entry
+
+
+    def _getHealthyConnection(self, connection_pool):
+        '''
+        Get a connection from the pool, replacing it if the server dropped it while idle.
+
+        Args:
+          connection_pool: pool to take the connection from
+
+        Returns:
+          connection
+        '''
+        conn = connection_pool.getconn()
+        if not conn.closed:
+            try:
+                with conn.cursor() as csr:
+                    csr.execute("SELECT 1;")
+                conn.rollback()
+                return conn
+            except psycopg2.Error as e:
+                self._L.warning("Discarding broken pooled connection: %s", e)
+        connection_pool.putconn(conn, close=True)
+        return connection_pool.getconn()
+
+
+    @contextlib.contextmanager
+    def pooledConnection(self):
+        '''
+        Borrow a connection from the process wide pool for the duration of a with block.
+
+        While the connection is borrowed it is also the connection used by the other methods
+        of this instance, so getCursor() and friends work unchanged inside the block. On exit
+        the connection is returned to the pool, rolling back any uncommitted transaction.
+
+        Waits up to pool_timeout seconds for a connection when all of them are in use.
+
+        Yields:
+          connection
+        '''
+        connection_pool, slots = self._getPool()
+        t_start = time.time()
+        acquired = slots.acquire(timeout=self._pool_config["pool_timeout"])
+        telemetry.PG_POOL_WAIT_SECONDS.observe(time.time() - t_start)
+        if not acquired:
+            raise psycopg2.pool.PoolError("Timed out waiting for a pooled database connection")
+        self._L.debug("Waited %fsec for a pooled connection", time.time() - t_start)
+        previous_conn = self.conn
+        conn = None
+        broken = False
+        try:
+            conn = self._getHealthyConnection(connection_pool)
+            self.conn = conn
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.conn = previous_conn
+            if conn is not None:
+                connection_pool.putconn(conn, close=broken or bool(conn.closed))
+            slots.release()
+
+
+    @contextlib.contextmanager
+    def pooledCursor(self):
+        '''
+        Convenience wrapper of pooledConnection() that yields a cursor.
+
+        Yields:
+          cursor on a pooled connection
+        '''
+        with self.pooledConnection() as conn:
+            with conn.cursor() as csr:
+                yield csr
+
+
     def _iterRow(self, cursor, num_rows=100):
         '''
         Iterator method for access to query results.
@@ -256,6 +375,38 @@ class MetricsDatabase(object):
         self.conn.commit()
 
 
+    def reserveSessionIds(self, index_name, count, first_session_id=None):
+        '''
+        Atomically reserve a range of sessionIds of an event index. Concurrent callers
+        always get disjoint ranges.
+
+        Args:
+          index_name: name of the event index
+          count: number of sessionIds to reserve
+          first_session_id: callable returning the first sessionId to hand out, called
+            only when the index has no allocator yet, e.g. on the first run
+
+        Returns: the first sessionId of the range, the range is [first, first + count)
+
+        '''
+        sql = "UPDATE session_id_allocator SET next_id=next_id + %s, updated_at=now() " \
+              "WHERE index_name=%s RETURNING next_id - %s"
+        csr = self.getCursor()
+        csr.execute(sql, (count, index_name, count))
+        row = csr.fetchone()
+        if row is None:
+            first = 1
+            if first_session_id is not None:
+                first = first_session_id()
+            self._L.info("Starting sessionId allocator of %s at %d", index_name, first)
+            csr.execute("INSERT INTO session_id_allocator (index_name, next_id) VALUES (%s, %s) "
+                        "ON CONFLICT (index_name) DO NOTHING", (index_name, first))
+            csr.execute(sql, (count, index_name, count))
+            row = csr.fetchone()
+        self.conn.commit()
+        return row[0]
+
+
     def getMetadata(self):
         '''
         Retrieve all the metadata entries
@@ -8,11 +8,15 @@ from elasticsearch import helpers
 import requests
 import json
 import datetime
+import threading
+import concurrent.futures
 from dateutil import parser as dateparser
 from dateutil.tz import tzutc
 from pytz import timezone
 import json
 import pprint
+from d1_metrics import telemetry
+from d1_metrics import timing
 
 CONFIG_ELASTIC_SECTION = "elasticsearch"
 DEFAULT_ELASTIC_CONFIG = {
@@ -20,8 +24,55 @@ DEFAULT_ELASTIC_CONFIG = {
   "port":9200,
   "index":"eventlog-1",
   "request_timeout":60,
+  "maxsize":25,            # HTTP connections kept alive per node by each pooled client
+  "http_compress":False,   # gzip request and response bodies
   }
 
+# Process wide registry of Elasticsearch clients, keyed by connection settings.
+# The clients are thread safe and hold the keep-alive connection pools, so they are
+# shared by all the MetricsElasticSearch instances and threads of a process.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def getPooledClient(host, port, maxsize=DEFAULT_ELASTIC_CONFIG["maxsize"], http_compress=False,
+                    force_new=False):
+  '''
+  Get the shared Elasticsearch client for a server, creating it on first use.
+
+  Args:
+    host: Elasticsearch host
+    port: Elasticsearch port
+    maxsize: number of connections to keep open to the node
+    http_compress: compress request and response bodies with gzip
+    force_new: replace the registered client with a new one
+
+  Returns:
+    Elasticsearch client
+  '''
+  key = (host, port, maxsize, http_compress)
+  with _CLIENTS_LOCK:
+    client = _CLIENTS.get(key)
+    if client is None or force_new:
+      settings = {"host": host,
+                  "port": port,
+                  }
+      kwargs = {"maxsize": maxsize}
+      if http_compress:
+        kwargs["http_compress"] = True
+      client = Elasticsearch([settings,], **kwargs)
+      _CLIENTS[key] = client
+    return client
+
+
+def clearPooledClients():
+  '''
+  Drop all the registered clients, e.g. in a child process after fork.
+  '''
+  with _CLIENTS_LOCK:
+    _CLIENTS.clear()
+
+
 class MetricsElasticSearch(object):
   '''
 
@@ -33,6 +84,7 @@ class MetricsElasticSearch(object):
   F_SESSIONID = "sessionId"     # Name of the sessionId field
   F_DATELOGGED = "dateLogged"   # Name of the field where the event timestamp is recorded
   F_IPADDR = "ipAddress"        # name ofthe IP Address field
+  SLICE_WORKERS = 4             # Concurrent requests for a time sliced aggregation
 
 
   def __init__(self, config_file=None, index_name=None):
@@ -95,8 +147,9 @@ class MetricsElasticSearch(object):
       query = query.copy() if query else {}
       query["sort"] = "_doc"
     # initial search
-    resp = self._es.search(body=query, scroll=scroll, size=size,
-                         request_timeout=request_timeout, **kwargs)
+    with telemetry.ES_QUERY_SECONDS.time(operation="scan"):
+      resp = self._es.search(body=query, scroll=scroll, size=size,
+                             request_timeout=request_timeout, **kwargs)
     total_hits = resp["hits"]["total"]
     logging.info("Total hits = %d", total_hits)
 
@@ -112,9 +165,10 @@ class MetricsElasticSearch(object):
         if first_run:
           first_run = False
         else:
-          resp = self._es.scroll(scroll_id, scroll=scroll,
-                               request_timeout=request_timeout,
-                               **scroll_kwargs)
+          with telemetry.ES_QUERY_SECONDS.time(operation="scan"):
+            resp = self._es.scroll(scroll_id, scroll=scroll,
+                                   request_timeout=request_timeout,
+                                   **scroll_kwargs)
         for hit in resp['hits']['hits']:
           current_entry += 1
           yield (hit, current_entry, total_hits)
@@ -157,6 +211,10 @@ class MetricsElasticSearch(object):
     for key, value in iter(self._config.items()):
       self._config[key] = config.get(CONFIG_ELASTIC_SECTION, key, fallback=value)
     self._config["port"] = int(self._config["port"])
+    self._config["request_timeout"] = float(self._config["request_timeout"])
+    self._config["maxsize"] = int(self._config["maxsize"])
+    if isinstance(self._config["http_compress"], str):
+      self._config["http_compress"] = self._config["http_compress"].lower() in ("1", "true", "yes", "on")
     return self._config
 
 
@@ -169,6 +227,9 @@ class MetricsElasticSearch(object):
     '''
     Connect to the ElasticSearch server
 
+    The client is taken from the process wide registry so that connections are
+    reused across instances and requests.
+
     Args:
       force_reconnect: Force a reconnection even if one is already created
 
@@ -178,10 +239,11 @@ class MetricsElasticSearch(object):
     if self._es is not None and not force_reconnect:
       self._L.info("Elastic Search connection already established.")
       return
-    settings = {"host": self._config["host"],
-                "port": self._config["port"],
-                }
-    self._es = Elasticsearch([settings,])
+    self._es = getPooledClient(self._config["host"],
+                               self._config["port"],
+                               maxsize=self._config.get("maxsize", DEFAULT_ELASTIC_CONFIG["maxsize"]),
+                               http_compress=self._config.get("http_compress", False),
+                               force_new=force_reconnect)
 
 
   def getInfo(self, show_mappings=False):
@@ -551,12 +613,43 @@ class MetricsElasticSearch(object):
     return results, naggregates
 
 
-  def countUnprocessedEvents(self, index_name=None):
+  def getPartitionFilter(self, partition):
+    '''
+    Query clause matching the events of one partition of the IP addresses. An address
+    belongs to the partition of the hash of the address modulo the number of partitions,
+    so all the events of an address, and all its sessions, are in the same partition.
+
+    Args:
+      partition: (worker, workers), the index of the partition and the number of partitions
+
+    Returns:
+      script query
+    '''
+    worker, workers = partition
+    return {
+      "script": {
+        "script": {
+          "inline": "doc['" + MetricsElasticSearch.F_IPADDR + "'].size() == 0 ? params.worker == 0 : "
+                    "Math.floorMod(doc['" + MetricsElasticSearch.F_IPADDR + "'].value.hashCode(), params.workers) "
+                    "== params.worker",
+          "lang": "painless",
+          "params": {
+            "worker": worker,
+            "workers": workers,
+          }
+        }
+      }
+    }
+
+
+  def countUnprocessedEvents(self, index_name=None, partition=None, date_end=None):
     '''
     Count the number of events that have no sessionId.
 
     Args:
       index_name: name of the index containing events
+      partition: (worker, workers), count only the events of a partition, see getPartitionFilter
+      date_end: datetime, count only the events logged up to and including it
 
     Returns:
       integer, number of events without a sessionId
@@ -582,6 +675,11 @@ class MetricsElasticSearch(object):
         }
       }
     }
+    if partition is not None:
+      search_body["query"]["bool"]["must"].append(self.getPartitionFilter(partition))
+    if date_end is not None:
+      search_body["query"]["bool"]["must"].append(
+        {"range": {MetricsElasticSearch.F_DATELOGGED: {"lte": date_end.isoformat()}}})
     if index_name is None:
       index_name = self.indexname
     try:
@@ -627,12 +725,13 @@ class MetricsElasticSearch(object):
       yield next_session_id
 
 
-  def getFirstUnprocessedEventDatetime(self, index_name=None):
+  def getFirstUnprocessedEventDatetime(self, index_name=None, partition=None):
     '''
     Returns the datetime of the oldest read event with no session information.
 
     Args:
       index_name: Name of index to use
+      partition: (worker, workers), consider only the events of a partition, see getPartitionFilter
 
     Returns:
       datetime or None
@@ -664,6 +763,8 @@ class MetricsElasticSearch(object):
         }
       }
     }
+    if partition is not None:
+      search_body["query"]["bool"]["must"].append(self.getPartitionFilter(partition))
     if index_name is None:
       index_name = self.indexname
     try:
@@ -678,6 +779,59 @@ class MetricsElasticSearch(object):
     return None
 
 
+  def getLastSessionizedEventDatetime(self, index_name=None, partition=None):
+    '''
+    Returns the datetime of the most recent read event with session information.
+
+    Args:
+      index_name: Name of index to use
+      partition: (worker, workers), consider only the events of a partition, see getPartitionFilter
+
+    Returns:
+      datetime or None
+    '''
+    search_body = {
+      "from": 0, "size": 0,
+      "query": {
+        "bool": {
+          "must": [
+            {
+              "term": {"fields.entryType": self._entryname}
+            },
+            {
+              "term": {"event.key": "read"}
+            },
+            {
+              "exists": {
+                "field": MetricsElasticSearch.F_SESSIONID
+              }
+            },
+          ],
+        }
+      },
+      "aggs": {
+        "max_timestamp": {
+          "max": {
+            "field": MetricsElasticSearch.F_DATELOGGED
+          }
+        }
+      }
+    }
+    if partition is not None:
+      search_body["query"]["bool"]["must"].append(self.getPartitionFilter(partition))
+    if index_name is None:
+      index_name = self.indexname
+    try:
+      results = self._es.search(index=index_name, body=search_body)
+      esvalue = results["aggregations"]["max_timestamp"]["value"] or None
+      if esvalue is None:
+        raise ValueError("No processed events.")
+      return datetime.datetime.fromtimestamp(esvalue / 1000, tz=tzutc())
+    except Exception as e:
+      self._L.warning(e)
+    return None
+
+
   def getLiveSessionsSearchBody(self, mark):
     '''
     Returns a search body for retrieving active sessions.
@@ -771,7 +925,8 @@ class MetricsElasticSearch(object):
       index_name = self.indexname
     search_body = self.getLiveSessionsSearchBody( mark )
     self._L.debug(json.dumps(search_body, indent=2))
-    results = self._es.search(index=index_name, body=search_body)
+    with telemetry.ES_QUERY_SECONDS.time(operation="search"):
+      results = self._es.search(index=index_name, body=search_body)
     self._L.debug(str(results))
     for item in results["aggregations"]["group"]["buckets"]:
       record = item["group_docs"]["hits"]["hits"][0]["_source"]
@@ -787,14 +942,18 @@ class MetricsElasticSearch(object):
     return live_sessions
 
 
-  def getNewEvents(self, index_name=None, batch_size=BATCH_SIZE):
+  def getNewEvents(self, index_name=None, batch_size=BATCH_SIZE, source_fields=None, partition=None,
+                   search_after=None):
     '''
     Get a batch of events that are not associated with a session
     Args:
       index_name: Name of the index to use
       batch_size: Maximum number of records to return in the batch
+      source_fields: list of the fields of the events to return, all fields if None
+      partition: (worker, workers), return only the events of a partition, see getPartitionFilter
+      search_after: sort values of the last event of the previous batch, from its "sort" entry
 
-    Returns: elastic search response structure with the events, ordered by date logged.
+    Returns: elastic search response structure with the events, ordered by date logged and uid.
     '''
     if index_name is None:
       index_name = self.indexname
@@ -822,10 +981,21 @@ class MetricsElasticSearch(object):
           "order": "asc",
           "unmapped_type": "date"
         }
+      },{
+        "_uid": {
+          "order": "asc"
+        }
       }]
     }
+    if search_after is not None:
+      search_body["search_after"] = search_after
+    if source_fields is not None:
+      search_body["_source"] = {"includes": source_fields}
+    if partition is not None:
+      search_body["query"]["bool"]["must"].append(self.getPartitionFilter(partition))
     try:
-      results = self._es.search(index=index_name, body=search_body)
+      with telemetry.ES_QUERY_SECONDS.time(operation="search"):
+        results = self._es.search(index=index_name, body=search_body)
       if results["hits"]["hits"] is None:
         raise ValueError("No hits in result.")
       return results
@@ -884,6 +1054,130 @@ class MetricsElasticSearch(object):
     return None
 
 
+  def getLastProcessedEventDatetimeByIps(self, index_name=None, client_ips=[], since=None):
+    '''
+    Datetime of the most recent event with a session of each of a list of IP addresses,
+    in a single request.
+
+    Args:
+      index_name: Name of the event index
+      client_ips: list of IP addresses
+      since: datetime, only events logged after since are considered
+
+    Returns:
+      {ip: datetime} for the addresses with such events
+    '''
+    if index_name is None:
+      index_name = self.indexname
+    if len(client_ips) == 0:
+      return {}
+    search_body = {
+      "from": 0, "size": 0,
+      "query": {
+        "bool": {
+          "must": [
+            {
+              "term": {"fields.entryType": self._entryname}
+            },
+            {
+              "term":{"event.key": "read"}
+            },
+            {
+              "range": {
+                MetricsElasticSearch.F_SESSIONID: {"gt": 0}
+              }
+            },
+            {
+              "terms": {MetricsElasticSearch.F_IPADDR: client_ips}
+            }
+          ],
+        }
+      },
+      "aggs": {
+        "group": {
+          "terms": {
+            "field": MetricsElasticSearch.F_IPADDR,
+            "size": len(client_ips)
+          },
+          "aggs": {
+            "max_timestamp": {
+              "max": {
+                "field": MetricsElasticSearch.F_DATELOGGED
+              }
+            }
+          }
+        }
+      }
+    }
+    if since is not None:
+      search_body["query"]["bool"]["must"].append(
+        {"range": {MetricsElasticSearch.F_DATELOGGED: {"gt": since.isoformat()}}}
+      )
+    with telemetry.ES_QUERY_SECONDS.time(operation="search"):
+      results = self._es.search(index=index_name, body=search_body)
+    last_entry_dates = {}
+    for bucket in results["aggregations"]["group"]["buckets"]:
+      esvalue = bucket["max_timestamp"]["value"]
+      if esvalue is not None:
+        last_entry_dates[bucket["key"]] = datetime.datetime.fromtimestamp(esvalue / 1000, tz=tzutc())
+    return last_entry_dates
+
+
+  def getSessionizedEvents(self, index_name=None, date_start=None, date_end=None, partition=None):
+    '''
+    Iterate over the read events with a session logged in [date_start, date_end), in no
+    particular order.
+
+    Args:
+      index_name: Name of the event index
+      date_start: datetime
+      date_end: datetime
+      partition: (worker, workers), only the events of a partition, see getPartitionFilter
+
+    Returns:
+      generator of the _source of the events, with the date logged, IP address and sessionId
+    '''
+    if index_name is None:
+      index_name = self.indexname
+    search_body = {
+      "query": {
+        "bool": {
+          "must": [
+            {
+              "term": {"fields.entryType": self._entryname}
+            },
+            {
+              "term":{"event.key": "read"}
+            },
+            {
+              "range": {
+                MetricsElasticSearch.F_SESSIONID: {"gte": 0}
+              }
+            },
+            {
+              "range": {
+                MetricsElasticSearch.F_DATELOGGED: {
+                  "gte": date_start.isoformat(),
+                  "lt": date_end.isoformat()
+                }
+              }
+            }
+          ],
+        }
+      },
+      "_source": {"includes": [
+        MetricsElasticSearch.F_DATELOGGED,
+        MetricsElasticSearch.F_IPADDR,
+        MetricsElasticSearch.F_SESSIONID
+        ]
+      }
+    }
+    if partition is not None:
+      search_body["query"]["bool"]["must"].append(self.getPartitionFilter(partition))
+    for hit, counter, total_hits in self._scan(query=search_body, index=index_name):
+      yield hit["_source"]
+
+
   def removeStaleSessionIds(self, index_name=None, client_ip=None, time_stamp=None):
     if index_name is None:
       index_name = self.indexname
@@ -921,22 +1215,60 @@ class MetricsElasticSearch(object):
       }
     }
     self._es.indices.refresh(index_name)
-    results = self._es.update_by_query(index=index_name,
-                                       body=search_body,
-                                       conflicts="proceed",
-                                       request_timeout=self._config["request_timeout"],
-                                       wait_for_completion="true")
+    with telemetry.ES_QUERY_SECONDS.time(operation="update_by_query"):
+      results = self._es.update_by_query(index=index_name,
+                                         body=search_body,
+                                         conflicts="proceed",
+                                         request_timeout=self._config["request_timeout"],
+                                         wait_for_completion="true")
     self._es.indices.refresh(index_name)
     self._L.debug(results)
     return results
 
 
   def updateRecord(self, index_name, record):
-    self._es.update(index=index_name,
-                    id = record["_id"],
-                    doc_type=self._doc_type,
-                    request_timeout=self._config["request_timeout"],
-                    body={"doc": record["_source"]})
+    with telemetry.ES_QUERY_SECONDS.time(operation="update"):
+      self._es.update(index=index_name,
+                      id = record["_id"],
+                      doc_type=self._doc_type,
+                      request_timeout=self._config["request_timeout"],
+                      body={"doc": record["_source"]})
+
+
+  def bulkUpdateRecords(self, index_name, updates, chunk_size=BATCH_SIZE):
+    '''
+    Partial update of many records with bulk requests.
+
+    Args:
+      index_name: name of the event index
+      updates: iterable of (_id, dictionary of the fields to set)
+      chunk_size: number of updates per bulk request
+
+    Returns:
+      number of records updated. Raises BulkIndexError if any update failed.
+    '''
+    actions = ({
+        "_op_type": "update",
+        "_index": index_name,
+        "_type": self._doc_type,
+        "_id": record_id,
+        "doc": fields,
+      } for record_id, fields in updates)
+    with telemetry.ES_QUERY_SECONDS.time(operation="bulk"):
+      success, errors = helpers.bulk(self._es,
+                                     actions,
+                                     chunk_size=chunk_size,
+                                     request_timeout=self._config["request_timeout"])
+    return success
+
+
+  def refresh(self, index_name=None):
+    '''
+    Make the recent changes to an index visible to searches.
+    '''
+    if index_name is None:
+      index_name = self.indexname
+    self._es.indices.refresh(index_name)
 
 
   def _processNewEvents(self, index_name=None, new_events=[], live_sessions=[]):
@@ -1072,26 +1404,18 @@ class MetricsElasticSearch(object):
     return 1
 
 
-  def get_aggregations(self,
-                  date_start,
-                  date_end,
-                  index=None,
-                  query=None,
-                  aggQuery=None,
-                  after_record = None):
+  def getAggregationsSearchBody(self,
+                                date_start,
+                                date_end,
+                                query=None,
+                                aggQuery=None,
+                                after_record=None,
+                                agg_name="pid_list",
+                                date_end_inclusive=True):
     """
-    Retrieve a response for aggregations
-    :param date_start:
-    :param date_end:
-    :param index:
-    :param query:
-    :param aggQuery:
-    :param after_record:
-    :return: Aggregations dictionary
+    Search body of an aggregations request, see get_aggregations
+    :return: search body dictionary
     """
-
-    if index is None:
-      index = self.indexname
     search_body = {
       "size": 0,
       "query": {
@@ -1116,7 +1440,7 @@ class MetricsElasticSearch(object):
             "range": {
               MetricsElasticSearch.F_DATELOGGED: {
                 "gte": date_start.isoformat(),
-                "lte": date_end.isoformat()
+                "lte" if date_end_inclusive else "lt": date_end.isoformat()
               }
             }
           }
@@ -1131,38 +1455,255 @@ class MetricsElasticSearch(object):
     if(aggQuery is not None):
       search_body["aggs"] = aggQuery
     if(after_record is not None):
-      search_body["aggs"]["pid_list"]["composite"]["after"] = {}
-      search_body["aggs"]["pid_list"]["composite"]["after"] = after_record
+      # Copy the composite so the caller's aggregation body is not modified
+      search_body["aggs"] = dict(search_body["aggs"])
+      search_body["aggs"][agg_name] = dict(search_body["aggs"][agg_name])
+      search_body["aggs"][agg_name]["composite"] = dict(search_body["aggs"][agg_name]["composite"])
+      search_body["aggs"][agg_name]["composite"]["after"] = after_record
+    return search_body
+
+
+  def msearch_aggregations(self, requests):
+    """
+    Retrieve the responses of several aggregation requests with a single _msearch call
+    :param requests: list of dictionaries with the date_start, date_end, query, aggQuery and
+      optionally date_end_inclusive parameters of get_aggregations
+    :return: list of responses in the order of requests, None for a request that failed
+    """
+    if len(requests) == 0:
+      return []
+    body = []
+    for request in requests:
+      body.append({})
+      body.append(self.getAggregationsSearchBody(request["date_start"], request["date_end"],
+                                                 query=request.get("query"),
+                                                 aggQuery=request.get("aggQuery"),
+                                                 date_end_inclusive=request.get("date_end_inclusive", True)))
+    self._L.debug("msearch of %d aggregation requests", len(requests))
+    with timing.span(timing.STAGE_ES), telemetry.ES_QUERY_SECONDS.time(operation="msearch"):
+      results = self._es.msearch(body=body, request_timeout=self._config["request_timeout"])
+    responses = []
+    for response in results["responses"]:
+      if "error" in response:
+        self._L.warning("msearch request failed: %s", str(response["error"]))
+        response = None
+      responses.append(response)
+    return responses
+
+
+  def get_aggregations(self,
+                  date_start,
+                  date_end,
+                  index=None,
+                  query=None,
+                  aggQuery=None,
+                  after_record = None,
+                  agg_name = "pid_list",
+                  date_end_inclusive = True):
+    """
+    Retrieve a response for aggregations
+    :param date_start:
+    :param date_end:
+    :param date_end_inclusive: include events logged at date_end, otherwise date_end is excluded
+    :param index:
+    :param query:
+    :param aggQuery:
+    :param after_record: composite key to continue the aggregation from
+    :param agg_name: name of the composite aggregation that after_record applies to
+    :return: Aggregations dictionary
+    """
+
+    if index is None:
+      index = self.indexname
+    search_body = self.getAggregationsSearchBody(date_start, date_end, query=query, aggQuery=aggQuery,
+                                                 after_record=after_record, agg_name=agg_name,
+                                                 date_end_inclusive=date_end_inclusive)
     self._L.debug("Request: %s", str(search_body))
-    resp = self._es.search(body=search_body, request_timeout=self._config["request_timeout"])
+    with timing.span(timing.STAGE_ES), telemetry.ES_QUERY_SECONDS.time(operation="aggregation"):
+      resp = self._es.search(body=search_body, request_timeout=self._config["request_timeout"])
     return(resp)
 
 
+  def iterate_composite_aggregation_pages(self, start_date, end_date, search_query = None, aggregation_query = None,
+                                          agg_name = "pid_list", date_end_inclusive = True, first_response = None):
+    """
+    Generator over the pages of a composite aggregation.
+
+    Pages are requested using the `after_key` returned by ES for the composite aggregation named
+    agg_name until no further key is returned or a short page is received. The page size is the
+    `size` set in the composite aggregation body (ES defaults to 10 when it is not set).
 
-  def iterate_composite_aggregations(self, start_date, end_date, search_query = None, aggregation_query = None):
+    :param start_date:
+    :param end_date:
+    :param search_query:
+    :param aggregation_query:
+    :param agg_name: name of the composite aggregation to page through
+    :param date_end_inclusive: include events logged at end_date
+    :param first_response: response of the first page when it was already retrieved, e.g. by msearch_aggregations
+    :return: yields (response, buckets) for each page retrieved from ES
+    """
+    size = aggregation_query[agg_name]["composite"].get("size", 10)
+    after = None
+    while True:
+      if after is None and first_response is not None:
+        response = first_response
+      else:
+        response = self.get_aggregations(query=search_query, aggQuery=aggregation_query, date_start=start_date,
+                                         date_end=end_date, after_record=after, agg_name=agg_name,
+                                         date_end_inclusive=date_end_inclusive)
+      composite = response["aggregations"][agg_name]
+      buckets = composite["buckets"]
+      yield response, buckets
+      if len(buckets) < size:
+        return
+      # after_key is returned by ES >= 6.3, fall back to the key of the last bucket otherwise
+      after = composite.get("after_key", buckets[-1]["key"])
+
+
+  def iterate_composite_aggregations(self, start_date, end_date, search_query = None, aggregation_query = None,
+                                     agg_name = "pid_list", date_end_inclusive = True, first_response = None):
     """
     Performs pagination using the `after` parameter of the Composite aggregations of the ES.
+
+    Other aggregations in aggregation_query are taken from the first page of results.
+
     :param start_date:
     :param end_date:
     :param search_query:
     :param aggregation_query:
+    :param agg_name: name of the composite aggregation to page through
+    :param date_end_inclusive: include events logged at end_date
+    :param first_response: response of the first page when it was already retrieved
     :return: Returns aggregated list of all the results retrieved from the ES
     """
-    count = 0
-    total = 0
-    size = 100
-    if(count == total == 0):
-      aggregations = self.get_aggregations( query=search_query, aggQuery = aggregation_query, date_start=start_date, date_end=end_date)
-      count = count + size
-      total = aggregations["hits"]["total"]
-    while( count < total):
-      after = aggregations["aggregations"]["pid_list"]["buckets"][-1]
-      temp = self.get_aggregations(query=search_query, aggQuery = aggregation_query, date_start=start_date, date_end=end_date, after_record=after["key"])
-      if(len(temp["aggregations"]["pid_list"]["buckets"]) == 0):
-        break
-      aggregations["aggregations"]["pid_list"]["buckets"] = aggregations["aggregations"]["pid_list"]["buckets"] \
-                                                            + temp["aggregations"]["pid_list"]["buckets"]
-      count = count + size
+    aggregations = None
+    for response, buckets in self.iterate_composite_aggregation_pages(start_date, end_date,
+                                                                      search_query=search_query,
+                                                                      aggregation_query=aggregation_query,
+                                                                      agg_name=agg_name,
+                                                                      date_end_inclusive=date_end_inclusive,
+                                                                      first_response=first_response):
+      if aggregations is None:
+        aggregations = response
+      else:
+        aggregations["aggregations"][agg_name]["buckets"].extend(buckets)
+    aggregations["aggregations"][agg_name].pop("after_key", None)
+    return aggregations
+
+
+  def getTimeSlices(self, start_date, end_date, slice_by=None):
+    """
+    Splits the range start_date to end_date on calendar boundaries.
+
+    :param start_date:
+    :param end_date:
+    :param slice_by: "year" or "month". When None, ranges longer than two years are sliced by year.
+    :return: list of (slice_start, slice_end, end_inclusive). Only the last slice includes its end date.
+    """
+    if slice_by is None:
+      slice_by = "year" if (end_date - start_date).days > 730 else "month"
+    boundaries = []
+    if slice_by == "year":
+      boundary = datetime.datetime(start_date.year + 1, 1, 1, tzinfo=start_date.tzinfo)
+      while boundary < end_date:
+        boundaries.append(boundary)
+        boundary = boundary.replace(year=boundary.year + 1)
+    elif slice_by == "month":
+      boundary = datetime.datetime(start_date.year + start_date.month // 12, start_date.month % 12 + 1, 1,
+                                   tzinfo=start_date.tzinfo)
+      while boundary < end_date:
+        boundaries.append(boundary)
+        boundary = boundary.replace(year=boundary.year + boundary.month // 12, month=boundary.month % 12 + 1)
+    else:
+      raise ValueError("Unsupported time slice: %s" % slice_by)
+    slices = []
+    slice_start = start_date
+    for boundary in boundaries:
+      slices.append((slice_start, boundary, False))
+      slice_start = boundary
+    slices.append((slice_start, end_date, True))
+    return slices
+
+
+  @staticmethod
+  def mergeCompositeBuckets(aggregation_query, bucket_lists, agg_name="pid_list"):
+    """
+    Merges the buckets of a composite aggregation retrieved for disjoint time ranges.
+
+    Buckets with the same key are combined by adding their doc_count and single value metrics,
+    which is exact for counts over disjoint sets of events. The merged buckets are returned in
+    the order ES returns them for the composite sources.
+
+    :param aggregation_query: the aggregation body used for the requests
+    :param bucket_lists: list of bucket lists to merge
+    :param agg_name: name of the composite aggregation
+    :return: list of buckets
+    """
+    merged = {}
+    for buckets in bucket_lists:
+      for bucket in buckets:
+        key = tuple(sorted(bucket["key"].items()))
+        if key not in merged:
+          merged[key] = bucket
+          continue
+        existing = merged[key]
+        existing["doc_count"] += bucket["doc_count"]
+        for name, value in bucket.items():
+          if isinstance(value, dict) and "value" in value and value["value"] is not None:
+            existing[name]["value"] = (existing[name]["value"] or 0) + value["value"]
+    result = list(merged.values())
+    for source in reversed(aggregation_query[agg_name]["composite"]["sources"]):
+      name, definition = next(iter(source.items()))
+      order = next(iter(definition.values())).get("order", "asc")
+      result.sort(key=lambda b: (b["key"][name] is not None,
+                                 b["key"][name] if b["key"][name] is not None else 0),
+                  reverse=(order == "desc"))
+    return result
+
+
+  def iterate_composite_aggregations_sliced(self, start_date, end_date, search_query = None, aggregation_query = None,
+                                            agg_name = "pid_list", slice_by = None, max_workers = None,
+                                            date_end_inclusive = True):
+    """
+    Time sliced version of iterate_composite_aggregations.
+
+    The date range is split by year or month and each slice is paged through with its own
+    `after` cursor on a bounded pool of workers. The buckets of all the slices are merged into
+    a single response in composite order. Only the buckets of agg_name are merged, so the
+    aggregation body should not rely on other top level aggregations.
+
+    :param start_date:
+    :param end_date:
+    :param search_query:
+    :param aggregation_query:
+    :param agg_name: name of the composite aggregation to page through
+    :param slice_by: "year", "month" or None to choose from the length of the range
+    :param max_workers: maximum concurrent slices, defaults to SLICE_WORKERS
+    :param date_end_inclusive: include events logged at end_date
+    :return: Returns aggregated list of all the results retrieved from the ES
+    """
+    slices = self.getTimeSlices(start_date, end_date, slice_by=slice_by)
+    if len(slices) == 1:
+      return self.iterate_composite_aggregations(start_date, end_date, search_query=search_query,
+                                                 aggregation_query=aggregation_query, agg_name=agg_name,
+                                                 date_end_inclusive=date_end_inclusive)
+    if max_workers is None:
+      max_workers = MetricsElasticSearch.SLICE_WORKERS
+    self._L.debug("Aggregating %d time slices with %d workers", len(slices), max_workers)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      futures = [executor.submit(timing.wrap(self.iterate_composite_aggregations), slice_start, slice_end,
+                                 search_query=search_query, aggregation_query=aggregation_query,
+                                 agg_name=agg_name, date_end_inclusive=end_inclusive and date_end_inclusive)
+                 for slice_start, slice_end, end_inclusive in slices]
+      responses = [future.result() for future in futures]
+
+    aggregations = responses[0]
+    aggregations["hits"]["total"] = sum(response["hits"]["total"] for response in responses)
+    aggregations["aggregations"][agg_name]["buckets"] = MetricsElasticSearch.mergeCompositeBuckets(
+      aggregation_query,
+      [response["aggregations"][agg_name]["buckets"] for response in responses],
+      agg_name=agg_name)
     return aggregations
 
 
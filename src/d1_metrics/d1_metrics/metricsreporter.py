@@ -14,6 +14,7 @@ from xml.etree import ElementTree
 from datetime import datetime
 from datetime import timedelta
 from urllib.parse import quote_plus
+from d1_metrics import telemetry
 from d1_metrics.metricselasticsearch import MetricsElasticSearch
 from collections import Counter
 from dateutil.relativedelta import relativedelta
@@ -21,6 +22,7 @@ import logging
 import gzip
 import shutil
 import asyncio
+import itertools
 from aiohttp import ClientSession
 import concurrent.futures
 from requests.adapters import HTTPAdapter
@@ -32,7 +34,8 @@ DEFAULT_REPORT_CONFIGURATION={
     "report_name" : "Dataset Master Report",
     "release" : "rd1",
     "created_by" : "DataONE",
-    "solr_query_url": "https://cn-secondary.dataone.org/cn/v2/query/solr/"
+    "solr_query_url": "https://cn-secondary.dataone.org/cn/v2/query/solr/",
+    "prometheus_textfile": None,    # Prometheus metrics of the scheduler runs, for the textfile collector
 }
 
 CONCURRENT_REQUESTS = 10  #max number of concurrent requests to run
@@ -200,12 +203,13 @@ class MetricsReporter(object):
                 }
             }
         }
-        data = self.es.iterate_composite_aggregations(search_query=search_body, aggregation_query = aggregation_body,\
+        pages = self.es.iterate_composite_aggregation_pages(search_query=search_body, aggregation_query = aggregation_body,\
                                                                      start_date=datetime.strptime(start_date,'%m/%d/%Y'),\
                                                                      end_date=datetime.strptime(end_date,'%m/%d/%Y'))
 
 
-        for i in data["aggregations"]["pid_list"]["buckets"]:
+        # Buckets are consumed page by page rather than collected for the whole report period
+        for i in itertools.chain.from_iterable(buckets for response, buckets in pages):
             if i["key"]["country"] is None:
                 i["key"]["country"] = "n/a"
             if(i["key"]["format"] == "METADATA"):
@@ -602,6 +606,21 @@ class MetricsReporter(object):
         Probably would be called only once in its lifetime
         :return: None
         """
+        t_start = time.time()
+        succeeded = False
+        try:
+            self._schedule()
+            succeeded = True
+        finally:
+            if self._config["prometheus_textfile"]:
+                telemetry.recordJob("metrics_reporter", t_start, succeeded=succeeded)
+                try:
+                    telemetry.writeTextfile(self._config["prometheus_textfile"])
+                except OSError as e:
+                    self.logger.error("Unable to write the metrics: " + str(e))
+
+
+    def _schedule(self):
         mn_dict = self.get_MN_Dict()
         for node, nodeName in mn_dict.items():
             self.logger.debug("Running job for Node: " + node)
@@ -0,0 +1,492 @@
+'''
+Bulk computation of the sessions of the read events.
+
+The unprocessed events are pulled from the event index in large windows ordered by the
+date logged. The live session of each IP address is kept in memory, and the sessionId
+of every event of a window is written back with bulk partial updates. This replaces the
+per event searches and updates of MetricsElasticSearch.computeSessions, with the same
+session rules:
+
+- events of an IP address belong to the same session while less than SESSION_TTL_MINUTES
+  separate consecutive events
+- events that failed to parse in logstash get the sessionId -1
+- requests of the CN Solr query endpoint are flagged as search events
+- when events of an address were sessionized after an event that arrived late, their
+  sessions are removed so that they are computed again in order
+
+Sessions never span IP addresses, so the events can be split by the hash of their
+address into partitions computed by independent processes with
+computeSessionsParallel().
+
+New sessionIds are reserved in blocks from the session_id_allocator table of the
+metrics database, see getSessionIdAllocator(), so concurrent sessionizers never
+collide and no run needs the largest sessionId of the index, except the very first.
+
+The windows are read with search_after on (dateLogged, _uid), without refreshing the
+index between windows. After each window the sort values of its last event, the
+watermark, and the live sessions are saved in db_metadata. The next run resumes from
+the checkpoint: it neither refreshes the index, nor searches for the first
+unprocessed event, nor checks the addresses of each window for events sessionized
+out of order; it only counts the unprocessed events logged before the watermark.
+When there are such events that arrived late, when there is no usable checkpoint,
+or when asked to rescan, the run starts over from the first unprocessed event with
+these checks.
+'''
+import datetime
+import logging
+import multiprocessing
+
+from dateutil import parser as dateparser
+from dateutil.tz import tzutc
+
+from d1_metrics import metricsdatabase
+from d1_metrics import metricselasticsearch
+from d1_metrics.metricselasticsearch import MetricsElasticSearch
+
+F_SEARCHEVENT = "searchevent"       # Name of the field flagging search events
+SEARCH_REQUEST_PREFIX = "/cn/v2/query/solr/"
+INVALID_SESSION_ID = -1             # sessionId of events that failed to parse
+INVALID_TAGS = ("_jsonparsefailure", "_geoip_lookup_failure")
+WINDOW_SIZE = 10000                 # Events pulled per search, at most index.max_result_window
+CHUNK_SIZE = 2000                   # Updates per bulk request
+BLOCK_SIZE = 100000                 # sessionIds reserved at a time in the metrics database
+
+# Fields of the events needed to compute their session
+SOURCE_FIELDS = [
+  MetricsElasticSearch.F_DATELOGGED,
+  MetricsElasticSearch.F_IPADDR,
+  "tags",
+  "request",
+]
+
+
+def isInvalidEvent(source):
+  '''
+  True if the event failed to parse in logstash. This is uncommon.
+  '''
+  tags = source.get("tags") or []
+  for tag in INVALID_TAGS:
+    if tag in tags:
+      return True
+  return False
+
+
+def isSearchEvent(source):
+  request = source.get("request") or ""
+  return request.startswith(SEARCH_REQUEST_PREFIX)
+
+
+class SessionIdBlocks(object):
+  '''
+  Iterator over sessionIds reserved in blocks, so that several processes can assign
+  sessionIds without colliding.
+  '''
+
+  def __init__(self, reserve, block_size=BLOCK_SIZE, reserved=None):
+    '''
+    Args:
+      reserve: callable returning the first of count consecutive sessionIds reserved for the caller
+      block_size: number of sessionIds reserved at a time
+      reserved: (next, end) sessionIds left from a previous block, as returned by remaining()
+    '''
+    self._reserve = reserve
+    self._block_size = block_size
+    self._next = 0
+    self._end = 0
+    if reserved is not None:
+      self._next, self._end = reserved
+
+
+  def remaining(self):
+    '''
+    The sessionIds left in the current block, to be used by a later run
+
+    Returns:
+      (next, end)
+    '''
+    return self._next, self._end
+
+
+  def __iter__(self):
+    return self
+
+
+  def __next__(self):
+    if self._next >= self._end:
+      self._next = self._reserve(self._block_size)
+      self._end = self._next + self._block_size
+    session_id = self._next
+    self._next += 1
+    return session_id
+
+
+def getSessionIdAllocator(config_file, elastic, index_name=None, block_size=BLOCK_SIZE, reserved=None):
+  '''
+  sessionIds reserved in blocks in the metrics database. The allocator of an index
+  starts after the largest sessionId of the index.
+
+  Args:
+    config_file: configuration file of the metrics database
+    elastic: connected MetricsElasticSearch
+    index_name: name of the event index, the configured index if None
+    block_size: number of sessionIds reserved at a time
+    reserved: (next, end) sessionIds left from a previous block of the index
+
+  Returns:
+    SessionIdBlocks
+  '''
+  if index_name is None:
+    index_name = elastic.indexname
+  database = metricsdatabase.MetricsDatabase(config_file)
+
+  def firstSessionId():
+    return next(elastic.getNextSessionId(index_name)) + 1
+
+  def reserve(count):
+    return database.reserveSessionIds(index_name, count, first_session_id=firstSessionId)
+
+  return SessionIdBlocks(reserve, block_size=block_size, reserved=reserved)
+
+
+class SessionTable(object):
+  '''
+  Live sessions by IP address.
+  '''
+
+  def __init__(self, session_ids, ttl_minutes=MetricsElasticSearch.SESSION_TTL_MINUTES):
+    '''
+    Args:
+      session_ids: iterator of the sessionIds to assign to new sessions
+      ttl_minutes: longest gap between two events of a session
+    '''
+    self._session_ids = session_ids
+    self._ttl = datetime.timedelta(minutes=ttl_minutes)
+    # ip -> [datetime of the last event, sessionId]
+    self.sessions = {}
+
+
+  def seed(self, client_ip, time_stamp, session_id):
+    '''
+    Add an event that already has a session. The most recent event of an address wins.
+    '''
+    session = self.sessions.get(client_ip)
+    if session is None or session[0] < time_stamp:
+      self.sessions[client_ip] = [time_stamp, session_id]
+
+
+  def assign(self, client_ip, time_stamp):
+    '''
+    sessionId of an event, continuing the live session of the address or starting a new one.
+    Events must be assigned in order of their date logged.
+
+    Args:
+      client_ip: IP address of the event
+      time_stamp: datetime the event was logged
+
+    Returns:
+      sessionId
+    '''
+    session = self.sessions.get(client_ip)
+    if session is None:
+      session = self.sessions[client_ip] = [time_stamp, next(self._session_ids)]
+    elif time_stamp - session[0] > self._ttl:
+      session[1] = next(self._session_ids)
+    session[0] = time_stamp
+    return session[1]
+
+
+  def expire(self, time_stamp):
+    '''
+    Drop the sessions that no event logged after time_stamp can continue.
+    '''
+    oldest = time_stamp - self._ttl
+    expired = [client_ip for client_ip, session in self.sessions.items() if session[0] < oldest]
+    for client_ip in expired:
+      del self.sessions[client_ip]
+    return len(expired)
+
+
+class Sessionizer(object):
+  '''
+  Computes the sessions of the unprocessed events of an index.
+  '''
+
+  def __init__(self, elastic, index_name=None, window_size=WINDOW_SIZE, chunk_size=CHUNK_SIZE,
+               partition=None, session_ids=None, database=None, rescan=False):
+    '''
+    Args:
+      elastic: connected MetricsElasticSearch
+      index_name: name of the event index, the configured index if None
+      window_size: number of events pulled per search
+      chunk_size: number of updates per bulk request
+      partition: (worker, workers), compute only the sessions of a partition of the IP addresses
+      session_ids: iterator of the sessionIds for new sessions, e.g. from getSessionIdAllocator().
+        Counts from the largest sessionId of the index if None, for a single sessionizer.
+      database: MetricsDatabase keeping the checkpoint of the sessionizer, no checkpoint if None
+      rescan: ignore the checkpoint and start over from the first unprocessed event
+    '''
+    self._L = logging.getLogger(self.__class__.__name__)
+    if partition is not None:
+      self._L = logging.getLogger("{0}[{1}/{2}]".format(self.__class__.__name__, *partition))
+    self._elastic = elastic
+    self._index_name = index_name
+    if self._index_name is None:
+      self._index_name = elastic.indexname
+    self._window_size = window_size
+    self._chunk_size = chunk_size
+    self._partition = partition
+    self._session_ids = session_ids
+    self._database = database
+    self._rescan = rescan
+    # dateLogged of the first and last events processed by the last run, None if there were none
+    self.first_processed = None
+    self.last_processed = None
+
+
+  def getCheckpointKey(self):
+    '''
+    db_metadata key of the checkpoint, one per index and partition
+    '''
+    key = "{0}:{1}".format(metricsdatabase.METADATA_SESSION_CHECKPOINT, self._index_name)
+    if self._partition is not None:
+      key += ":{0}/{1}".format(*self._partition)
+    return key
+
+
+  def loadCheckpoint(self, table):
+    '''
+    Restore the live sessions of the previous run.
+
+    Args:
+      table: SessionTable
+
+    Returns:
+      search_after values to resume from, None to start from the first unprocessed event
+    '''
+    if self._database is None:
+      return None
+    if self._rescan:
+      self._L.info("Rescan, starting at the first unprocessed event")
+      return None
+    checkpoint = self._database.getMetadataValue(self.getCheckpointKey())
+    if checkpoint is None:
+      self._L.info("No checkpoint, starting at the first unprocessed event")
+      return None
+    try:
+      search_after = checkpoint["search_after"]
+      sessions = checkpoint["sessions"]
+      watermark = datetime.datetime.fromtimestamp(search_after[0] / 1000, tz=tzutc())
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+      self._L.warning("Invalid checkpoint %s, starting at the first unprocessed event", e)
+      return None
+    if len(search_after) != 2 or not isinstance(sessions, dict):
+      self._L.warning("Invalid checkpoint, starting at the first unprocessed event")
+      return None
+    # Events that arrived late, logged before the watermark
+    late_count = self._elastic.countUnprocessedEvents(self._index_name, partition=self._partition,
+                                                      date_end=watermark)
+    if late_count > 0:
+      self._L.warning("%d unprocessed events before the watermark %s, starting at the first unprocessed event",
+                      late_count, watermark.isoformat())
+      return None
+    table.sessions = sessions
+    self._L.info("Resuming after the watermark %s with %d live sessions", watermark.isoformat(), len(table.sessions))
+    return search_after
+
+
+  def saveCheckpoint(self, table, search_after):
+    '''
+    Record the sort values of the last event processed and the live sessions.
+    '''
+    if self._database is None:
+      return
+    checkpoint = {
+      "search_after": search_after,
+      "sessions": table.sessions,
+    }
+    self._database.setMetadataValue(self.getCheckpointKey(), checkpoint)
+
+
+  def loadLiveSessions(self, table, mark):
+    '''
+    Seed a session table with the sessions of the events logged less than the session
+    duration before mark.
+    '''
+    date_start = mark - datetime.timedelta(minutes=MetricsElasticSearch.SESSION_TTL_MINUTES)
+    counter = 0
+    for source in self._elastic.getSessionizedEvents(self._index_name, date_start, mark,
+                                                     partition=self._partition):
+      table.seed(source.get(MetricsElasticSearch.F_IPADDR),
+                 dateparser.parse(source.get(MetricsElasticSearch.F_DATELOGGED)),
+                 source.get(MetricsElasticSearch.F_SESSIONID))
+      counter += 1
+    self._L.info("Loaded %d live sessions from %d events", len(table.sessions), counter)
+
+
+  def processWindow(self, table, hits, check_stale=True):
+    '''
+    Compute the session fields of a window of events ordered by date logged.
+
+    When an event arrived after later events of its address were sessionized, the
+    sessions of those events are removed and the window stops at that event, so that
+    the events removed, all logged after it, are read again by the next window.
+
+    Args:
+      table: SessionTable
+      hits: the events, as search hits
+      check_stale: look for events of the addresses of the window sessionized after it,
+        not needed after the watermark of a checkpoint
+
+    Returns:
+      list of (_id, fields to update) of the first events of the window, in order
+    '''
+    if len(hits) == 0:
+      return []
+    last_entry_dates = {}
+    if check_stale:
+      client_ips = set()
+      for record in hits:
+        if not isInvalidEvent(record["_source"]):
+          client_ips.add(record["_source"].get(MetricsElasticSearch.F_IPADDR))
+      since = dateparser.parse(hits[0]["_source"].get(MetricsElasticSearch.F_DATELOGGED))
+      # Addresses with events sessionized after the start of the window, i.e. events arrived late
+      last_entry_dates = self._elastic.getLastProcessedEventDatetimeByIps(self._index_name,
+                                                                          list(client_ips),
+                                                                          since)
+    updates = []
+    for record in hits:
+      source = record["_source"]
+      if isInvalidEvent(source):
+        updates.append((record["_id"], {MetricsElasticSearch.F_SESSIONID: INVALID_SESSION_ID}))
+        continue
+      time_stamp = dateparser.parse(source.get(MetricsElasticSearch.F_DATELOGGED))
+      client_ip = source.get(MetricsElasticSearch.F_IPADDR)
+      last_entry_date = last_entry_dates.get(client_ip)
+      stale = last_entry_date is not None and last_entry_date > time_stamp
+      if stale:
+        self._L.warning("Found events after %s for %s", time_stamp.isoformat(), client_ip)
+        self._elastic.removeStaleSessionIds(self._index_name, client_ip, time_stamp)
+      fields = {MetricsElasticSearch.F_SESSIONID: table.assign(client_ip, time_stamp)}
+      if isSearchEvent(source):
+        fields[F_SEARCHEVENT] = True
+      updates.append((record["_id"], fields))
+      if stale:
+        break
+    return updates
+
+
+  def computeSessions(self, dry_run=False):
+    '''
+    Updates event records with a session id.
+
+    Args:
+      dry_run: If True, then just show work to be done
+
+    Returns:
+      number of events updated
+    '''
+    #Quiet down the elastic search logger a bit
+    es_logger = logging.getLogger('elasticsearch')
+    es_logger.propagate = False
+    es_logger.setLevel(logging.WARNING)
+
+    self.first_processed = None
+    self.last_processed = None
+    unprocessed_count = self._elastic.countUnprocessedEvents(self._index_name, partition=self._partition)
+    self._L.info("Unprocessed events = %d", unprocessed_count)
+    if dry_run:
+      return 0
+
+    session_ids = self._session_ids
+    if session_ids is None:
+      session_ids = self._elastic.getNextSessionId(self._index_name)
+    table = SessionTable(session_ids)
+    search_after = self.loadCheckpoint(table)
+    # Without a checkpoint, start over from the first unprocessed event
+    check_stale = search_after is None
+    if search_after is None:
+      self._elastic.refresh(self._index_name)
+      mark = self._elastic.getFirstUnprocessedEventDatetime(self._index_name, partition=self._partition)
+      if mark is None:
+        self._L.info("Completed computeSessions.")
+        return 0
+      self._L.info("At mark: %s", mark.isoformat())
+      self.loadLiveSessions(table, mark)
+    processed = 0
+    while True:
+      new_events = self._elastic.getNewEvents(self._index_name,
+                                              self._window_size,
+                                              source_fields=SOURCE_FIELDS,
+                                              partition=self._partition,
+                                              search_after=search_after)
+      if new_events is None:
+        raise ValueError("Unable to retrieve the unprocessed events")
+      hits = new_events["hits"]["hits"]
+      if len(hits) == 0:
+        break
+      updates = self.processWindow(table, hits, check_stale=check_stale)
+      # The next window starts after the last event processed
+      hits = hits[:len(updates)]
+      self._elastic.bulkUpdateRecords(self._index_name, updates, chunk_size=self._chunk_size)
+      processed += len(hits)
+      search_after = hits[-1]["sort"]
+      if self.first_processed is None:
+        self.first_processed = dateparser.parse(hits[0]["_source"].get(MetricsElasticSearch.F_DATELOGGED))
+      self.last_processed = dateparser.parse(hits[-1]["_source"].get(MetricsElasticSearch.F_DATELOGGED))
+      table.expire(self.last_processed)
+      self.saveCheckpoint(table, search_after)
+      self._L.info("Processed %d / %d events, %d live sessions",
+                   processed, unprocessed_count, len(table.sessions))
+    self._L.info("Completed computeSessions.")
+    return processed
+
+
+def _initPartitionProcess():
+  # The clients of the parent are not usable after fork
+  metricselasticsearch.clearPooledClients()
+
+
+def _computePartitionSessions(config_file, index_name, worker, workers, rescan):
+  elastic = MetricsElasticSearch(config_file)
+  elastic.connect()
+  session_ids = getSessionIdAllocator(config_file, elastic, index_name)
+  database = metricsdatabase.MetricsDatabase(config_file)
+  sessionizer = Sessionizer(elastic, index_name=index_name, partition=(worker, workers), session_ids=session_ids,
+                            database=database, rescan=rescan)
+  processed = sessionizer.computeSessions()
+  return processed, sessionizer.first_processed, sessionizer.last_processed
+
+
+def computeSessionsParallel(config_file, workers, index_name=None, dry_run=False, rescan=False):
+  '''
+  Compute the sessions with one process per partition of the IP addresses.
+
+  Args:
+    config_file: configuration file of the Elastic Search and metrics database connections
+    workers: number of processes
+    index_name: name of the event index, the configured index if None
+    dry_run: If True, then just show work to be done
+    rescan: ignore the checkpoints and start over from the first unprocessed event
+
+  Returns:
+    (number of events updated, dateLogged of the first and of the last event processed, None if none)
+  '''
+  _L = logging.getLogger("computeSessionsParallel")
+  elastic = MetricsElasticSearch(config_file)
+  elastic.connect()
+  if index_name is None:
+    index_name = elastic.indexname
+  unprocessed_count = elastic.countUnprocessedEvents(index_name)
+  _L.info("Unprocessed events = %d in %d partitions", unprocessed_count, workers)
+  if dry_run:
+    return 0, None, None
+  tasks = [(config_file, index_name, worker, workers, rescan) for worker in range(workers)]
+  with multiprocessing.Pool(workers, initializer=_initPartitionProcess) as pool:
+    results = pool.starmap(_computePartitionSessions, tasks, chunksize=1)
+  processed = sum(result[0] for result in results)
+  first_processed = [result[1] for result in results if result[1] is not None]
+  last_processed = [result[2] for result in results if result[2] is not None]
+  _L.info("Completed computeSessions, %d events in %d partitions", processed, workers)
+  if processed == 0:
+    return 0, None, None
+  return processed, min(first_processed), max(last_processed)
@@ -0,0 +1,301 @@
+'''
+Counters, gauges and histograms in the Prometheus text exposition format.
+
+The metrics of a process are kept in REGISTRY. The service serves them on /_prometheus,
+the batch tools write them to a file for the textfile collector of the node exporter
+with writeTextfile() at the end of a run.
+
+The metrics are per process: each worker of the service exposes its own values.
+'''
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Histogram buckets of counts of calls or pages
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _formatValue(value):
+  if value == math.inf:
+    return "+Inf"
+  if value == -math.inf:
+    return "-Inf"
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return repr(value)
+
+
+def _escapeLabelValue(value):
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatLabels(names, values, extra=None):
+  pairs = list(zip(names, values))
+  if extra is not None:
+    pairs.append(extra)
+  if len(pairs) == 0:
+    return ""
+  return "{" + ",".join('{0}="{1}"'.format(name, _escapeLabelValue(value)) for name, value in pairs) + "}"
+
+
+class _Metric(object):
+
+  TYPE = None
+
+  def __init__(self, name, documentation, labelnames=()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self._lock = threading.Lock()
+    self._values = OrderedDict()
+
+
+  def _key(self, labels):
+    if set(labels) != set(self.labelnames):
+      raise ValueError("Expected labels {0} for {1}, got {2}".format(self.labelnames, self.name, sorted(labels)))
+    return tuple(str(labels[name]) for name in self.labelnames)
+
+
+  def render(self):
+    lines = [
+      "# HELP {0} {1}".format(self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n")),
+      "# TYPE {0} {1}".format(self.name, self.TYPE),
+    ]
+    with self._lock:
+      items = [(key, self._copy(value)) for key, value in self._values.items()]
+    for key, value in items:
+      lines.extend(self._renderValue(key, value))
+    return lines
+
+
+  def _copy(self, value):
+    return value
+
+
+class Counter(_Metric):
+  '''
+  Monotonically increasing value.
+  '''
+
+  TYPE = "counter"
+
+  def inc(self, amount=1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+
+  def _renderValue(self, key, value):
+    return ["{0}{1} {2}".format(self.name, _formatLabels(self.labelnames, key), _formatValue(value))]
+
+
+class Gauge(_Metric):
+  '''
+  Value that goes up and down.
+  '''
+
+  TYPE = "gauge"
+
+  def set(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = value
+
+
+  def _renderValue(self, key, value):
+    return ["{0}{1} {2}".format(self.name, _formatLabels(self.labelnames, key), _formatValue(value))]
+
+
+class Histogram(_Metric):
+  '''
+  Distribution of observed values in cumulative buckets.
+  '''
+
+  TYPE = "histogram"
+
+  def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, documentation, labelnames=labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      state = self._values.get(key)
+      if state is None:
+        state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+      position = len(self.buckets)
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          position = i
+          break
+      state[0][position] += 1
+      state[1] += value
+
+
+  def time(self, **labels):
+    '''
+    Context manager observing the duration of a with block, in seconds.
+    '''
+    return _Timer(self, labels)
+
+
+  def _copy(self, value):
+    return [list(value[0]), value[1]]
+
+
+  def _renderValue(self, key, value):
+    counts, total = value
+    lines = []
+    cumulative = 0
+    for bound, count in zip(self.buckets + (math.inf,), counts):
+      cumulative += count
+      lines.append("{0}_bucket{1} {2}".format(
+        self.name, _formatLabels(self.labelnames, key, extra=("le", _formatValue(float(bound)))), cumulative))
+    labels = _formatLabels(self.labelnames, key)
+    lines.append("{0}_sum{1} {2}".format(self.name, labels, _formatValue(total)))
+    lines.append("{0}_count{1} {2}".format(self.name, labels, cumulative))
+    return lines
+
+
+class _Timer(object):
+
+  def __init__(self, histogram, labels):
+    self._histogram = histogram
+    self._labels = labels
+
+
+  def __enter__(self):
+    self._t_0 = time.time()
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._histogram.observe(time.time() - self._t_0, **self._labels)
+
+
+class Registry(object):
+  '''
+  The metrics of a process.
+  '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._metrics = OrderedDict()
+
+
+  def register(self, metric):
+    with self._lock:
+      if metric.name in self._metrics:
+        raise ValueError("Duplicate metric " + metric.name)
+      self._metrics[metric.name] = metric
+    return metric
+
+
+  def render(self):
+    '''
+    Returns:
+      the metrics in the text exposition format
+    '''
+    with self._lock:
+      metrics = list(self._metrics.values())
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Content type of the text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Labels of the request metrics. Other filter types are reported as "other".
+FILTER_TYPES = ("dataset", "catalog", "package", "repository", "user", "group", "portal", "batch", "citations")
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+  "d1_metrics_request_duration_seconds", "Duration of the service requests by filterType",
+  labelnames=("filter_type", )))
+REQUEST_COMPOSITE_PAGES = REGISTRY.register(Histogram(
+  "d1_metrics_request_es_pages", "ES aggregation pages fetched per service request",
+  labelnames=("filter_type", ), buckets=(0, ) + COUNT_BUCKETS))
+ES_QUERY_SECONDS = REGISTRY.register(Histogram(
+  "d1_metrics_es_query_duration_seconds", "Duration of the Elastic Search queries, the count is the number of queries",
+  labelnames=("operation", )))
+SOLR_CALLS_PER_RESOLVE = REGISTRY.register(Histogram(
+  "d1_metrics_solr_calls_per_resolve", "Solr requests made by a call of getResolvePIDs", buckets=COUNT_BUCKETS))
+PG_POOL_WAIT_SECONDS = REGISTRY.register(Histogram(
+  "d1_metrics_pg_pool_wait_seconds", "Wait for a pooled Postgres connection",
+  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+  "d1_metrics_cache_requests_total", "Lookups of the caches by result, hit or miss",
+  labelnames=("cache", "result")))
+JOB_DURATION_SECONDS = REGISTRY.register(Gauge(
+  "d1_metrics_job_duration_seconds", "Duration of the last run of a batch job", labelnames=("job", )))
+JOB_LAST_SUCCESS = REGISTRY.register(Gauge(
+  "d1_metrics_job_last_success_timestamp_seconds", "Time of the last successful run of a batch job",
+  labelnames=("job", )))
+
+
+def getFilterTypeLabel(filter_type):
+  '''
+  Bounded label value of a filterType
+  '''
+  if filter_type is None:
+    return "other"
+  filter_type = str(filter_type).lower()
+  if filter_type in FILTER_TYPES:
+    return filter_type
+  return "other"
+
+
+def recordCache(cache, hits=0, misses=0):
+  '''
+  Count lookups of a cache
+
+  Args:
+    cache: name of the cache
+    hits: number of lookups that were answered from the cache
+    misses: number of lookups that were not
+  '''
+  if hits > 0:
+    CACHE_REQUESTS.inc(hits, cache=cache, result="hit")
+  if misses > 0:
+    CACHE_REQUESTS.inc(misses, cache=cache, result="miss")
+
+
+def recordJob(job, t_start, succeeded=True):
+  '''
+  Record the duration of a batch job run started at t_start, and its completion time if it succeeded.
+  '''
+  now = time.time()
+  JOB_DURATION_SECONDS.set(now - t_start, job=job)
+  if succeeded:
+    JOB_LAST_SUCCESS.set(now, job=job)
+
+
+def writeTextfile(path, registry=REGISTRY):
+  '''
+  Write the metrics to a file for the textfile collector. The file is replaced atomically,
+  so the collector never reads a partial file.
+
+  Args:
+    path: destination, should end with .prom
+    registry: the metrics to write
+  '''
+  directory = os.path.dirname(os.path.abspath(path))
+  handle, temporary_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".prom.tmp")
+  try:
+    with os.fdopen(handle, "w") as destination:
+      destination.write(registry.render())
+    os.chmod(temporary_path, 0o644)
+    os.replace(temporary_path, path)
+  except Exception:
+    os.unlink(temporary_path)
+    raise
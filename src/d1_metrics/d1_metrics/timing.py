@@ -0,0 +1,309 @@
+'''
+Lightweight timing of the stages of a request.
+
+A SpanRecorder is bound to the thread handling a request with recording(), or bind()
+and restore() when the request is not handled within a single block. The code
+on the request path marks its stages with span() or the timed() decorator, which cost
+a thread local lookup when no recorder is bound. Work handed to other threads is
+recorded in the recorder of the request when the callable is wrapped with wrap().
+
+A span nested in a span of the same name is not recorded, so that functions calling
+each other do not count the same time twice.
+
+StageHistograms accumulates the spans of many requests in rolling histograms.
+'''
+import contextlib
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+# Stages recorded on the request path
+STAGE_RESOLVE = "resolve"         # identifier resolution through Solr and the identifiers index
+STAGE_ES = "es"                   # an Elastic Search aggregation request, one per page
+STAGE_CITATIONS = "citations"     # citation lookup in Postgres
+STAGE_FORMAT = "format"           # formatting of the aggregation buckets into the response
+STAGE_TOTAL = "total"             # the whole request
+
+STAGE_DESCRIPTIONS = {
+  STAGE_RESOLVE: "PID resolution",
+  STAGE_ES: "ES aggregation",
+  STAGE_CITATIONS: "Citation lookup",
+  STAGE_FORMAT: "Formatting",
+  STAGE_TOTAL: "Total",
+}
+
+# Upper bounds, in milliseconds, of the histogram buckets. The last bucket is unbounded.
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000)
+
+_local = threading.local()
+
+
+class SpanRecorder(object):
+  '''
+  The spans of a request. Spans may be added from several threads.
+  '''
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._spans = []
+    self._t_start = time.time()
+
+
+  def add(self, name, seconds):
+    with self._lock:
+      self._spans.append((name, seconds))
+
+
+  def elapsed(self):
+    return time.time() - self._t_start
+
+
+  def spans(self):
+    '''
+    Returns:
+      list of (stage name, seconds)
+    '''
+    with self._lock:
+      return list(self._spans)
+
+
+  def totals(self):
+    '''
+    Returns:
+      OrderedDict of stage name to (seconds, count), in order of first occurrence
+    '''
+    totals = OrderedDict()
+    for name, seconds in self.spans():
+      total, count = totals.get(name, (0.0, 0))
+      totals[name] = (total + seconds, count + 1)
+    return totals
+
+
+  def serverTiming(self):
+    '''
+    Value of the Server-Timing header for the spans, one metric per stage with the
+    total duration of its spans and the number of spans in the description.
+
+    Returns:
+      string
+    '''
+    metrics = []
+    for name, (seconds, count) in self.totals().items():
+      description = STAGE_DESCRIPTIONS.get(name, name)
+      if count > 1:
+        description = "{0} x{1}".format(description, count)
+      metrics.append('{0};dur={1:.1f};desc="{2}"'.format(name, seconds * 1000, description))
+    metrics.append('{0};dur={1:.1f};desc="{2}"'.format(STAGE_TOTAL, self.elapsed() * 1000,
+                                                         STAGE_DESCRIPTIONS[STAGE_TOTAL]))
+    return ", ".join(metrics)
+
+
+def getRecorder():
+  '''
+  Returns:
+    the SpanRecorder bound to the current thread or None
+  '''
+  return getattr(_local, "recorder", None)
+
+
+def bind(recorder):
+  '''
+  Bind a recorder to the current thread, until restore() is called with the returned token.
+
+  Returns:
+    token of the previous binding
+  '''
+  token = (getRecorder(), getattr(_local, "active", None))
+  _local.recorder = recorder
+  _local.active = set()
+  return token
+
+
+def restore(token):
+  _local.recorder, _local.active = token
+
+
+@contextlib.contextmanager
+def recording(recorder=None):
+  '''
+  Bind a recorder to the current thread for the duration of a with block.
+
+  Args:
+    recorder: SpanRecorder, a new one if None
+
+  Yields:
+    the recorder
+  '''
+  if recorder is None:
+    recorder = SpanRecorder()
+  token = bind(recorder)
+  try:
+    yield recorder
+  finally:
+    restore(token)
+
+
+@contextlib.contextmanager
+def span(name):
+  '''
+  Record the duration of a with block as a span of the bound recorder.
+
+  Args:
+    name: stage name
+  '''
+  recorder = getRecorder()
+  if recorder is None or name in _local.active:
+    yield
+    return
+  _local.active.add(name)
+  t_0 = time.time()
+  try:
+    yield
+  finally:
+    recorder.add(name, time.time() - t_0)
+    _local.active.discard(name)
+
+
+def timed(name):
+  '''
+  Decorator recording the calls of a function as spans.
+
+  Args:
+    name: stage name
+  '''
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def wrap(function):
+  '''
+  Bind the recorder of the current thread to function, for calling it in another thread.
+
+  Returns:
+    callable
+  '''
+  recorder = getRecorder()
+  if recorder is None:
+    return function
+
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    with recording(recorder):
+      return function(*args, **kwargs)
+  return wrapper
+
+
+class StageHistograms(object):
+  '''
+  Rolling histograms of the stage durations over the last window_seconds, kept in
+  slots of slot_seconds.
+  '''
+
+  def __init__(self, window_seconds=900, slot_seconds=60):
+    self._slot_seconds = slot_seconds
+    self._num_slots = max(1, window_seconds // slot_seconds)
+    self._lock = threading.Lock()
+    # slot number -> stage name -> [bucket counts, sum of seconds, max seconds]
+    self._slots = OrderedDict()
+
+
+  def _bucket(self, seconds):
+    milliseconds = seconds * 1000
+    for position, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+      if milliseconds <= bound:
+        return position
+    return len(HISTOGRAM_BOUNDS_MS)
+
+
+  def _currentSlot(self, now):
+    slot_number = int(now // self._slot_seconds)
+    slot = self._slots.get(slot_number)
+    if slot is None:
+      slot = self._slots[slot_number] = {}
+      while len(self._slots) > self._num_slots:
+        self._slots.popitem(last=False)
+    return slot
+
+
+  def observe(self, name, seconds, now=None):
+    if now is None:
+      now = time.time()
+    bucket = self._bucket(seconds)
+    with self._lock:
+      slot = self._currentSlot(now)
+      stage = slot.get(name)
+      if stage is None:
+        stage = slot[name] = [[0] * (len(HISTOGRAM_BOUNDS_MS) + 1), 0.0, 0.0]
+      stage[0][bucket] += 1
+      stage[1] += seconds
+      stage[2] = max(stage[2], seconds)
+
+
+  def observeRecorder(self, recorder):
+    '''
+    Add each span of a request, e.g. every ES page, and the total duration of the request.
+    '''
+    now = time.time()
+    for name, seconds in recorder.spans():
+      self.observe(name, seconds, now=now)
+    self.observe(STAGE_TOTAL, recorder.elapsed(), now=now)
+
+
+  def stats(self, now=None):
+    '''
+    Returns:
+      dictionary of stage name to count, sum, max and approximate percentiles in seconds,
+      and the bucket counts keyed by their upper bound in milliseconds
+    '''
+    if now is None:
+      now = time.time()
+    oldest = int(now // self._slot_seconds) - self._num_slots + 1
+    merged = {}
+    with self._lock:
+      for slot_number, slot in self._slots.items():
+        if slot_number < oldest:
+          continue
+        for name, (counts, total, maximum) in slot.items():
+          stage = merged.get(name)
+          if stage is None:
+            stage = merged[name] = [[0] * len(counts), 0.0, 0.0]
+          stage[0] = [a + b for a, b in zip(stage[0], counts)]
+          stage[1] += total
+          stage[2] = max(stage[2], maximum)
+
+    stats = {}
+    for name, (counts, total, maximum) in merged.items():
+      count = sum(counts)
+      stage = {
+        "count": count,
+        "sum_seconds": total,
+        "max_seconds": maximum,
+        "buckets_ms": OrderedDict(
+          (str(bound), counts[position]) for position, bound in enumerate(HISTOGRAM_BOUNDS_MS)),
+      }
+      stage["buckets_ms"]["+Inf"] = counts[-1]
+      for percentile in (50, 90, 99):
+        stage["p{0}_seconds".format(percentile)] = self._percentile(counts, count, percentile, maximum)
+      stats[name] = stage
+    return stats
+
+
+  def _percentile(self, counts, count, percentile, maximum):
+    # Upper bound of the bucket holding the percentile, the maximum for the last bucket
+    if count == 0:
+      return None
+    rank = count * percentile / 100.0
+    cumulative = 0
+    for position, bucket_count in enumerate(counts):
+      cumulative += bucket_count
+      if cumulative >= rank:
+        if position < len(HISTOGRAM_BOUNDS_MS):
+          return min(HISTOGRAM_BOUNDS_MS[position] / 1000.0, maximum)
+        return maximum
+    return maximum
@@ -0,0 +1,170 @@
+'''
+Tests of the bulk sessionizer against an in-memory event index.
+
+Usage:
+
+  python -m pytest tests
+'''
+import datetime
+import itertools
+import pickle
+
+from d1_metrics import sessionizer
+from d1_metrics.metricselasticsearch import MetricsElasticSearch
+
+T0 = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class MemoryIndex(object):
+  '''
+  The methods of MetricsElasticSearch used by the Sessionizer, over a list of events.
+  '''
+
+  def __init__(self, events):
+    self.indexname = "eventlog-test"
+    self.events = events
+
+  def _dateLogged(self, source):
+    return datetime.datetime.fromisoformat(source[MetricsElasticSearch.F_DATELOGGED])
+
+  def _sort(self, event):
+    return [int(self._dateLogged(event["_source"]).timestamp() * 1000), "doc#" + event["_id"]]
+
+  def _unprocessed(self):
+    events = [e for e in self.events if MetricsElasticSearch.F_SESSIONID not in e["_source"]]
+    return sorted(events, key=self._sort)
+
+  def refresh(self, index_name=None):
+    pass
+
+  def countUnprocessedEvents(self, index_name=None, partition=None, date_end=None):
+    events = self._unprocessed()
+    if date_end is not None:
+      events = [e for e in events if self._dateLogged(e["_source"]) <= date_end]
+    return len(events)
+
+  def getFirstUnprocessedEventDatetime(self, index_name=None, partition=None):
+    events = self._unprocessed()
+    if len(events) == 0:
+      return None
+    return self._dateLogged(events[0]["_source"])
+
+  def getNewEvents(self, index_name, limit, source_fields=None, partition=None, search_after=None):
+    events = self._unprocessed()
+    if search_after is not None:
+      events = [e for e in events if self._sort(e) > list(search_after)]
+    return {"hits": {"hits": [{"_id": e["_id"], "_source": dict(e["_source"]), "sort": self._sort(e)}
+                              for e in events[:limit]]}}
+
+  def getSessionizedEvents(self, index_name=None, date_start=None, date_end=None, partition=None):
+    for event in self.events:
+      source = event["_source"]
+      if MetricsElasticSearch.F_SESSIONID in source and date_start <= self._dateLogged(source) < date_end:
+        yield dict(source)
+
+  def getLastProcessedEventDatetimeByIps(self, index_name, client_ips, since):
+    last = {}
+    for event in self.events:
+      source = event["_source"]
+      client_ip = source[MetricsElasticSearch.F_IPADDR]
+      if source.get(MetricsElasticSearch.F_SESSIONID, 0) > 0 and client_ip in client_ips:
+        date_logged = self._dateLogged(source)
+        if date_logged > since:
+          last[client_ip] = max(last.get(client_ip, date_logged), date_logged)
+    return last
+
+  def removeStaleSessionIds(self, index_name=None, client_ip=None, time_stamp=None):
+    for event in self.events:
+      source = event["_source"]
+      if source[MetricsElasticSearch.F_IPADDR] == client_ip and self._dateLogged(source) > time_stamp:
+        source.pop(MetricsElasticSearch.F_SESSIONID, None)
+
+  def bulkUpdateRecords(self, index_name, updates, chunk_size=None):
+    events = {event["_id"]: event for event in self.events}
+    for record_id, fields in updates:
+      events[record_id]["_source"].update(fields)
+    return len(updates)
+
+
+class MemoryDatabase(object):
+
+  def __init__(self):
+    self.values = {}
+
+  def getMetadataValue(self, k, default=None):
+    if k not in self.values:
+      return default
+    return pickle.loads(self.values[k])
+
+  def setMetadataValue(self, k, v):
+    self.values[k] = pickle.dumps(v)
+
+
+def makeEvent(number, client_ip, minutes, session_id=None):
+  source = {
+    MetricsElasticSearch.F_DATELOGGED: (T0 + datetime.timedelta(minutes=minutes)).isoformat(),
+    MetricsElasticSearch.F_IPADDR: client_ip,
+    "tags": [],
+    "request": "",
+  }
+  if session_id is not None:
+    source[MetricsElasticSearch.F_SESSIONID] = session_id
+  return {"_id": "%06d" % number, "_source": source}
+
+
+def assertSessions(events):
+  '''
+  Every event has a session, continued while less than the session duration separates
+  consecutive events of an address.
+  '''
+  by_ip = {}
+  for event in sorted(events, key=lambda e: e["_source"][MetricsElasticSearch.F_DATELOGGED]):
+    source = event["_source"]
+    assert MetricsElasticSearch.F_SESSIONID in source, source
+    by_ip.setdefault(source[MetricsElasticSearch.F_IPADDR], []).append(source)
+  ttl = datetime.timedelta(minutes=MetricsElasticSearch.SESSION_TTL_MINUTES)
+  for sources in by_ip.values():
+    for before, after in zip(sources, sources[1:]):
+      gap = (datetime.datetime.fromisoformat(after[MetricsElasticSearch.F_DATELOGGED]) -
+             datetime.datetime.fromisoformat(before[MetricsElasticSearch.F_DATELOGGED]))
+      same_session = before[MetricsElasticSearch.F_SESSIONID] == after[MetricsElasticSearch.F_SESSIONID]
+      assert same_session == (gap <= ttl), (before, after)
+
+
+def test_lateEventBeforeSessionizedEventsOfTheWindow():
+  # 10.0.0.1 was sessionized up to 80 minutes, then an event at 5 minutes arrived
+  events = [
+    makeEvent(1, "10.0.0.1", 20, session_id=1),
+    makeEvent(2, "10.0.0.1", 50, session_id=1),
+    makeEvent(3, "10.0.0.1", 80, session_id=1),
+    makeEvent(4, "10.0.0.1", 5),
+    makeEvent(5, "10.0.0.2", 10),
+    makeEvent(6, "10.0.0.2", 60),
+    makeEvent(7, "10.0.0.2", 200),
+    makeEvent(8, "10.0.0.1", 210),
+  ]
+  index = MemoryIndex(events)
+  computer = sessionizer.Sessionizer(index, window_size=100, session_ids=itertools.count(2),
+                                     database=MemoryDatabase())
+  computer.computeSessions()
+  assertSessions(events)
+  assert index.countUnprocessedEvents() == 0
+  assert computer.first_processed == T0 + datetime.timedelta(minutes=5)
+
+
+def test_lateEventBeforeTheCheckpoint():
+  events = [makeEvent(number, "10.0.0.%d" % (number % 3), number * 10) for number in range(12)]
+  index = MemoryIndex(events)
+  database = MemoryDatabase()
+  session_ids = itertools.count(1)
+  sessionizer.Sessionizer(index, window_size=5, session_ids=session_ids, database=database).computeSessions()
+  assert index.countUnprocessedEvents() == 0
+
+  # Logged before the watermark of the checkpoint, between sessionized events of its address
+  events.append(makeEvent(12, "10.0.0.1", 45))
+  events.append(makeEvent(13, "10.0.0.2", 200))
+  computer = sessionizer.Sessionizer(index, window_size=5, session_ids=session_ids, database=database)
+  computer.computeSessions()
+  assertSessions(events)
+  assert index.countUnprocessedEvents() == 0
+  assert computer.first_processed == T0 + datetime.timedelta(minutes=45)
@@ -0,0 +1,127 @@
+"""
+Microbenchmark of the period formatter against the formatting loops it replaced.
+
+The legacy functions below are copies of the bucket handling of the former
+formatElasticSearchResultsByMonth / ByDay / ByYear methods of MetricsReader.
+
+Usage:
+
+  python period_formatter_benchmark.py [-n BUCKETS] [-r REPEAT]
+"""
+import argparse
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from d1_metrics_service import periodformatter
+
+PERIOD_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+
+def legacyFormat(buckets, start_dt, end_dt, key_name, by_country):
+    period_format = PERIOD_FORMATS[key_name]
+    results = {"periods": [], "downloads": [], "views": [], "country": []}
+    totalDownloads, totalViews = 0, 0
+    if by_country:
+        records = {}
+        for i in buckets:
+            period = datetime.utcfromtimestamp((i["key"][key_name] // 1000)).strftime((period_format))
+            if (i["key"]["country"] is None) or (i["key"]["country"] == "null"):
+                i["key"]["country"] = "US"
+            if period not in records:
+                records[period] = {}
+            if i["key"]["country"] not in records[period]:
+                records[period][i["key"]["country"]] = {}
+            if i["key"]["format"] == "DATA":
+                totalDownloads += i["unique_doc_count"]["value"]
+                records[period][i["key"]["country"]]["downloads"] = i["unique_doc_count"]["value"]
+            if i["key"]["format"] == "METADATA":
+                totalViews += i["unique_doc_count"]["value"]
+                records[period][i["key"]["country"]]["views"] = i["unique_doc_count"]["value"]
+        for period in records:
+            for country in records[period]:
+                results["periods"].append(period)
+                results["country"].append(country)
+                results["downloads"].append(records[period][country].get("downloads", 0))
+                results["views"].append(records[period][country].get("views", 0))
+        return results, totalDownloads, totalViews
+
+    results["periods"] = list(OrderedDict(
+        ((start_dt + timedelta(_)).strftime(period_format), None) for _ in range((end_dt - start_dt).days)).keys())
+    results["downloads"] = [0] * len(results["periods"])
+    results["views"] = [0] * len(results["periods"])
+    for i in buckets:
+        period = datetime.utcfromtimestamp((i["key"][key_name] // 1000)).strftime((period_format))
+        period_index = results["periods"].index(period)
+        if i["key"]["format"] == "DATA":
+            totalDownloads += i["unique_doc_count"]["value"]
+            results["downloads"][period_index] += i["unique_doc_count"]["value"]
+        elif i["key"]["format"] == "METADATA":
+            totalViews += i["unique_doc_count"]["value"]
+            results["views"][period_index] += i["unique_doc_count"]["value"]
+    return results, totalDownloads, totalViews
+
+
+def makeBuckets(count, start_dt, end_dt, key_name):
+    period = periodformatter.PERIODS[key_name]
+    index = periodformatter.PeriodIndex(period, start_dt, end_dt)
+    countries = ["US", "CA", "DE", "FR", "GB", "JP", "BR", "AU", "IN", None]
+    buckets = []
+    for position in range(count):
+        ordinal = index.first + random.randrange(len(index))
+        start = max(period.start(ordinal), start_dt)
+        buckets.append({
+            "key": {
+                key_name: int((start - periodformatter.EPOCH).total_seconds()) * 1000,
+                "format": random.choice(["DATA", "METADATA"]),
+                "country": random.choice(countries),
+            },
+            "doc_count": 1,
+            "unique_doc_count": {"value": random.randint(1, 100)},
+        })
+    return buckets
+
+
+def timeIt(function, repeat):
+    best = None
+    for i in range(repeat):
+        t_0 = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - t_0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--buckets", type=int, default=100000, help="Number of buckets")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Best of repeat runs")
+    args = parser.parse_args()
+
+    random.seed(1)
+    start_dt = datetime(2010, 1, 1)
+    end_dt = datetime(2020, 1, 1)
+    print("{0:>6}{1:>9}{2:>12}{3:>12}{4:>10}".format("period", "country", "legacy (s)", "engine (s)", "speedup"))
+    for key_name in ("day", "month", "year"):
+        period = periodformatter.PERIODS[key_name]
+        buckets = makeBuckets(args.buckets, start_dt, end_dt, key_name)
+        for by_country in (False, True):
+            legacy = legacyFormat(buckets, start_dt, end_dt, key_name, by_country)
+            engine = periodformatter.formatBuckets(period, buckets, start_dt, end_dt, {},
+                                                   include_citations=False, by_country=by_country)
+            assert legacy[0]["periods"] == engine[0][period.plural]
+            assert legacy[0]["downloads"] == engine[0]["downloads"]
+            assert legacy[0]["views"] == engine[0]["views"]
+            assert legacy[1:] == engine[1:]
+            t_legacy = timeIt(lambda: legacyFormat(buckets, start_dt, end_dt, key_name, by_country), args.repeat)
+            t_engine = timeIt(lambda: periodformatter.formatBuckets(period, buckets, start_dt, end_dt, {},
+                                                                    include_citations=False,
+                                                                    by_country=by_country), args.repeat)
+            print("{0:>6}{1:>9}{2:>12.4f}{3:>12.4f}{4:>9.1f}x".format(key_name, str(by_country), t_legacy, t_engine,
+                                                                      t_legacy / t_engine))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Admission module
+
+Admission control of the metricsRequests processed by a worker. Requests are classified
+by cost into lanes, each lane with its own concurrency limit and bounded queue, so that
+a few expensive portal or CN wide repository requests can not hold all the threads of a
+worker while landing page requests wait behind them.
+
+A request arriving at a lane with a full queue, or waiting longer than the queue timeout
+of the lane, is rejected right away so that the client can retry later.
+"""
+import logging
+import threading
+import time
+
+LANE_CHEAP = "cheap"
+LANE_STANDARD = "standard"
+LANE_EXPENSIVE = "expensive"
+
+# Threads of a gunicorn worker, gunicorn.conf reads its threads setting from here
+WORKER_THREADS = 8
+
+# Threads of a worker that only cheap requests can hold
+CHEAP_RESERVED_THREADS = 2
+
+
+def getLanes(worker_threads=WORKER_THREADS, reserved_threads=CHEAP_RESERVED_THREADS):
+    """
+    Limits of the lanes of a worker. A lane holds at most max_concurrent + max_queued threads
+    of the worker. The standard and expensive lanes together hold at most worker_threads less
+    reserved_threads, so a cheap request always finds a thread.
+    :param worker_threads: number of threads of the worker
+    :param reserved_threads: threads left to the cheap lane
+    :return: dictionary of lane name to limits
+    """
+    shared_threads = worker_threads - reserved_threads
+    if reserved_threads < 1 or shared_threads < 2:
+        raise ValueError("{0} threads can not be shared by the lanes".format(worker_threads))
+    expensive_threads = max(1, shared_threads // 3)
+    standard_threads = shared_threads - expensive_threads
+    # half of the threads of a lane run, the others wait in its queue
+    return {
+        LANE_CHEAP: {"max_concurrent": worker_threads, "max_queued": 2 * worker_threads,
+                     "queue_timeout": 10, "retry_after": 5},
+        LANE_STANDARD: {"max_concurrent": (standard_threads + 1) // 2, "max_queued": standard_threads // 2,
+                        "queue_timeout": 30, "retry_after": 15},
+        LANE_EXPENSIVE: {"max_concurrent": (expensive_threads + 1) // 2, "max_queued": expensive_threads // 2,
+                         "queue_timeout": 30, "retry_after": 60},
+    }
+
+
+DEFAULT_LANES = getLanes()
+
+# Largest catalog or package request, in identifiers, that is cheap
+CHEAP_MAX_PIDS = 50
+
+# Repositories with enough events that their requests are expensive
+EXPENSIVE_REPOSITORIES = ["urn:node:CN", ]
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+def classifyRequest(metrics_request):
+    """
+    Lane of a metricsRequest, from the type and number of values of its first filter
+    :param metrics_request: metricsRequest dictionary
+    :return: name of the lane
+    """
+    try:
+        filter_object = metrics_request["filterBy"][0]
+        filter_type = filter_object["filterType"].lower()
+        values = filter_object["values"]
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return LANE_CHEAP
+    if filter_type == "dataset":
+        return LANE_CHEAP
+    if filter_type in ("catalog", "package"):
+        if len(values) <= CHEAP_MAX_PIDS:
+            return LANE_CHEAP
+        return LANE_STANDARD
+    if filter_type == "portal":
+        return LANE_EXPENSIVE
+    if filter_type == "repository":
+        if len(values) > 0 and values[0] in EXPENSIVE_REPOSITORIES:
+            return LANE_EXPENSIVE
+        return LANE_STANDARD
+    return LANE_STANDARD
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a lane can not admit a request.
+    """
+
+    def __init__(self, lane, retry_after):
+        super(AdmissionRejected, self).__init__("Lane {0} is full".format(lane))
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class Lane(object):
+    """
+    Concurrency limit with a bounded queue.
+    """
+
+    def __init__(self, name, max_concurrent, max_queued, queue_timeout, retry_after):
+        self.name = name
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout
+        self._retry_after = retry_after
+        self._condition = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+    def acquire(self):
+        """
+        Waits for a slot of the lane
+        :return: seconds waited
+        """
+        t_0 = time.time()
+        with self._condition:
+            if self.active >= self._max_concurrent:
+                if self.queued >= self._max_queued:
+                    self.rejected += 1
+                    raise AdmissionRejected(self.name, self._retry_after)
+                self.queued += 1
+                try:
+                    admitted = self._condition.wait_for(lambda: self.active < self._max_concurrent,
+                                                        timeout=self._queue_timeout)
+                finally:
+                    self.queued -= 1
+                if not admitted:
+                    self.rejected += 1
+                    raise AdmissionRejected(self.name, self._retry_after)
+            self.active += 1
+            self.admitted += 1
+            waited = time.time() - t_0
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return waited
+
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+    def stats(self):
+        """
+        Counters of the lane
+        :return: dictionary
+        """
+        with self._condition:
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "wait_seconds_total": self.wait_total,
+                "wait_seconds_max": self.wait_max,
+            }
+
+
+class AdmissionController(object):
+    """
+    The lanes of a worker.
+    """
+
+    def __init__(self, lanes=None):
+        if lanes is None:
+            lanes = DEFAULT_LANES
+        self._lanes = {}
+        for name, limits in lanes.items():
+            self._lanes[name] = Lane(name, limits["max_concurrent"], limits["max_queued"],
+                                     limits["queue_timeout"], limits["retry_after"])
+
+
+    def do(self, lane, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) once the lane admits it
+        :param lane: name of the lane
+        :param function: the function to call
+        :return: result of the function
+        :raises AdmissionRejected: when the queue of the lane is full or the wait timed out
+        """
+        lane = self._lanes[lane]
+        try:
+            waited = lane.acquire()
+        except AdmissionRejected:
+            _getLogger().warning("Rejected request, lane %s is full", lane.name)
+            raise
+        if waited > 0.1:
+            _getLogger().info("Request waited %fsec in lane %s", waited, lane.name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            lane.release()
+
+
+    def stats(self):
+        """
+        Counters of the lanes
+        :return: dictionary of lane name to counters
+        """
+        return {name: lane.stats() for name, lane in self._lanes.items()}
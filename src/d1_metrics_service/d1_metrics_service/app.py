@@ -11,26 +11,51 @@ We create unique resource and map to its endpoint.
 import falcon
 import logging
 
-from d1_metrics_service.metricsreader import MetricsReader
+from d1_metrics_service.metricsreader import MetricsReader, MetricsBatchReader, MetricsJobReader, \
+    MetricsStatsReader, PrometheusReader
 from d1_metrics_service.citationsmanager import CitationsManager
+from d1_metrics_service.compression import CompressionMiddleware
+from d1_metrics_service.servertiming import ServerTimingMiddleware
+from d1_metrics.timing import StageHistograms
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(name)18s: %(message)s'
                     )
 
-api = application = falcon.API() # pylint: disable=invalid-name
+# Durations of the stages of the requests of the worker, served by /metrics/_stats
+stage_histograms = StageHistograms() # pylint: disable=invalid-name
+
+# Responses are compressed according to the Accept-Encoding of the request, and carry the
+# durations of their stages in a Server-Timing header
+api = application = falcon.API(middleware=[CompressionMiddleware(), # pylint: disable=invalid-name
+                                           ServerTimingMiddleware(stage_histograms)])
 
 # Creating a resource handler for the Falcon API that handles the HTTP requests
 metrics_handler_resource = MetricsReader() # pylint: disable=invalid-name
+metrics_batch_resource = MetricsBatchReader(metrics_handler_resource) # pylint: disable=invalid-name
+metrics_job_resource = MetricsJobReader(metrics_handler_resource) # pylint: disable=invalid-name
+metrics_stats_resource = MetricsStatsReader(metrics_handler_resource, # pylint: disable=invalid-name
+                                            stage_histograms=stage_histograms)
 citations_manager_resource = CitationsManager() # pylint: disable=invalid-name
+prometheus_resource = PrometheusReader() # pylint: disable=invalid-name
 
 # Mapping the HTTP endpoint with its unique resource.
 # Used for both the GET and the POST endpoints
 api.add_route('/metrics', metrics_handler_resource)
 api.add_route('/metrics/filters', metrics_handler_resource)
 
+# Mapping the batch HTTP endpoint, POST only
+api.add_route('/metrics/batch', metrics_batch_resource)
+
+# Mapping the status HTTP endpoint of the requests processed in the background, GET only
+api.add_route('/metrics/jobs/{job_id}', metrics_job_resource)
+
+# Mapping the HTTP endpoint of the counters of the worker, GET only
+api.add_route('/metrics/_stats', metrics_stats_resource)
+
 # Mapping the Citations HTTP endpoint with its unique resource.
 # Used for both the GET and the POST endpoints
 api.add_route('/citations', citations_manager_resource)
 
-
+# Mapping the HTTP endpoint of the metrics of the worker in the Prometheus format, GET only
+api.add_route('/_prometheus', prometheus_resource)
@@ -0,0 +1,173 @@
+"""
+Citation Index module
+
+Keeps the rows of a citations table in memory, indexed so that the citations of a
+set of identifiers can be found without scanning every row for every request.
+
+A citation matches an identifier when its target_id, lower cased, is a substring of the
+lower cased identifier. For Dryad identifiers only the part before the first '?' is
+considered. Most target_ids are DOIs, so they are indexed on the position of their "10."
+prefix: a target can only occur in an identifier where the identifier has a "10." at the
+same offset, which reduces the lookup to a few dictionary probes per identifier. Targets
+without a "10." are few and are checked with a plain substring test.
+
+The index is rebuilt when the table statistics show that rows were inserted, updated or
+deleted, checking at most every CITATION_INDEX_CHECK_SECONDS.
+"""
+import logging
+import threading
+import time
+
+import psycopg2
+
+# The anchor all DOI targets share
+DOI_ANCHOR = "10."
+
+# Minimum number of seconds between checks of the citations table for changes
+CITATION_INDEX_CHECK_SECONDS = 60
+
+# Indexes of the process, keyed by (table, columns)
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+def normalizeIdentifier(identifier):
+    """
+    Lower cases an identifier for matching, applying the Dryad special case.
+    :param identifier:
+    :return: normalized identifier
+    """
+    # Special use case for Dryad datasets.
+    if '?' in identifier:
+        identifier = identifier.split("?")[0]
+    return identifier.lower()
+
+
+class CitationIndex(object):
+    """
+    In memory index of citation rows. The first column of each row is the target_id.
+    """
+
+    def __init__(self, rows, version=None):
+        self.rows = rows
+        self.version = version
+        # lower cased target -> positions of the rows citing it
+        self._targets = {}
+        # (offset of the anchor in the target, length of the target) of the anchored targets
+        self._shapes = set()
+        # (lower cased target, positions) of the targets without an anchor
+        self._unanchored = []
+
+        unanchored = {}
+        for position, row in enumerate(rows):
+            if row[0] is None:
+                continue
+            target = row[0].lower()
+            offset = target.find(DOI_ANCHOR)
+            if offset < 0:
+                unanchored.setdefault(target, []).append(position)
+                continue
+            self._targets.setdefault(target, []).append(position)
+            self._shapes.add((offset, len(target)))
+        self._unanchored = list(unanchored.items())
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def matchPositions(self, PIDs):
+        """
+        Find the rows citing any of the PIDs
+        :param PIDs: list of identifiers
+        :return: set of row positions
+        """
+        matched = set()
+        for pid in PIDs:
+            pid = normalizeIdentifier(pid)
+            pid_length = len(pid)
+            anchor = pid.find(DOI_ANCHOR)
+            while anchor >= 0:
+                for offset, length in self._shapes:
+                    start = anchor - offset
+                    if start < 0 or start + length > pid_length:
+                        continue
+                    positions = self._targets.get(pid[start:start + length])
+                    if positions is not None:
+                        matched.update(positions)
+                anchor = pid.find(DOI_ANCHOR, anchor + 1)
+            for target, positions in self._unanchored:
+                if target in pid:
+                    matched.update(positions)
+        return matched
+
+
+    def match(self, PIDs):
+        """
+        Find the rows citing any of the PIDs
+        :param PIDs: list of identifiers
+        :return: list of rows, in table order, each row at most once
+        """
+        return [self.rows[position] for position in sorted(self.matchPositions(PIDs))]
+
+
+def getTableVersion(csr, table):
+    """
+    Cheap change counter for a table, taken from the postgres statistics collector.
+    :param csr: database cursor
+    :param table: name of the table
+    :return: tuple that changes when rows are inserted, updated or deleted, None if not available
+    """
+    sql = "SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables WHERE relname = %s;"
+    try:
+        csr.execute(sql, (table,))
+        row = csr.fetchone()
+    except psycopg2.DatabaseError as e:
+        _getLogger().warning("Unable to read the statistics of %s: %s", table, e)
+        csr.connection.rollback()
+        return None
+    if row is None:
+        return None
+    return tuple(row)
+
+
+def getCitationIndex(metrics_database, table="citations", columns=None):
+    """
+    Get the index of a citations table, loading or refreshing it if necessary.
+    :param metrics_database: MetricsDatabase with a connection to use for loading
+    :param table: name of the citations table
+    :param columns: list of the columns of the rows, target_id first
+    :return: CitationIndex
+    """
+    if columns is None:
+        columns = ["target_id", ]
+    key = (table, tuple(columns))
+    with _INDEXES_LOCK:
+        entry = _INDEXES.get(key)
+        now = time.time()
+        if entry is not None and now - entry["checked"] < CITATION_INDEX_CHECK_SECONDS:
+            return entry["index"]
+        csr = metrics_database.getCursor()
+        version = getTableVersion(csr, table)
+        if entry is not None and version is not None and version == entry["index"].version:
+            entry["checked"] = now
+            return entry["index"]
+        t_0 = time.time()
+        csr.execute("SELECT " + ",".join(columns) + " FROM " + table + ";")
+        index = CitationIndex(csr.fetchall(), version=version)
+        _INDEXES[key] = {"index": index, "checked": now}
+        _getLogger().info("Loaded %d rows of %s into the citation index in %fsec", len(index), table, time.time() - t_0)
+        return index
+
+
+def clearCitationIndexes():
+    """
+    Drop the loaded indexes so they are reloaded on next use.
+    :return: None
+    """
+    with _INDEXES_LOCK:
+        _INDEXES.clear()
@@ -21,12 +21,21 @@ from urllib.parse import quote_plus, unquote, urlparse
 
 from d1_metrics.metricsdatabase import MetricsDatabase
 from d1_metrics_service import pid_resolution
+from d1_metrics_service import citationindex
+from d1_metrics_service import responsecache
+from d1_metrics_service import versiontoken
 
 
 DEFAULT_CITATIONS_CONFIGURATION = {
     "solr_query_url": "https://cn-secondary.dataone.org/cn/v2/query/solr/"
 }
 
+# Columns of the citations table used for the citation lookups, target_id first
+CITATION_COLUMNS = [
+    "target_id", "source_id", "source_url", "link_publication_date", "origin", "title", "publisher", "journal",
+    "volume", "page", "year_of_publishing", "relation_type"
+]
+
 # List of characters that should be escaped in solr query terms
 SOLR_RESERVED_CHAR_LIST = [
     '+', '-', '&', '|', '!', '(', ')', '{', '}', '[', ']', '^', '"', '~', '*', '?', ':'
@@ -59,12 +68,13 @@ class CitationsManager:
     This class manages the storage and retrieval of citations
     """
 
+    telemetry_filter_type = "citations"
+
 
     def __init__(self):
         self._config = DEFAULT_CITATIONS_CONFIGURATION
-        self.request = {}
-        self.response = {}
         self.logger = logging.getLogger('citations_service.' + __name__)
+        self._data_version = versiontoken.DataVersion(tables=("citations_test",))
 
 
     def on_get(self, req, resp):
@@ -81,18 +91,28 @@ class CitationsManager:
 
         query_param = urlparse(unquote(req.url))
 
-        if ("=" in query_param.query):
-            metrics_request = json.loads((query_param.query).split("=", 1)[1])
-            self.request = metrics_request
-            resp.body = json.dumps(self.process_citation_request(metrics_request), ensure_ascii=False)
-        else:
-            self.request = metrics_request
-            resp.body = json.dumps(metrics_request, ensure_ascii=False)
-
         # The following line can be omitted because 200 is the default
         # status returned by the framework, but it is included here to
         # illustrate how this may be overridden as needed.
         resp.status = falcon.HTTP_200
+
+        if ("=" in query_param.query):
+            metrics_request = json.loads((query_param.query).split("=", 1)[1])
+
+            # Conditional requests are answered without processing when the citations did not change
+            etag = None
+            data_version = self._data_version.get()
+            if data_version is not None:
+                request_key = "citations:" + responsecache.canonicalMetricsRequest(metrics_request)
+                etag = versiontoken.getETag(request_key, data_version)
+                resp.set_header("ETag", etag)
+            if versiontoken.matchesETag(req.get_header("If-None-Match"), etag):
+                self.logger.debug("on_get: not modified")
+                resp.status = falcon.HTTP_304
+            else:
+                resp.body = json.dumps(self.process_citation_request(metrics_request), ensure_ascii=False)
+        else:
+            resp.body = json.dumps(metrics_request, ensure_ascii=False)
         self.logger.debug("exit on_get")
 
 
@@ -107,7 +127,6 @@ class CitationsManager:
         request_string = req.stream.read().decode('utf8')
 
         citations_request = json.loads(request_string)
-        self.request = citations_request
 
         response = self.handle_citation_post_request(citations_request)
         resp.body = json.dumps(response, ensure_ascii=False)
@@ -158,7 +177,8 @@ class CitationsManager:
             if "submitter" in citation_request and "citations" in citation_request:
                 # handling updated version
                 if len(citation_request["citations"]) == 1:
-                    return self.register_citation(citation_object=citation_request["citations"][0], submitter=citation_request["submitter"])
+                    return self.register_citation(citation_object=citation_request["citations"][0], submitter=citation_request["submitter"],
+                                                  citation_request=citation_request)
 
                 elif len(citation_request["citations"]) > 1:
                     return self.batch_register_citation(citation_request)
@@ -175,9 +195,12 @@ class CitationsManager:
         return response
 
 
-    def register_citation(self, citation_object, submitter):
+    def register_citation(self, citation_object, submitter, citation_request=None):
         """
         Validates citation metadata and registers it into the citation database
+        :param citation_object: the citation to register
+        :param submitter: submitter of the citation
+        :param citation_request: the complete request, queued if the registration fails
         :return:
         """
         invalid_metadata = False
@@ -226,82 +249,82 @@ class CitationsManager:
 
                     try:
                         metrics_database = MetricsDatabase()
-                        metrics_database.connect()
-                        doi_pattern = "^\s*(http:\/\/|https:\/\/)?(doi.org\/|dx.doi.org\/)?(doi: ?|DOI: ?)?(10\.\d{4,}(\.\d)*)\/(\w+).*$"
-                        doi_metadata = {}
-                        if (re.match(doi_pattern, source_id)):
-                            source_doi_index = source_id.index("10.")
-                            source_doi = source_id[source_doi_index:]
-                            doi_metadata = metrics_database.getDOIMetadata(doi=source_doi)
-
-                        if (re.match(doi_pattern, identifier)):
-                            identifier_index = identifier.index("10.")
-                            identifier = identifier[identifier_index:]
-
-                        citation_db_object = {}
-                        citation_db_object["source_id"] = source_doi
-                        citation_db_object["target_id"] = identifier
-                        citation_db_object["relation_type"] = relation_type
-
-                        if submitter is not None:
-                            citation_db_object["reporter"] = submitter
-
-                        if "source_url" in citation_object:
-                            citation_db_object["source_url"] = citation_object["source_url"]
-                        elif "source_url" in doi_metadata:
-                            citation_db_object["source_url"] = doi_metadata["source_url"]
-
-                        if "link_publication_date" in citation_object:
-                            citation_db_object["link_publication_date"] = citation_object["link_publication_date"]
-                        elif "link_publication_date" in doi_metadata:
-                            citation_db_object["link_publication_date"] = doi_metadata["link_publication_date"]
-
-                        if "origin" in citation_object:
-                            citation_db_object["origin"] = citation_object["origin"]
-                        elif "origin" in doi_metadata:
-                            citation_db_object["origin"] = doi_metadata["origin"]
-
-                        if "title" in citation_object:
-                            citation_db_object["title"] = citation_object["title"]
-                        elif "title" in doi_metadata:
-                            citation_db_object["title"] = doi_metadata["title"]
-
-                        if "publisher" in citation_object:
-                            citation_db_object["publisher"] = citation_object["publisher"]
-                        elif "publisher" in doi_metadata:
-                            citation_db_object["publisher"] = doi_metadata["publisher"]
-
-                        if "journal" in citation_object:
-                            citation_db_object["journal"] = citation_object["journal"]
-                        elif "journal" in doi_metadata:
-                            citation_db_object["journal"] = doi_metadata["journal"]
-
-                        if "volume" in citation_object:
-                            citation_db_object["volume"] = citation_object["volume"]
-                        elif "volume" in doi_metadata:
-                            citation_db_object["volume"] = doi_metadata["volume"]
-
-                        if "page" in citation_object:
-                            citation_db_object["page"] = citation_object["page"]
-                        elif "page" in doi_metadata:
-                            citation_db_object["page"] = doi_metadata["page"]
-
-                        if "year_of_publishing" in citation_object:
-                            citation_db_object["year_of_publishing"] = citation_object["year_of_publishing"]
-                        elif "year_of_publishing" in doi_metadata:
-                            citation_db_object["year_of_publishing"] = doi_metadata["year_of_publishing"]
-
-                        citations.append(citation_db_object)
-                        metrics_database.insertCitationObjects(citations_data=citations)
-                        response = {
-                            "message": "Registered",
-                            "status_code": "202"
-                        }
-                        return response
+                        with metrics_database.pooledConnection():
+                            doi_pattern = "^\s*(http:\/\/|https:\/\/)?(doi.org\/|dx.doi.org\/)?(doi: ?|DOI: ?)?(10\.\d{4,}(\.\d)*)\/(\w+).*$"
+                            doi_metadata = {}
+                            if (re.match(doi_pattern, source_id)):
+                                source_doi_index = source_id.index("10.")
+                                source_doi = source_id[source_doi_index:]
+                                doi_metadata = metrics_database.getDOIMetadata(doi=source_doi)
+
+                            if (re.match(doi_pattern, identifier)):
+                                identifier_index = identifier.index("10.")
+                                identifier = identifier[identifier_index:]
+
+                            citation_db_object = {}
+                            citation_db_object["source_id"] = source_doi
+                            citation_db_object["target_id"] = identifier
+                            citation_db_object["relation_type"] = relation_type
+
+                            if submitter is not None:
+                                citation_db_object["reporter"] = submitter
+
+                            if "source_url" in citation_object:
+                                citation_db_object["source_url"] = citation_object["source_url"]
+                            elif "source_url" in doi_metadata:
+                                citation_db_object["source_url"] = doi_metadata["source_url"]
+
+                            if "link_publication_date" in citation_object:
+                                citation_db_object["link_publication_date"] = citation_object["link_publication_date"]
+                            elif "link_publication_date" in doi_metadata:
+                                citation_db_object["link_publication_date"] = doi_metadata["link_publication_date"]
+
+                            if "origin" in citation_object:
+                                citation_db_object["origin"] = citation_object["origin"]
+                            elif "origin" in doi_metadata:
+                                citation_db_object["origin"] = doi_metadata["origin"]
+
+                            if "title" in citation_object:
+                                citation_db_object["title"] = citation_object["title"]
+                            elif "title" in doi_metadata:
+                                citation_db_object["title"] = doi_metadata["title"]
+
+                            if "publisher" in citation_object:
+                                citation_db_object["publisher"] = citation_object["publisher"]
+                            elif "publisher" in doi_metadata:
+                                citation_db_object["publisher"] = doi_metadata["publisher"]
+
+                            if "journal" in citation_object:
+                                citation_db_object["journal"] = citation_object["journal"]
+                            elif "journal" in doi_metadata:
+                                citation_db_object["journal"] = doi_metadata["journal"]
+
+                            if "volume" in citation_object:
+                                citation_db_object["volume"] = citation_object["volume"]
+                            elif "volume" in doi_metadata:
+                                citation_db_object["volume"] = doi_metadata["volume"]
+
+                            if "page" in citation_object:
+                                citation_db_object["page"] = citation_object["page"]
+                            elif "page" in doi_metadata:
+                                citation_db_object["page"] = doi_metadata["page"]
+
+                            if "year_of_publishing" in citation_object:
+                                citation_db_object["year_of_publishing"] = citation_object["year_of_publishing"]
+                            elif "year_of_publishing" in doi_metadata:
+                                citation_db_object["year_of_publishing"] = doi_metadata["year_of_publishing"]
+
+                            citations.append(citation_db_object)
+                            metrics_database.insertCitationObjects(citations_data=citations)
+                            response = {
+                                "message": "Registered",
+                                "status_code": "202"
+                            }
+                            return response
 
                     except Exception as e:
                         self.logger.error(e)
-                        return self.queue_citation_object(self.request)
+                        return self.queue_citation_object(citation_request)
 
         response = {
             "message": "Cannot process this type of request",
@@ -332,7 +355,8 @@ class CitationsManager:
 
         try:
             metrics_database = MetricsDatabase()
-            metrics_database.queueCitationRequest(citations_request)
+            with metrics_database.pooledConnection():
+                metrics_database.queueCitationRequest(citations_request)
             response["message"] = "Successful"
             response["status_code"] = "202"
         except Exception as e:
@@ -351,9 +375,9 @@ class CitationsManager:
         """
         t_0 = time.time()
         self.logger.debug("enter process_request. metrics_request=%s", str(metrics_request))
-        self.request = metrics_request
-        self.response["metricsRequest"] = metrics_request
-        filter_by = self.request['filterBy']
+        response = {}
+        response["metricsRequest"] = metrics_request
+        filter_by = metrics_request['filterBy']
         results = {}
         resultDetails = []
 
@@ -369,9 +393,9 @@ class CitationsManager:
                 if n_filter_values == 1:
                     resultDetails = self.getDatasetCitations(filter_by[0]["values"])
 
-        self.response["resultDetails"] = resultDetails
+        response["resultDetails"] = resultDetails
         self.logger.debug("exit process_request, duration=%fsec", time.time() - t_0)
-        return self.response
+        return response
 
 
     def getDatasetCitations(self, PIDs):
@@ -398,53 +422,45 @@ class CitationsManager:
         :param metrics_database:
         :return:
         """
+        if metrics_database is None:
+            # Borrow a pooled connection for the duration of the lookup
+            metrics_database = MetricsDatabase()
+            with metrics_database.pooledConnection():
+                return self.gatherCitations(PIDs, metrics_database=metrics_database)
+
         # Retreive the citations if any!
         t_0 = time.time()
         self.logger.debug("enter gatherCitations")
         self.logger.debug("enter gatherCitations")
-        if metrics_database is None:
-            metrics_database = MetricsDatabase()
-            metrics_database.connect()
-        csr = metrics_database.getCursor()
-        sql = 'SELECT target_id,source_id,source_url,link_publication_date,origin,title,publisher,journal,volume,page,year_of_publishing,relation_type FROM citations_test;'
-
         citations = []
         citationCount = 0
         try:
-            csr.execute(sql)
-            rows = csr.fetchall()
-
-            for i in rows:
+            index = citationindex.getCitationIndex(metrics_database, table="citations_test", columns=CITATION_COLUMNS)
+            # Each citing row is returned once, in table order
+            for i in index.match(PIDs):
                 citationObject = {}
-                for j in PIDs:
-                    # Special use case for Dryad datasets.
-                    if ('?' in j.lower()):
-                        j = j.split("?")[0]
-                    if i[0].lower() in j.lower():
-                        citationCount = citationCount + 1
-                        citationObject["source_id"] = i[1]
-                        citationObject["source_url"] = i[2]
-                        citationObject["link_publication_date"] = i[3]
-                        citationObject["origin"] = i[4]
-                        citationObject["title"] = i[5]
-                        citationObject["publisher"] = i[6]
-                        citationObject["journal"] = i[7]
-                        citationObject["volume"] = i[8]
-                        citationObject["page"] = i[9]
-                        citationObject["year_of_publishing"] = i[10]
-
-                        # form the related identifier object
-                        related_identifiers_list = []
-                        related_identifier_object = {}
-                        related_identifier_object["identifier"] = i[0]
-                        related_identifier_object["relation_type"] = "cites" if i[11] is None else i[11]
-                        related_identifiers_list.append(related_identifier_object)
-
-                        citationObject["related_identifiers"] = related_identifiers_list
-
-                        citations.append(citationObject)
-                        # We don't want to add duplicate citations for all the objects of the dataset
-                        break
+                citationCount = citationCount + 1
+                citationObject["source_id"] = i[1]
+                citationObject["source_url"] = i[2]
+                citationObject["link_publication_date"] = i[3]
+                citationObject["origin"] = i[4]
+                citationObject["title"] = i[5]
+                citationObject["publisher"] = i[6]
+                citationObject["journal"] = i[7]
+                citationObject["volume"] = i[8]
+                citationObject["page"] = i[9]
+                citationObject["year_of_publishing"] = i[10]
+
+                # form the related identifier object
+                related_identifiers_list = []
+                related_identifier_object = {}
+                related_identifier_object["identifier"] = i[0]
+                related_identifier_object["relation_type"] = "cites" if i[11] is None else i[11]
+                related_identifiers_list.append(related_identifier_object)
+
+                citationObject["related_identifiers"] = related_identifiers_list
+
+                citations.append(citationObject)
         except Exception as e:
             print('Database error!\n{0}', e)
         finally:
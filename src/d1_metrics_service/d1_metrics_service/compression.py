@@ -0,0 +1,177 @@
+"""
+Compression module
+
+Falcon middleware compressing the responses of the service according to the
+Accept-Encoding header of the request. Brotli is used when the client accepts it and
+the brotli package is installed, gzip otherwise.
+
+Responses set through resp.body or resp.data are compressed when they are at least
+min_bytes long. Streamed responses are compressed while they are sent.
+"""
+import logging
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_COMPRESSION_CONFIGURATION = {
+    "min_bytes": 1024,          # smallest response body that is compressed
+    "gzip_level": 6,            # zlib compression level, 1 to 9
+    "brotli_quality": 5,        # brotli quality, 0 to 11
+    "stream_read_bytes": 65536, # bytes read at a time from a file-like response stream
+}
+
+# Statuses of responses without a body
+NO_BODY_STATUSES = ("204", "304")
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+def parseAcceptEncoding(accept_encoding):
+    """
+    Content codings accepted by a client
+    :param accept_encoding: value of the Accept-Encoding header, may be None
+    :return: dictionary of lower cased coding to quality value
+    """
+    accepted = {}
+    if not accept_encoding:
+        return accepted
+    for part in accept_encoding.split(","):
+        params = part.strip().split(";")
+        coding = params[0].strip().lower()
+        if coding == "":
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def selectEncoding(accept_encoding, available):
+    """
+    The preferred coding of a client among the available ones
+    :param accept_encoding: value of the Accept-Encoding header, may be None
+    :param available: list of codings, in order of preference of the server
+    :return: coding or None for the identity coding
+    """
+    accepted = parseAcceptEncoding(accept_encoding)
+    best = None
+    best_quality = 0.0
+    for coding in available:
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best = coding
+            best_quality = quality
+    return best
+
+
+class CompressionMiddleware(object):
+    """
+    Compresses response bodies with the coding negotiated with the client.
+    """
+
+    def __init__(self, config=None):
+        self._config = dict(DEFAULT_COMPRESSION_CONFIGURATION)
+        if config is not None:
+            self._config.update(config)
+        self._encodings = ["gzip", ]
+        if brotli is not None:
+            self._encodings.insert(0, "br")
+
+
+    def _getCompressor(self, encoding):
+        """
+        :param encoding: br or gzip
+        :return: tuple of (function compressing a chunk, function returning the remaining output)
+        """
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=self._config["brotli_quality"])
+            return compressor.process, compressor.finish
+        # wbits of 16 + MAX_WBITS produce the gzip format
+        compressor = zlib.compressobj(self._config["gzip_level"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, compressor.flush
+
+
+    def compress(self, encoding, data):
+        """
+        Compresses a whole body
+        :param encoding: br or gzip
+        :param data: bytes
+        :return: compressed bytes
+        """
+        process, finish = self._getCompressor(encoding)
+        return process(data) + finish()
+
+
+    def compressStream(self, encoding, stream):
+        """
+        Compresses a response stream while it is read
+        :param encoding: br or gzip
+        :param stream: iterable of bytes or file-like object
+        :return: generator of compressed bytes
+        """
+        if hasattr(stream, "read"):
+            read_bytes = self._config["stream_read_bytes"]
+            fragments = iter(lambda: stream.read(read_bytes), b"")
+        else:
+            fragments = stream
+        process, finish = self._getCompressor(encoding)
+        try:
+            for fragment in fragments:
+                compressed = process(fragment)
+                if compressed:
+                    yield compressed
+            yield finish()
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        """
+        Falcon hook called after the resource responder
+        :param req: HTTP Request object
+        :param resp: HTTP Response object
+        :param resource: resource the request was routed to, may be None
+        :param req_succeeded: whether the responder completed without raising
+        :return: None
+        """
+        if req.method == "HEAD" or resp.status[:3] in NO_BODY_STATUSES:
+            return
+        if resp.get_header("Content-Encoding") is not None:
+            return
+        resp.append_header("Vary", "Accept-Encoding")
+        encoding = selectEncoding(req.get_header("Accept-Encoding"), self._encodings)
+        if encoding is None:
+            return
+
+        if resp.stream is not None:
+            resp.stream = self.compressStream(encoding, resp.stream)
+            resp.stream_len = None
+        else:
+            data = resp.data
+            if data is None:
+                if resp.body is None:
+                    return
+                data = resp.body.encode("utf-8")
+            if len(data) < self._config["min_bytes"]:
+                return
+            resp.data = self.compress(encoding, data)
+            resp.body = None
+            _getLogger().debug("process_response: %s %d to %d bytes", encoding, len(data), len(resp.data))
+
+        resp.set_header("Content-Encoding", encoding)
+        # The compressed representation is not byte for byte the one the entity tag was computed for
+        etag = resp.get_header("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            resp.set_header("ETag", "W/" + etag)
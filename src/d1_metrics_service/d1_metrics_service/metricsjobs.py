@@ -0,0 +1,173 @@
+"""
+Metrics Jobs module
+
+Background processing of metricsRequests for clients that send "Prefer: respond-async".
+The request is answered with 202 and a job id, the work runs on a bounded executor and
+the client polls /metrics/jobs/{job_id} until the response is ready.
+
+The state of the jobs is kept in the metrics_jobs table, so that a job can be polled
+through any worker of the service. The id of a job is derived from the canonical
+metricsRequest and the cache expiry date, so identical requests share a job. Completed
+responses are kept until the response cache expires, the next 07:00.
+"""
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psycopg2
+
+from d1_metrics.metricsdatabase import MetricsDatabase
+from d1_metrics_service import responsecache
+
+JOB_PENDING = "pending"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Seconds after which a pending job that is not running in this process is considered abandoned
+JOB_TIMEOUT = 6000
+
+# Minimum number of seconds between removals of the expired jobs
+PURGE_SECONDS = 600
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+def getJobId(request_key, expiry_time=None):
+    """
+    Id of the job of a request
+    :param request_key: canonical form of the metricsRequest
+    :param expiry_time: expiry of the response cache, defaults to the next one
+    :return: hex digest
+    """
+    if expiry_time is None:
+        expiry_time, secs = responsecache.getCacheExpiry()
+    key = expiry_time.strftime("%Y-%m-%d") + "\n" + request_key
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class MetricsJobs(object):
+    """
+    Runs jobs on at most max_workers threads, with at most max_pending jobs of the process
+    waiting or running.
+    """
+
+    def __init__(self, max_workers=2, max_pending=100, job_timeout=JOB_TIMEOUT):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="metrics-job")
+        self._max_pending = max_pending
+        self._job_timeout = job_timeout
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._purged = 0
+
+
+    def submit(self, request_key, function, *args):
+        """
+        Starts the job of a request, unless a job for the same request exists.
+        :param request_key: canonical form of the metricsRequest
+        :param function: called with args, returns a tuple of (HTTP status, serialized response)
+        :return: job id, None if too many jobs are pending
+        """
+        expiry_time, secs = responsecache.getCacheExpiry()
+        job_id = getJobId(request_key, expiry_time=expiry_time)
+        with self._lock:
+            if job_id in self._pending:
+                return job_id
+            job = self.getJob(job_id)
+            if job is not None:
+                # Failed and abandoned jobs are run again
+                abandoned = (job["status"] == JOB_PENDING and
+                             (datetime.now() - job["created_at"]).total_seconds() > self._job_timeout)
+                if job["status"] != JOB_FAILED and not abandoned:
+                    return job_id
+            if len(self._pending) >= self._max_pending:
+                _getLogger().warning("submit: %d jobs pending, rejecting job", len(self._pending))
+                return None
+            self._storeJob(job_id, JOB_PENDING, None, None, expiry_time)
+            self._pending.add(job_id)
+        self._executor.submit(self._run, job_id, expiry_time, function, *args)
+        self._purgeExpired()
+        return job_id
+
+
+    def _run(self, job_id, expiry_time, function, *args):
+        t_0 = time.time()
+        try:
+            try:
+                http_status, body = function(*args)
+                self._storeJob(job_id, JOB_DONE, http_status, body, expiry_time)
+            except Exception as e:
+                _getLogger().error("Job %s failed: %s", job_id, e)
+                self._storeJob(job_id, JOB_FAILED, None, None, expiry_time)
+        except psycopg2.Error as e:
+            _getLogger().error("Unable to store job %s: %s", job_id, e)
+        finally:
+            with self._lock:
+                self._pending.discard(job_id)
+        _getLogger().debug("Job %s duration=%fsec", job_id, time.time() - t_0)
+
+
+    def _storeJob(self, job_id, status, http_status, body, expiry_time):
+        sql = "INSERT INTO metrics_jobs (job_id, status, http_status, body, created_at, completed_at, expires_at) " \
+              "VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (job_id) DO UPDATE " \
+              "SET status=excluded.status, http_status=excluded.http_status, body=excluded.body, " \
+              "completed_at=excluded.completed_at"
+        if status == JOB_PENDING:
+            sql += ", created_at=excluded.created_at"
+        # Times are local, as the expiry of the response cache
+        now = datetime.now()
+        completed_at = None if status == JOB_PENDING else now
+        if body is not None:
+            body = psycopg2.Binary(body)
+        metrics_database = MetricsDatabase()
+        with metrics_database.pooledConnection() as conn:
+            with conn.cursor() as csr:
+                csr.execute(sql, (job_id, status, http_status, body, now, completed_at, expiry_time))
+            conn.commit()
+
+
+    def getJob(self, job_id):
+        """
+        State of a job
+        :param job_id: id returned by submit
+        :return: dictionary with status, http_status, body, created_at and completed_at, None if there is
+            no such job or it expired
+        """
+        sql = "SELECT status, http_status, body, created_at, completed_at FROM metrics_jobs " \
+              "WHERE job_id = %s AND expires_at > %s;"
+        metrics_database = MetricsDatabase()
+        with metrics_database.pooledCursor() as csr:
+            csr.execute(sql, (job_id, datetime.now()))
+            row = csr.fetchone()
+        if row is None:
+            return None
+        status, http_status, body, created_at, completed_at = row
+        return {
+            "status": status,
+            "http_status": http_status,
+            "body": None if body is None else bytes(body),
+            "created_at": created_at,
+            "completed_at": completed_at,
+        }
+
+
+    def _purgeExpired(self):
+        now = time.time()
+        with self._lock:
+            if now - self._purged < PURGE_SECONDS:
+                return
+            self._purged = now
+        sql = "DELETE FROM metrics_jobs WHERE expires_at <= %s;"
+        try:
+            metrics_database = MetricsDatabase()
+            with metrics_database.pooledConnection() as conn:
+                with conn.cursor() as csr:
+                    csr.execute(sql, (datetime.now(),))
+                    _getLogger().debug("Removed %d expired jobs", csr.rowcount)
+                conn.commit()
+        except psycopg2.Error as e:
+            _getLogger().warning("Unable to remove the expired jobs: %s", e)
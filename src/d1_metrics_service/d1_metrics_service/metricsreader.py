@@ -5,8 +5,13 @@ Implemented as a falcon web application, https://falcon.readthedocs.io/en/stable
 
 
 """
+import concurrent.futures
+import copy
+import hashlib
+import itertools
 import json
 import logging
+import threading
 import time
 from collections import OrderedDict
 from datetime import datetime, timedelta
@@ -17,19 +22,84 @@ from urllib.parse import quote_plus, unquote, urlparse
 import requests
 
 import falcon
+from d1_metrics.aggregatecache import MonthlyAggregateCache
 from d1_metrics.metricsdatabase import MetricsDatabase
 from d1_metrics.metricselasticsearch import MetricsElasticSearch
+from d1_metrics import telemetry
+from d1_metrics import timing
+from d1_metrics_service import admission
+from d1_metrics_service import periodformatter
 from d1_metrics_service import pid_resolution
+from d1_metrics_service import citationindex
+from d1_metrics_service import metricsjobs
+from d1_metrics_service import responsecache
+from d1_metrics_service import responsewriter
+from d1_metrics_service import servertiming
+from d1_metrics_service import singleflight
+from d1_metrics_service import versiontoken
 
 DEFAULT_REPORT_CONFIGURATION={
-    "solr_query_url": "https://cn-secondary.dataone.org/cn/v2/query/solr/"
+    "solr_query_url": "https://cn-secondary.dataone.org/cn/v2/query/solr/",
+    "response_cache_entries": 1000,                 # responses held by the in-process cache
+    "response_cache_bytes": 256 * 1024 * 1024,      # serialized bytes held by the in-process cache
+    "single_flight_timeout": 120,                   # seconds to wait for an identical request in flight
+    "aggregate_cache_enabled": True,                # reuse the ES aggregations of closed months
+    "aggregate_cache_settle_days": 3,               # days after the end of a month before it is cached
+    "stream_min_items": 10000,                      # result items from which a response is streamed
+    "stream_chunk_items": 2000,                     # result items encoded at a time when streaming
+    "stream_cache_max_bytes": 4 * 1024 * 1024,      # largest streamed response kept for the cache, 0 to keep none
+    "batch_max_requests": 50,                       # metricsRequests accepted in a batch
+    "async_job_workers": 2,                         # metricsRequests processed at a time in the background
+    "async_job_max_pending": 100,                   # background jobs of a worker waiting or running
 }
 
+# Number of lookups of a dataset request that are run concurrently
+DATASET_LOOKUP_WORKERS = 2
+
+# Columns of the citations table used for the citation lookups, target_id first
+CITATION_COLUMNS = [
+    "target_id", "source_id", "source_url", "link_publication_date", "origin", "title", "publisher", "journal",
+    "volume", "page", "year_of_publishing"
+]
+
 # List of characters that should be escaped in solr query terms
 SOLR_RESERVED_CHAR_LIST = [
   '+', '-', '&', '|', '!', '(', ')', '{', '}', '[', ']', '^', '"', '~', '*', '?', ':'
   ]
 
+class MetricsRequestContext:
+    """
+    State of a single metricsRequest while it is processed.
+
+    A new context is created for every request and passed to the methods of
+    MetricsReader, so that the requests handled concurrently by the threads of
+    a worker do not share state through the MetricsReader instance.
+    """
+
+    def __init__(self, metrics_request, batch=None):
+        self.request = metrics_request
+        self.response = {}
+        self.response["metricsRequest"] = metrics_request
+        self.catalogPIDs = {}
+        self.userPIDs = {}
+        self.batch = batch
+
+
+class MetricsBatchContext:
+    """
+    State shared by the metricsRequests of a batch.
+
+    Holds the identifiers resolved for the whole batch, the first pages of the ES
+    aggregations retrieved with a single msearch, and the citations already looked up.
+    """
+
+    def __init__(self):
+        self.resolvedPIDs = {}
+        self.prefetched = {}
+        self.citations = {}
+        self.lock = threading.Lock()
+
+
 class MetricsReader:
     """
     This class parses the metricsRequest object
@@ -39,9 +109,15 @@ class MetricsReader:
 
     def __init__(self):
         self._config = DEFAULT_REPORT_CONFIGURATION
-        self.request = {}
-        self.response = {}
         self.logger = logging.getLogger('metrics_service.' + __name__)
+        self._response_cache = responsecache.ResponseCache(max_entries=self._config["response_cache_entries"],
+                                                           max_bytes=self._config["response_cache_bytes"])
+        self._single_flight = singleflight.SingleFlight(wait_timeout=self._config["single_flight_timeout"])
+        self._aggregate_cache = MonthlyAggregateCache(settle_days=self._config["aggregate_cache_settle_days"])
+        self._data_version = versiontoken.DataVersion(tables=("citations", "citation_metadata"))
+        self._admission = admission.AdmissionController()
+        self._jobs = metricsjobs.MetricsJobs(max_workers=self._config["async_job_workers"],
+                                             max_pending=self._config["async_job_max_pending"])
 
 
     def on_get(self, req, resp):
@@ -57,28 +133,31 @@ class MetricsReader:
         metrics_request = {}
 
         # Setting up the auto expiry time stamp for the caching requests
-        current_time = datetime.now()
-        tomorrow = current_time + timedelta(1)
-
-        # Setting the GMT offset to get the local time in Pacific
-        # Note: Day Light Savings time difference is not set
-        midnight = datetime(year=tomorrow.year, month=tomorrow.month, day=tomorrow.day, hour=7, minute=0, second=0)
-        secs = ((midnight - current_time).seconds)
-        
-        expiry_time = datetime.now() + timedelta(seconds=secs)
+        expiry_time, secs = responsecache.getCacheExpiry()
 
         query_param = urlparse(unquote(req.url))
 
         if ("=" in query_param.query):
             metrics_request = json.loads((query_param.query).split("=", 1)[1])
-            metrics_response = self.process_request(metrics_request)
-            resp.body = json.dumps(metrics_response, ensure_ascii=False)
+            servertiming.setFilterType(req, metrics_request)
+
+            # Conditional requests are answered without processing when the data did not change
+            etag = None
+            data_version = self._data_version.get()
+            if data_version is not None:
+                etag = versiontoken.getETag(responsecache.canonicalMetricsRequest(metrics_request), data_version)
+            if versiontoken.matchesETag(req.get_header("If-None-Match"), etag):
+                self.logger.debug("on_get: not modified")
+                resp.status = falcon.HTTP_304
+            elif self.prefersAsync(req):
+                self.respondAsync(metrics_request, req, resp)
+            else:
+                self.respond(metrics_request, resp)
+            if etag is not None and resp.status in (falcon.HTTP_200, falcon.HTTP_304):
+                resp.set_header("ETag", etag)
         else:
             resp.body = json.dumps(metrics_request, ensure_ascii=False)
-
-        resp.status = falcon.HTTP_200
-        if "status_code" in metrics_response["resultDetails"]:
-            resp.status = metrics_response["resultDetails"]["status_code"]
+            resp.status = falcon.HTTP_200
 
         resp.set_headers({"Expires": expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")})
         self.logger.debug("exit on_get")
@@ -95,17 +174,401 @@ class MetricsReader:
         request_string = req.stream.read().decode('utf8')
 
         metrics_request = json.loads(request_string)
+        servertiming.setFilterType(req, metrics_request)
+        if self.prefersAsync(req):
+            self.respondAsync(metrics_request, req, resp)
+        else:
+            self.respond(metrics_request, resp)
+
+        self.logger.debug("exit on_post")
+
+
+    def prefersAsync(self, req):
+        """
+        Whether the client asked for the request to be processed in the background
+        :param req: HTTP Request object
+        :return: True if the Prefer header of the request has respond-async
+        """
+        prefer = req.get_header("Prefer")
+        if prefer is None:
+            return False
+        for preference in prefer.split(","):
+            if preference.split(";")[0].strip().lower() == "respond-async":
+                return True
+        return False
+
+
+    def respondAsync(self, metrics_request, req, resp):
+        """
+        Sets the HTTP response for a metricsRequest processed in the background. Cached
+        responses are returned right away, otherwise the response is 202 with the id of the
+        job processing the request.
+        :param metrics_request: metricsRequest object
+        :param req: HTTP Request object
+        :param resp: HTTP Response object
+        :return: None
+        """
+        cache_key = self.responseCacheKey(metrics_request)
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            self.logger.debug("respondAsync: serving cached response")
+            resp.status, resp.data = cached
+            return
+
+        job_id = self._jobs.submit(cache_key, self.processJob, metrics_request, cache_key)
+        if job_id is None:
+            raise falcon.HTTPServiceUnavailable(title="Too many jobs",
+                                                description="Too many metricsRequests are being processed, "
+                                                            "retry later",
+                                                retry_after=60)
+        location = req.app + "/metrics/jobs/" + job_id
+        resp.status = falcon.HTTP_202
+        resp.set_headers({"Location": location, "Preference-Applied": "respond-async"})
+        resp.data = responsewriter.dumps({"jobId": job_id, "status": metricsjobs.JOB_PENDING, "location": location})
+
+
+    def processJob(self, metrics_request, cache_key):
+        """
+        Processes a metricsRequest in the background
+        :param metrics_request: metricsRequest object
+        :param cache_key: key returned by responseCacheKey
+        :return: tuple of (HTTP status, serialized MetricsResponse)
+        """
+        # The job executor bounds the background requests, they are not shed
+        metrics_response = self.process_request(metrics_request, admit=False)
+        status = falcon.HTTP_200
+        if "status_code" in metrics_response["resultDetails"]:
+            status = metrics_response["resultDetails"]["status_code"]
+        body = responsewriter.dumps(metrics_response)
+        self.cacheResponse(cache_key, status, body)
+        return status, body
+
+
+    def getJob(self, job_id):
+        """
+        State of a background job
+        :param job_id: id of the job
+        :return: dictionary as returned by MetricsJobs.getJob, None if there is no such job
+        """
+        return self._jobs.getJob(job_id)
+
+
+    def respond(self, metrics_request, resp):
+        """
+        Sets the HTTP response for a metricsRequest, from the response cache when possible.
+
+        Successful responses are cached serialized until the next 07:00. Responses with
+        large results are streamed.
+        :param metrics_request: metricsRequest object
+        :param resp: HTTP Response object
+        :return: None
+        """
+        cache_key = self.responseCacheKey(metrics_request)
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            self.logger.debug("respond: serving cached response")
+            resp.status, resp.data = cached
+            return
+
         metrics_response = self.process_request(metrics_request)
-        resp.body = json.dumps(metrics_response, ensure_ascii=False)
 
-        resp.status = falcon.HTTP_200
+        status = falcon.HTTP_200
         if "status_code" in metrics_response["resultDetails"]:
-            resp.status = metrics_response["resultDetails"]["status_code"]
+            status = metrics_response["resultDetails"]["status_code"]
+        resp.status = status
 
-        self.logger.debug("exit on_post")
+        def cacheResponse(body):
+            self.cacheResponse(cache_key, status, body)
+
+        if responsewriter.countResultItems(metrics_response) < self._config["stream_min_items"]:
+            body = responsewriter.dumps(metrics_response)
+            cacheResponse(body)
+            resp.data = body
+            return
+
+        # Large results are encoded while they are sent. Only a streamed response that fits in
+        # stream_cache_max_bytes is copied for the cache, larger ones are encoded again when requested.
+        self.logger.debug("respond: streaming the response")
+        fragments = responsewriter.iterResponse(metrics_response, chunk_items=self._config["stream_chunk_items"])
+        if self._config["stream_cache_max_bytes"] > 0:
+            fragments = responsewriter.tee(fragments, self._config["stream_cache_max_bytes"], cacheResponse)
+        resp.stream = fragments
+
+
+    def responseCacheKey(self, metrics_request, data_version=None):
+        """
+        Key of a metricsRequest in the response cache. The key includes the data version, so
+        the responses cached before the data changed are not served again.
+        :param metrics_request: metricsRequest object
+        :param data_version: value returned by DataVersion.get(), read if None
+        :return: string
+        """
+        if data_version is None:
+            data_version = self._data_version.get()
+        return "{0}\n{1}".format(data_version, responsecache.canonicalMetricsRequest(metrics_request))
+
+
+    def cacheResponse(self, cache_key, status, body):
+        """
+        Keeps a serialized response in the response cache until the next 07:00, if it is successful
+        :param cache_key: key returned by responseCacheKey
+        :param status: HTTP status of the response
+        :param body: serialized response
+        :return: None
+        """
+        if status == falcon.HTTP_200:
+            expiry_time, secs = responsecache.getCacheExpiry()
+            self._response_cache.put(cache_key, status, body, time.time() + secs)
 
 
-    def process_request(self, metrics_request):
+    def process_request(self, metrics_request, batch=None, admit=True):
+        """
+        Processes a metricsRequest. Concurrent requests with the same canonical
+        form are coalesced, the first one is processed and the others share its
+        response.
+
+        The request is admitted by the lane of its class before it joins the coalesced
+        requests, see the admission module, so that the requests waiting for an identical
+        one hold a slot of the lane as well. Requests rejected by a full lane raise
+        HTTPTooManyRequests.
+        :param metrics_request: metricsRequest object
+        :param batch: MetricsBatchContext when the request is part of a batch
+        :param admit: False to bypass the admission control, for the background jobs
+        :return: MetricsResponse Object
+        """
+        request_key = responsecache.canonicalMetricsRequest(metrics_request)
+        if not admit:
+            return self._single_flight.do(request_key, self._processRequest, metrics_request, batch)
+        lane = admission.classifyRequest(metrics_request)
+        try:
+            return self._admission.do(lane, self._single_flight.do, request_key, self._processRequest,
+                                      metrics_request, batch)
+        except admission.AdmissionRejected as e:
+            raise falcon.HTTPTooManyRequests(title="Too many requests",
+                                             description="Too many {0} requests are being processed, "
+                                                         "retry later".format(e.lane),
+                                             retry_after=e.retry_after)
+
+
+    def stats(self):
+        """
+        Counters of the admission lanes, the coalesced requests and the response cache
+        :return: dictionary
+        """
+        return {
+            "admission": self._admission.stats(),
+            "singleFlight": self._single_flight.stats(),
+            "responseCache": self._response_cache.stats(),
+        }
+
+
+    def process_batch(self, metrics_requests):
+        """
+        Processes a batch of metricsRequests.
+
+        Identical requests are processed once. The identifiers of the dataset and catalog
+        requests are resolved in a single pass and the first pages of their aggregations are
+        retrieved with a single ES msearch. Citations are looked up once per identifier family.
+        :param metrics_requests: list of metricsRequest objects
+        :return: serialized {"metricsResponses": [...]}, with the responses in request order
+        """
+        t_0 = time.time()
+        data_version = self._data_version.get()
+        cache_keys = [self.responseCacheKey(metrics_request, data_version) for metrics_request in metrics_requests]
+        unique_requests = OrderedDict()
+        for cache_key, metrics_request in zip(cache_keys, metrics_requests):
+            if cache_key not in unique_requests:
+                unique_requests[cache_key] = metrics_request
+
+        bodies = {}
+        for cache_key in unique_requests:
+            cached = self._response_cache.get(cache_key)
+            if cached is not None:
+                status, bodies[cache_key] = cached
+
+        batch = MetricsBatchContext()
+        pending = [(cache_key, metrics_request) for cache_key, metrics_request in unique_requests.items()
+                   if cache_key not in bodies]
+        try:
+            self.prefetchBatch(batch, [metrics_request for cache_key, metrics_request in pending])
+        except Exception as e:
+            # Prefetching is an optimization, the requests retrieve what is missing themselves
+            self.logger.warning("process_batch: prefetch failed: %s", e)
+
+        for cache_key, metrics_request in pending:
+            try:
+                metrics_response = self.process_request(metrics_request, batch=batch)
+                status = falcon.HTTP_200
+                if "status_code" in metrics_response["resultDetails"]:
+                    status = metrics_response["resultDetails"]["status_code"]
+                body = responsewriter.dumps(metrics_response)
+                self.cacheResponse(cache_key, status, body)
+            except falcon.HTTPTooManyRequests as e:
+                body = responsewriter.dumps({
+                    "metricsRequest": metrics_request,
+                    "results": {},
+                    "resultDetails": {"status_code": falcon.HTTP_429, "error": e.description},
+                })
+            except Exception as e:
+                self.logger.error("process_batch: request failed: %s", e)
+                body = responsewriter.dumps({
+                    "metricsRequest": metrics_request,
+                    "results": {},
+                    "resultDetails": {"status_code": falcon.HTTP_500, "error": str(e)},
+                })
+            bodies[cache_key] = body
+
+        self.logger.debug("exit process_batch, %d requests, %d unique, %d cached, duration=%fsec",
+                          len(metrics_requests), len(unique_requests), len(unique_requests) - len(pending),
+                          time.time() - t_0)
+        return b'{"metricsResponses": [' + b", ".join(bodies[cache_key] for cache_key in cache_keys) + b"]}"
+
+
+    def prefetchBatch(self, batch, metrics_requests):
+        """
+        Resolves the identifiers of the dataset and catalog requests of a batch in one pass and
+        retrieves the first page of their aggregations with one ES msearch.
+        :param batch: MetricsBatchContext to fill
+        :param metrics_requests: list of metricsRequest objects
+        :return: None
+        """
+        planned = []
+        identifiers = []
+        for metrics_request in metrics_requests:
+            try:
+                filter_object = metrics_request["filterBy"][0]
+                filter_type = filter_object["filterType"].lower()
+                interpret_as = filter_object["interpretAs"].lower()
+                values = filter_object["values"]
+            except (KeyError, IndexError, TypeError, AttributeError):
+                continue
+            if interpret_as != "list":
+                continue
+            if filter_type == "dataset" and len(values) == 1:
+                planned.append((filter_type, metrics_request))
+                identifiers.append(values[0])
+            elif filter_type == "catalog" and len(values) > 1:
+                planned.append((filter_type, metrics_request))
+                identifiers.extend(values)
+        if len(planned) == 0:
+            return
+
+        batch.resolvedPIDs.update(pid_resolution.getResolvePIDs(list(OrderedDict.fromkeys(identifiers))))
+
+        queries = OrderedDict()
+        for filter_type, metrics_request in planned:
+            # The queries are built on a copy, processing the request modifies its filters
+            context = MetricsRequestContext(copy.deepcopy(metrics_request), batch=batch)
+            values = context.request["filterBy"][0]["values"]
+            if filter_type == "dataset":
+                search_body, aggregation_body, start_date, end_date = self.getDatasetAggregationQuery(
+                    context, batch.resolvedPIDs[values[0]])
+            else:
+                catalogPIDs = OrderedDict()
+                combinedPIDs = []
+                for i in values:
+                    if i not in catalogPIDs:
+                        catalogPIDs[i] = batch.resolvedPIDs[i]
+                        combinedPIDs.extend(catalogPIDs[i])
+                search_body, aggregation_body, start_date, end_date = self.getCatalogAggregationQuery(
+                    catalogPIDs, combinedPIDs)
+            query = {
+                "date_start": datetime.strptime(start_date, '%m/%d/%Y'),
+                "date_end": datetime.strptime(end_date, '%m/%d/%Y'),
+                "query": search_body,
+                "aggQuery": aggregation_body,
+            }
+            queries[self.getQueryKey(search_body, aggregation_body, query["date_start"], query["date_end"])] = query
+
+        metrics_elastic_search = MetricsElasticSearch()
+        metrics_elastic_search.connect()
+        responses = metrics_elastic_search.msearch_aggregations(list(queries.values()))
+        for query_key, response in zip(queries.keys(), responses):
+            if response is not None:
+                batch.prefetched[query_key] = response
+
+
+    @staticmethod
+    def getQueryKey(search_query, aggregation_query, start_date, end_date):
+        return json.dumps([search_query, aggregation_query, start_date.isoformat(), end_date.isoformat()],
+                          sort_keys=True)
+
+
+    def getPrefetchedResponse(self, context, search_query, aggregation_query, start_date, end_date):
+        """
+        First page of an aggregation retrieved for the batch of the request, if any. A page is only used once.
+        :return: ES response or None
+        """
+        if context is None or context.batch is None:
+            return None
+        query_key = self.getQueryKey(search_query, aggregation_query, start_date, end_date)
+        with context.batch.lock:
+            return context.batch.prefetched.pop(query_key, None)
+
+
+    def compositeAggregations(self, context, metrics_elastic_search, search_query, aggregation_query, start_date,
+                              end_date):
+        """
+        MetricsElasticSearch.iterate_composite_aggregations, starting from the prefetched first page of the batch
+        :param context: MetricsRequestContext of the request being processed
+        :return: ES response with all the buckets of the composite aggregation
+        """
+        return metrics_elastic_search.iterate_composite_aggregations(
+            search_query=search_query, aggregation_query=aggregation_query, start_date=start_date, end_date=end_date,
+            first_response=self.getPrefetchedResponse(context, search_query, aggregation_query, start_date, end_date))
+
+
+    def compositeAggregationPages(self, context, metrics_elastic_search, search_query, aggregation_query, start_date,
+                                  end_date):
+        """
+        MetricsElasticSearch.iterate_composite_aggregation_pages, starting from the prefetched first page of the batch
+        :param context: MetricsRequestContext of the request being processed
+        :return: generator of (response, buckets)
+        """
+        return metrics_elastic_search.iterate_composite_aggregation_pages(
+            search_query=search_query, aggregation_query=aggregation_query, start_date=start_date, end_date=end_date,
+            first_response=self.getPrefetchedResponse(context, search_query, aggregation_query, start_date, end_date))
+
+
+    @timing.timed(timing.STAGE_RESOLVE)
+    def resolvePIDs(self, context, PIDs):
+        """
+        pid_resolution.getResolvePIDs, using the identifiers already resolved for the batch of the request
+        :param context: MetricsRequestContext of the request being processed
+        :param PIDs: list of identifiers
+        :return: dictionary of identifier to the list of identifiers of its family
+        """
+        if context is None or context.batch is None:
+            return pid_resolution.getResolvePIDs(PIDs)
+        resolved = context.batch.resolvedPIDs
+        missing = [i for i in PIDs if i not in resolved]
+        if len(missing) > 0:
+            resolved.update(pid_resolution.getResolvePIDs(missing))
+        return {i: list(resolved[i]) for i in PIDs}
+
+
+    @timing.timed(timing.STAGE_CITATIONS)
+    def gatherRequestCitations(self, context, PIDs, metrics_database=None):
+        """
+        gatherCitations, looking up each identifier family once per batch
+        :param context: MetricsRequestContext of the request being processed
+        :param PIDs: list of identifiers
+        :param metrics_database: MetricsDatabase with a borrowed connection, optional
+        :return: tuple of (count, citations)
+        """
+        if context is None or context.batch is None:
+            return self.gatherCitations(PIDs, metrics_database=metrics_database)
+        citation_key = tuple(PIDs)
+        with context.batch.lock:
+            citations = context.batch.citations.get(citation_key)
+        if citations is None:
+            citations = self.gatherCitations(PIDs, metrics_database=metrics_database)
+            with context.batch.lock:
+                context.batch.citations[citation_key] = citations
+        return citations
+
+
+    def _processRequest(self, metrics_request, batch=None):
         """
         This method parses the filters of the
         MetricsRequest object
@@ -113,12 +576,11 @@ class MetricsReader:
         """
         t_0 = time.time()
         self.logger.debug("enter process_request. metrics_request=%s", str(metrics_request))
-        self.request = metrics_request
-        self.response["metricsRequest"] = metrics_request
-        metrics_page = self.request['metricsPage']
-        filter_by = self.request['filterBy']
-        metrics = self.request['metrics']
-        group_by = self.request['groupBy']
+        context = MetricsRequestContext(metrics_request, batch=batch)
+        metrics_page = context.request['metricsPage']
+        filter_by = context.request['filterBy']
+        metrics = context.request['metrics']
+        group_by = context.request['groupBy']
         results = {}
         resultDetails = []
         if (len(filter_by) > 0):
@@ -129,23 +591,23 @@ class MetricsReader:
                               filter_type, interpret_as, n_filter_values)
             if filter_type == "dataset" and interpret_as == "list":
                 if n_filter_values == 1:
-                    results, resultDetails = self.getSummaryMetricsPerDataset(filter_by[0]["values"])
+                    results, resultDetails = self.getSummaryMetricsPerDataset(context, filter_by[0]["values"])
 
             if (filter_type == "catalog" or filter_type == "package") and interpret_as == "list":
                 if n_filter_values > 1:
                     #Called when browsing the search UI for example
-                    results, resultDetails = self.getSummaryMetricsPerCatalog(filter_by[0]["values"], filter_type)
+                    results, resultDetails = self.getSummaryMetricsPerCatalog(context, filter_by[0]["values"], filter_type)
 
             if (filter_type == "repository") and interpret_as == "list":
-                results, resultDetails = self.getMetricsPerRepository(filter_by[0]["values"][0])
+                results, resultDetails = self.getMetricsPerRepository(context, filter_by[0]["values"][0])
 
             if (filter_type == "user") and interpret_as == "list":
                 # Called when generating metrics for a specific user
-                results, resultDetails = self.getMetricsPerUser(filter_by[0]["values"])
+                results, resultDetails = self.getMetricsPerUser(context, filter_by[0]["values"])
 
             if (filter_type == "group") and interpret_as == "list":
                 # Called when generating metrics for a specific user
-                results, resultDetails = self.getMetricsPerGroup(filter_by[0]["values"])
+                results, resultDetails = self.getMetricsPerGroup(context, filter_by[0]["values"])
 
             if (filter_type == "portal") and interpret_as == "list":
                 collectionQueryFilterObject = {}
@@ -153,34 +615,72 @@ class MetricsReader:
                 if ( len(collectionQueryFilterObjectList) ):
                     collectionQueryFilterObject = collectionQueryFilterObjectList[0]
                 # Called when generating metrics for a specific portal
-                results, resultDetails = self.getMetricsPerPortal(filter_by[0]["values"][0], collectionQueryFilterObject)
+                results, resultDetails = self.getMetricsPerPortal(context, filter_by[0]["values"][0], collectionQueryFilterObject)
 
-        self.response["results"] = results
-        self.response["resultDetails"] = resultDetails
+        context.response["results"] = results
+        context.response["resultDetails"] = resultDetails
         self.logger.debug("exit process_request, duration=%fsec", time.time()-t_0)
-        return self.response
+        return context.response
 
 
-    def getSummaryMetricsPerDataset(self, PIDs):
+    def getSummaryMetricsPerDataset(self, context, PIDs):
         """
         Queries the Elastic Search and retrieves the summary metrics for a given dataset.
         This information is used to populate the dataset landing pages.
+        :param context: MetricsRequestContext of the request being processed
         :param PIDs:
         :return: A dictionary containing lists of all the facets specified in the metrics_request
         """
         t_start = time.time()
         metrics_elastic_search = MetricsElasticSearch()
         metrics_elastic_search.connect()
-        PIDDict = pid_resolution.getResolvePIDs(PIDs)
+        PIDDict = self.resolvePIDs(context, PIDs)
         PIDs = PIDDict[PIDs[0]]
         t_delta = time.time() - t_start
         self.logger.debug('getSummaryMetricsPerDataset:t1=%.4f', t_delta)
 
-        obsoletes_dict = pid_resolution.getObsolescenceChain( PIDs, max_depth=1 )
+        # The obsolescence chain, the citations and the ES aggregations only depend on the
+        # resolved PIDs, they are retrieved concurrently. Each task gets its own copy of PIDs.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=DATASET_LOOKUP_WORKERS)
+        obsoletes_future = executor.submit(timing.wrap(self._timedStage), 'getSummaryMetricsPerDataset:obsolescence',
+                                           pid_resolution.getObsolescenceChain, list(PIDs), max_depth=1)
+        citations_future = executor.submit(timing.wrap(self._timedStage), 'getSummaryMetricsPerDataset:citations',
+                                           self.gatherRequestCitations, context, list(PIDs))
 
         t_delta = time.time() - t_start
         self.logger.debug('getSummaryMetricsPerDataset:t2=%.4f', t_delta)
 
+        # pid = context.response["metricsRequest"]["filterBy"][0]["values"]
+        context.response["metricsRequest"]["filterBy"][0]["values"] = PIDs
+        context.request["filterBy"][0]["values"] = context.response["metricsRequest"]["filterBy"][0]["values"]
+
+        search_body, aggregation_body, start_date, end_date = self.getDatasetAggregationQuery(context, PIDs)
+        try:
+            data = self._timedStage('getSummaryMetricsPerDataset:aggregations',
+                                    self.compositeAggregations, context, metrics_elastic_search,
+                                    search_query=search_body,
+                                    aggregation_query=aggregation_body,
+                                    start_date=datetime.strptime(start_date,'%m/%d/%Y'),
+                                    end_date=datetime.strptime(end_date,'%m/%d/%Y'))
+            obsoletes_dict = obsoletes_future.result()
+            citations = citations_future.result()
+        finally:
+            executor.shutdown(wait=False)
+
+        obsoletesDictionary = {k: str(v) for k, v in obsoletes_dict.items()}
+
+        t_delta = time.time() - t_start
+        self.logger.debug('getSummaryMetricsPerDataset:t3=%.4f', t_delta)
+        return (self.formatDataPerDataset(context, data, PIDs, obsoletesDictionary, citations=citations))
+
+
+    def getDatasetAggregationQuery(self, context, PIDs):
+        """
+        The ES query of the summary metrics of a dataset
+        :param context: MetricsRequestContext of the request being processed
+        :param PIDs: resolved identifiers of the dataset
+        :return: tuple of (search body, aggregation body, start date, end date)
+        """
         aggregatedPIDs = {}
         for i in PIDs:
             aggregatedPIDs[i] = {
@@ -271,17 +771,13 @@ class MetricsReader:
                 "aggs": aggregatedPIDs
             }
         }
-        # pid = self.response["metricsRequest"]["filterBy"][0]["values"]
-        self.response["metricsRequest"]["filterBy"][0]["values"] = PIDs
-        self.request["filterBy"][0]["values"] = self.response["metricsRequest"]["filterBy"][0]["values"]
-
         start_date = "01/01/2000"
         end_date = datetime.today().strftime('%m/%d/%Y')
 
-        if(len(self.response["metricsRequest"]["filterBy"]) > 1):
-            if (self.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" and self.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
-                start_date = self.response["metricsRequest"]["filterBy"][1]["values"][0]
-                end_date = self.response["metricsRequest"]["filterBy"][1]["values"][1]
+        if(len(context.response["metricsRequest"]["filterBy"]) > 1):
+            if (context.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" and context.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
+                start_date = context.response["metricsRequest"]["filterBy"][1]["values"][0]
+                end_date = context.response["metricsRequest"]["filterBy"][1]["values"][1]
 
             monthObject = {
                 "month": {
@@ -292,23 +788,31 @@ class MetricsReader:
                 }
             }
             aggregation_body["pid_list"]["composite"]["sources"].append(monthObject)
-        data = metrics_elastic_search.iterate_composite_aggregations(search_query=search_body,
-                                                                     aggregation_query=aggregation_body,
-                                                                     start_date=datetime.strptime(start_date,'%m/%d/%Y'),
-                                                                     end_date=datetime.strptime(end_date,'%m/%d/%Y'))
+        return search_body, aggregation_body, start_date, end_date
 
-        obsoletesDictionary = {k: str(v) for k, v in obsoletes_dict.items()}
 
-        t_delta = time.time() - t_start
-        self.logger.debug('getSummaryMetricsPerDataset:t3=%.4f', t_delta)
-        return (self.formatDataPerDataset(data, PIDs, obsoletesDictionary))
+    def _timedStage(self, name, function, *args, **kwargs):
+        """
+        Calls function and logs the time it took
+        :param name: name of the stage for the log
+        :param function: the function to call
+        :return: result of the function
+        """
+        t_0 = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.logger.debug('%s=%.4f', name, time.time() - t_0)
 
 
-    def formatDataPerDataset(self, data, PIDs, obsoletesDictionary):
+    @timing.timed(timing.STAGE_FORMAT)
+    def formatDataPerDataset(self, context, data, PIDs, obsoletesDictionary, citations=None):
         """
         Formats the data into the specified Swagger format
+        :param context: MetricsRequestContext of the request being processed
         :param data: Dictionary retrieved from the ES
         :param PIDs: List of pids
+        :param citations: (count, citations) tuple from gatherCitations, retrieved if not provided
         :return: A dictionary containing lists of all the facets specified in the metrics_request
         """
         records = {}
@@ -325,7 +829,9 @@ class MetricsReader:
         resultDetails["citations"] = []
         citationDict = {}
 
-        totalCitations,resultDetails["citations"] = self.gatherCitations(PIDs)
+        if citations is None:
+            citations = self.gatherCitations(PIDs)
+        totalCitations,resultDetails["citations"] = citations
         resultDetails["metrics_package_counts"] = self.parsePackageCounts(data, PIDs, obsoletesDictionary)
         appendedCitations = False
 
@@ -350,27 +856,27 @@ class MetricsReader:
                 citationDict[citationObject["link_publication_date"][:7]] = 1
 
 
-        if ("country" in self.response["metricsRequest"]["groupBy"]):
+        if ("country" in context.response["metricsRequest"]["groupBy"]):
             # Parse the dictionary to form the expected output in the form of lists
             for months in records:
                 appendedCitations = False
                 for country in records[months]:
                     results["months"].append(months)
                     results["country"].append(country)
-                    if("downloads" in self.response["metricsRequest"]["metrics"]):
+                    if("downloads" in context.response["metricsRequest"]["metrics"]):
                         if "downloads" in records[months][country]:
                             results["downloads"].append(records[months][country]["downloads"])
                         else:
                             results["downloads"].append(0)
 
                     # Views for the given time period.
-                    if ("views" in self.response["metricsRequest"]["metrics"]):
+                    if ("views" in context.response["metricsRequest"]["metrics"]):
                         if "views" in records[months][country]:
                             results["views"].append(records[months][country]["views"])
                         else:
                             results["views"].append(0)
 
-                    if ("citations" in self.response["metricsRequest"]["metrics"]):
+                    if ("citations" in context.response["metricsRequest"]["metrics"]):
                         if(not appendedCitations):
                             citationCount = 0
                             if(months in citationDict):
@@ -391,13 +897,13 @@ class MetricsReader:
                         totalViews = totalViews + records[months][country]["views"]
 
 
-                if("downloads" in self.response["metricsRequest"]["metrics"]):
+                if("downloads" in context.response["metricsRequest"]["metrics"]):
                     results["downloads"].append(totalDownloads)
 
-                if ("views" in self.response["metricsRequest"]["metrics"]):
+                if ("views" in context.response["metricsRequest"]["metrics"]):
                     results["views"].append(totalViews)
 
-                if ("citations" in self.response["metricsRequest"]["metrics"]):
+                if ("citations" in context.response["metricsRequest"]["metrics"]):
                     if months in citationDict:
                         results["citations"].append(citationDict[months])
                     else:
@@ -406,60 +912,52 @@ class MetricsReader:
         for months, totals in citationDict.items():
             if months not in results["months"]:
                 results["months"].append(months)
-                if("country" in self.response["metricsRequest"]["groupBy"]):
+                if("country" in context.response["metricsRequest"]["groupBy"]):
                     results["country"].append("US")
-                if ("downloads" in self.response["metricsRequest"]["metrics"]):
+                if ("downloads" in context.response["metricsRequest"]["metrics"]):
                     results["downloads"].append(0)
 
-                if ("views" in self.response["metricsRequest"]["metrics"]):
+                if ("views" in context.response["metricsRequest"]["metrics"]):
                     results["views"].append(0)
 
-                if ("citations" in self.response["metricsRequest"]["metrics"]):
+                if ("citations" in context.response["metricsRequest"]["metrics"]):
                     results["citations"].append(totals)
 
         return results, resultDetails
 
 
+    @timing.timed(timing.STAGE_CITATIONS)
     def gatherCitations(self, PIDs, metrics_database=None):
+        if metrics_database is None:
+            # Borrow a pooled connection for the duration of the lookup
+            metrics_database = MetricsDatabase()
+            with metrics_database.pooledConnection():
+                return self.gatherCitations(PIDs, metrics_database=metrics_database)
+
         # Retreive the citations if any!
         t_0 = time.time()
         self.logger.debug("enter gatherCitations")
         self.logger.debug("enter gatherCitations")
-        if metrics_database is None:
-            metrics_database = MetricsDatabase()
-            metrics_database.connect()
-        csr = metrics_database.getCursor()
-        sql = 'SELECT target_id,source_id,source_url,link_publication_date,origin,title,publisher,journal,volume,page,year_of_publishing FROM citations;'
-
         citations = []
         citationCount = 0
         try:
-            csr.execute(sql)
-            rows = csr.fetchall()
-
-            for i in rows:
+            index = citationindex.getCitationIndex(metrics_database, table="citations", columns=CITATION_COLUMNS)
+            # Each citing row is returned once, in table order
+            for i in index.match(PIDs):
                 citationObject = {}
-                for j in PIDs:
-                    # Special use case for Dryad datasets.
-                    if ('?' in j.lower()):
-                        j = j.split("?")[0]
-                    if i[0].lower() in j.lower():
-
-                        citationCount = citationCount + 1
-                        citationObject["target_id"] = i[0]
-                        citationObject["source_id"] = i[1]
-                        citationObject["source_url"] = i[2]
-                        citationObject["link_publication_date"] = i[3]
-                        citationObject["origin"] = i[4]
-                        citationObject["title"] = i[5]
-                        citationObject["publisher"] = i[6]
-                        citationObject["journal"] = i[7]
-                        citationObject["volume"] = i[8]
-                        citationObject["page"] = i[9]
-                        citationObject["year_of_publishing"] = i[10]
-                        citations.append(citationObject)
-                        # We don't want to add duplicate citations for all the objects of the dataset
-                        break
+                citationCount = citationCount + 1
+                citationObject["target_id"] = i[0]
+                citationObject["source_id"] = i[1]
+                citationObject["source_url"] = i[2]
+                citationObject["link_publication_date"] = i[3]
+                citationObject["origin"] = i[4]
+                citationObject["title"] = i[5]
+                citationObject["publisher"] = i[6]
+                citationObject["journal"] = i[7]
+                citationObject["volume"] = i[8]
+                citationObject["page"] = i[9]
+                citationObject["year_of_publishing"] = i[10]
+                citations.append(citationObject)
         except Exception as e:
             print('Database error!\n{0}', e)
         finally:
@@ -468,10 +966,11 @@ class MetricsReader:
         return (citationCount, citations)
 
 
-    def getSummaryMetricsPerCatalog(self, requestPIDArray, a_type):
+    def getSummaryMetricsPerCatalog(self, context, requestPIDArray, a_type):
         """
         Queries the Elastic Search and retrieves the summary metrics for a given DataCatalog pid Array.
         This information is used to populate the DataCatalog and Search pages.
+        :param context: MetricsRequestContext of the request being processed
         :param requestPIDArray: Array of PIDs of datasets on DataCatalog page or Search page
         :return:
         """
@@ -484,13 +983,13 @@ class MetricsReader:
                 catalogPIDs[i] = []
                 catalogPIDs[i].append(i)
 
-        self.catalogPIDs = catalogPIDs
+        context.catalogPIDs = catalogPIDs
 
         return_dict = {}
 
         self.logger.debug("getSummaryMetricsPerCatalog #004")
         if a_type == "catalog":
-          return_dict = pid_resolution.getResolvePIDs(catalogPIDs)
+          return_dict = self.resolvePIDs(context, catalogPIDs)
         elif a_type == "package":
           return_dict = pid_resolution.getObsolescenceChain(catalogPIDs)
         #    PIDs = self.resolvePackagePIDs([PID, ], req_session=req_session)
@@ -507,6 +1006,31 @@ class MetricsReader:
         for i in catalogPIDs:
             combinedPIDs.extend(catalogPIDs[i])
 
+        metrics_elastic_search = MetricsElasticSearch()
+        metrics_elastic_search.connect()
+        search_body, aggregation_body, start_date, end_date = self.getCatalogAggregationQuery(catalogPIDs,
+                                                                                             combinedPIDs)
+
+        pages = self.compositeAggregationPages(context, metrics_elastic_search, search_query=search_body,
+                                               aggregation_query=aggregation_body,
+                                               start_date=datetime.strptime(start_date, '%m/%d/%Y'),
+                                               end_date=datetime.strptime(end_date, '%m/%d/%Y'))
+        buckets = itertools.chain.from_iterable(page_buckets for response, page_buckets in pages)
+
+        # return {}, {}
+        # return data, return_dict
+        results = self.formatDataPerCatalog(buckets, catalogPIDs, context=context)
+        self.logger.debug("exit getSummaryMetricsPerCatalog, duration=%fsec", time.time()-t_0)
+        return results
+
+
+    def getCatalogAggregationQuery(self, catalogPIDs, combinedPIDs):
+        """
+        The ES query of the summary metrics of the datasets of a catalog page
+        :param catalogPIDs: Dictionary of requested PIDs to their resolved identifiers
+        :param combinedPIDs: all the resolved identifiers
+        :return: tuple of (search body, aggregation body, start date, end date)
+        """
         aggregatedPIDs = {}
         for i in catalogPIDs:
             aggregatedPIDs[i] = {
@@ -529,8 +1053,6 @@ class MetricsReader:
             }
 
         # Setting the query for the data catalog page
-        metrics_elastic_search = MetricsElasticSearch()
-        metrics_elastic_search.connect()
         search_body = [
             {
                 "term": {"event.key": "read"}
@@ -574,20 +1096,18 @@ class MetricsReader:
 
         start_date = "01/01/2012"
         end_date = datetime.today().strftime('%m/%d/%Y')
-
-        data = metrics_elastic_search.iterate_composite_aggregations(search_query=search_body,
-                                                                     aggregation_query=aggregation_body,
-                                                                     start_date=datetime.strptime(start_date,
-                                                                                                  '%m/%d/%Y'),
-                                                                     end_date=datetime.strptime(end_date, '%m/%d/%Y'))
-
-        # return {}, {}
-        # return data, return_dict
-        self.logger.debug("exit getSummaryMetricsPerCatalog, duration=%fsec", time.time()-t_0)
-        return (self.formatDataPerCatalog(data, catalogPIDs))
+        return search_body, aggregation_body, start_date, end_date
 
 
-    def formatDataPerCatalog(self, data, catalogPIDs):
+    @timing.timed(timing.STAGE_FORMAT)
+    def formatDataPerCatalog(self, buckets, catalogPIDs, context=None):
+        """
+        Formats the per format buckets of the catalog aggregation
+        :param buckets: iterable of the composite aggregation buckets, may be consumed page by page
+        :param catalogPIDs: Dictionary of requested PIDs to their resolved identifiers
+        :param context: MetricsRequestContext of the request being processed
+        :return:
+        """
         dataCounts = {}
         metadataCounts = {}
         downloads = []
@@ -603,12 +1123,12 @@ class MetricsReader:
         }
 
         metrics_database = MetricsDatabase()
-        metrics_database.connect()
-        for i in catalogPIDs:
-            count, cits = self.gatherCitations(catalogPIDs[i], metrics_database=metrics_database)
-            results["citations"].append(count)
+        with metrics_database.pooledConnection():
+            for i in catalogPIDs:
+                count, cits = self.gatherRequestCitations(context, catalogPIDs[i], metrics_database=metrics_database)
+                results["citations"].append(count)
 
-        for i in data["aggregations"]["pid_list"]["buckets"]:
+        for i in buckets:
             if i["key"]["format"] == "DATA":
                 dataCounts = i
             if i["key"]["format"] == "METADATA":
@@ -670,10 +1190,36 @@ class MetricsReader:
         return resultDict
 
 
-    def getMetricsPerRepository(self, nodeId):
+    def getCompositeAggregations(self, metrics_elastic_search, entity_type, entity_id, start_date, end_date,
+                                 search_query, aggregation_query):
+        """
+        Retrieves the composite aggregations of an entity, reusing the cached aggregations
+        of the closed months of the range when the aggregate cache is enabled.
+        :param metrics_elastic_search: connected MetricsElasticSearch
+        :param entity_type: repository, portal or user
+        :param entity_id: identifier of the entity
+        :param start_date: begin of the date range
+        :param end_date: end of the date range, included
+        :param search_query: ES search body
+        :param aggregation_query: ES aggregation body
+        :return: ES response structure with all the buckets of the range
+        """
+        if not self._config["aggregate_cache_enabled"]:
+            return metrics_elastic_search.iterate_composite_aggregations_sliced(search_query=search_query,
+                                                                                aggregation_query=aggregation_query,
+                                                                                start_date=start_date,
+                                                                                end_date=end_date)
+        return self._aggregate_cache.compositeAggregations(metrics_elastic_search, entity_type, entity_id,
+                                                           start_date, end_date,
+                                                           search_query=search_query,
+                                                           aggregation_query=aggregation_query)
+
+
+    def getMetricsPerRepository(self, context, nodeId):
         """
         Retrieves the metrics stats per repository
         Uses NodeID as repository ID
+        :param context: MetricsRequestContext of the request being processed
         :param: NodeId: Repository identifier to look up the metrics in the ES
         :return:
             Formatted Metrics Resonse object in JSON format
@@ -685,11 +1231,11 @@ class MetricsReader:
         metrics_elastic_search.connect()
 
         includeCitations, includeDownloads, includeViews = False, False, False
-        if "citations" in self.response["metricsRequest"]["metrics"]:
+        if "citations" in context.response["metricsRequest"]["metrics"]:
             includeCitations = True
-        if "downloads" in self.response["metricsRequest"]["metrics"]:
+        if "downloads" in context.response["metricsRequest"]["metrics"]:
             includeDownloads = True
-        if "views" in self.response["metricsRequest"]["metrics"]:
+        if "views" in context.response["metricsRequest"]["metrics"]:
             includeViews = True
 
         t_delta = time.time() - t_start
@@ -700,24 +1246,17 @@ class MetricsReader:
         end_date = datetime.today().strftime('%m/%d/%Y')
 
         # update the date range if supplied in the query
-        if (len(self.response["metricsRequest"]["filterBy"]) > 0):
-            if ((self.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" or
-                    self.response["metricsRequest"]["filterBy"][1]["filterType"] == "day" or
-                    self.response["metricsRequest"]["filterBy"][1]["filterType"] == "year") and
-                    self.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
-                start_date = self.response["metricsRequest"]["filterBy"][1]["values"][0]
-                end_date = self.response["metricsRequest"]["filterBy"][1]["values"][1]
+        if (len(context.response["metricsRequest"]["filterBy"]) > 0):
+            if ((context.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" or
+                    context.response["metricsRequest"]["filterBy"][1]["filterType"] == "day" or
+                    context.response["metricsRequest"]["filterBy"][1]["filterType"] == "year") and
+                    context.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
+                start_date = context.response["metricsRequest"]["filterBy"][1]["values"][0]
+                end_date = context.response["metricsRequest"]["filterBy"][1]["values"][1]
 
         # Get the aggregation Type
         # default it to months
-        aggType = "month"
-        if (len(self.response["metricsRequest"]["groupBy"]) > 0):
-            if "months" in self.response["metricsRequest"]["groupBy"]:
-                aggType = "month"
-            elif "days" in self.response["metricsRequest"]["groupBy"]:
-                aggType = "day"
-            elif "years" in self.response["metricsRequest"]["groupBy"]:
-                aggType = "year"
+        aggType = periodformatter.getAggregationType(context.response["metricsRequest"]["groupBy"])
         self.logger.debug('aggType: %s', aggType)
 
         data = {}
@@ -784,7 +1323,7 @@ class MetricsReader:
             self.logger.debug('aggregation_body', aggregation_body)
 
             # if the aggregation is requested by country, add country object to groupBy
-            if ("country" in self.response["metricsRequest"]["groupBy"]):
+            if ("country" in context.response["metricsRequest"]["groupBy"]):
                 countryObject = {
                     "country": {
                         "terms": {
@@ -797,12 +1336,12 @@ class MetricsReader:
 
             # Query the ES with the designed Search and Aggregation body
             # uses the start_date and the end_date for the time range of data retrieval
-            data = metrics_elastic_search.iterate_composite_aggregations(search_query=search_body,
-                                                                         aggregation_query=aggregation_body,
-                                                                         start_date=datetime.strptime(start_date,
-                                                                                                      '%m/%d/%Y'),
-                                                                         end_date=datetime.strptime(end_date,
-                                                                                                    '%m/%d/%Y'))
+            # The range is sliced by time and the slices are aggregated concurrently
+            data = self.getCompositeAggregations(metrics_elastic_search, "repository", nodeId,
+                                                 search_query=search_body,
+                                                 aggregation_query=aggregation_body,
+                                                 start_date=datetime.strptime(start_date, '%m/%d/%Y'),
+                                                 end_date=datetime.strptime(end_date, '%m/%d/%Y'))
 
         t_delta = time.time() - t_start
         self.logger.debug('getMetricsPerRepository:t3=%.4f', t_delta)
@@ -810,9 +1349,10 @@ class MetricsReader:
         node_list = []
         node_list.append(nodeId)
 
-        return (self.formatElasticSearchResults(data, node_list, start_date, end_date, aggregationType=aggType, objectType="repository"))
+        return (self.formatElasticSearchResults(context, data, node_list, start_date, end_date, aggregationType=aggType, objectType="repository"))
 
 
+    @timing.timed(timing.STAGE_CITATIONS)
     def getRepositoryCitationPIDs(self, nodeId):
         """
 
@@ -822,31 +1362,31 @@ class MetricsReader:
         t_0 = time.time()
         self.logger.debug("enter getRepositoryCitationPIDs")
         metrics_database = MetricsDatabase()
-        metrics_database.connect()
-        csr = metrics_database.getCursor()
-        if nodeId == "urn:node:CN":
-            sql = 'SELECT target_id, origin, title, datePublished, dateUploaded, dateModified FROM citation_metadata;'
-        else:
-            sql = 'SELECT target_id, origin, title, datePublished, dateUploaded, dateModified FROM citation_metadata WHERE \''+ nodeId +'\' = ANY (node_id);'
-
-        results = []
-        target_citation_metadata = {}
-        citationCount = 0
-        try:
-            csr.execute(sql)
-            rows = csr.fetchall()
-            for i in rows:
-                results.append(i[0])
-                target_citation_metadata[i[0]] = {}
-                target_citation_metadata[i[0]]["origin"] = i[1]
-                target_citation_metadata[i[0]]["title"] = i[2]
-                target_citation_metadata[i[0]]["datePublished"] = i[3]
-                target_citation_metadata[i[0]]["dateUploaded"] = i[4]
-                target_citation_metadata[i[0]]["dateModified"] = i[5]
-        except Exception as e:
-            print('Database error!\n{0}', e)
-        finally:
-            pass
+        with metrics_database.pooledConnection():
+            csr = metrics_database.getCursor()
+            if nodeId == "urn:node:CN":
+                sql = 'SELECT target_id, origin, title, datePublished, dateUploaded, dateModified FROM citation_metadata;'
+            else:
+                sql = 'SELECT target_id, origin, title, datePublished, dateUploaded, dateModified FROM citation_metadata WHERE \''+ nodeId +'\' = ANY (node_id);'
+
+            results = []
+            target_citation_metadata = {}
+            citationCount = 0
+            try:
+                csr.execute(sql)
+                rows = csr.fetchall()
+                for i in rows:
+                    results.append(i[0])
+                    target_citation_metadata[i[0]] = {}
+                    target_citation_metadata[i[0]]["origin"] = i[1]
+                    target_citation_metadata[i[0]]["title"] = i[2]
+                    target_citation_metadata[i[0]]["datePublished"] = i[3]
+                    target_citation_metadata[i[0]]["dateUploaded"] = i[4]
+                    target_citation_metadata[i[0]]["dateModified"] = i[5]
+            except Exception as e:
+                print('Database error!\n{0}', e)
+            finally:
+                pass
         self.logger.debug("exit getRepositoryCitationPIDs, elapsed=%fsec", time.time() - t_0)
         return results, target_citation_metadata
 
@@ -876,10 +1416,11 @@ class MetricsReader:
       return term
 
 
-    def getMetricsPerUser(self, requestPIDArray):
+    def getMetricsPerUser(self, context, requestPIDArray):
         """
             Retrieves the metrics stats per user
             Uses set of dataset identifiers as userID for now
+            :param context: MetricsRequestContext of the request being processed
             :param: requestPIDArray - set of dataset identifiers that belongs to the user
             :return:
                 Formatted Metrics Resonse object in JSON format
@@ -900,7 +1441,7 @@ class MetricsReader:
                 userPIDs[i] = []
                 userPIDs[i].append(i)
 
-        self.userPIDs = userPIDs
+        context.userPIDs = userPIDs
 
         t_resolve_start = time.time() - t_start
 
@@ -915,10 +1456,10 @@ class MetricsReader:
         for i in userPIDs:
             combinedPIDs.extend(userPIDs[i])
 
-        if (len(self.response["metricsRequest"]["filterBy"]) > 1):
-            if (self.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" and
-                        self.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
-                start_date = self.response["metricsRequest"]["filterBy"][1]["values"][0]
+        if (len(context.response["metricsRequest"]["filterBy"]) > 1):
+            if (context.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" and
+                        context.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
+                start_date = context.response["metricsRequest"]["filterBy"][1]["values"][0]
             else:
                 start_date = "01/01/2012"
         else:
@@ -927,8 +1468,6 @@ class MetricsReader:
 
 
         # Setting the query for the user profile
-        metrics_elastic_search = MetricsElasticSearch()
-        metrics_elastic_search.connect()
         search_body = [
             {
                 "term": {"event.key": "read"}
@@ -989,20 +1528,22 @@ class MetricsReader:
 
         t_es_start = time.time() - t_start
 
-        data = metrics_elastic_search.iterate_composite_aggregations(search_query=search_body,
-                                                                     aggregation_query=aggregation_body,
-                                                                     start_date=datetime.strptime(start_date,
-                                                                                                  '%m/%d/%Y'),
-                                                                     end_date=datetime.strptime(end_date, '%m/%d/%Y'))
+        userId = hashlib.sha1("\n".join(sorted(combinedPIDs)).encode("utf-8")).hexdigest()
+        data = self.getCompositeAggregations(metrics_elastic_search, "user", userId,
+                                             search_query=search_body,
+                                             aggregation_query=aggregation_body,
+                                             start_date=datetime.strptime(start_date, '%m/%d/%Y'),
+                                             end_date=datetime.strptime(end_date, '%m/%d/%Y'))
 
         t_es_end = time.time() - t_start
 
-        self.response["resolve_time"] = t_resolve_end - t_resolve_start
-        self.response["es_time"] = t_es_end - t_es_start
+        context.response["resolve_time"] = t_resolve_end - t_resolve_start
+        context.response["es_time"] = t_es_end - t_es_start
 
         return (self.formatDataPerUser(data, combinedPIDs, start_date, end_date))
 
 
+    @timing.timed(timing.STAGE_FORMAT)
     def formatDataPerUser(self, data, citation_pids, start_date, end_date):
         """
         Formats the results retrieved from the Elastic Search and returns it as a HTTP response
@@ -1013,67 +1554,28 @@ class MetricsReader:
         :return:
             A tuple of formatted JSON response objects containing the metrics corresponding metadata.
         """
-        results = {
-            "months": [],
-            "downloads": [],
-            "views": [],
-            "citations": [],
-        }
-
-        # Getting the months between the two given dates:
         start = datetime.strptime(start_date, "%m/%d/%Y")
         end = datetime.strptime(end_date, "%m/%d/%Y")
 
-        # Getting a list of all the months possible for the user
-        # And initializing the corresponding metrics array
-        results["months"] = list(
-            OrderedDict(((start + timedelta(_)).strftime('%Y-%m'), None) for _ in range((end - start).days)).keys())
-        results["downloads"] = [0] * len(results["months"])
-        results["views"] = [0] * len(results["months"])
-        results["citations"] = [0] * len(results["months"])
-
         # Gathering Citations
         resultDetails = {}
-        resultDetails["citations"] = []
-        citationDict = {}
         totalCitations, resultDetails["citations"] = self.gatherCitations(citation_pids)
+        period = periodformatter.PERIODS["month"]
+        citationDict = periodformatter.countCitationLabels(period, resultDetails["citations"])
 
-        for citationObject in resultDetails["citations"]:
-            if (citationObject["link_publication_date"][:7] in citationDict):
-                citationDict[citationObject["link_publication_date"][:7]] = citationDict[
-                                                                                citationObject["link_publication_date"][
-                                                                                :7]] + 1
-            else:
-                citationDict[citationObject["link_publication_date"][:7]] = 1
-
-        # Formatting the response from ES
-        for i in data["aggregations"]["pid_list"]["buckets"]:
-            months = datetime.utcfromtimestamp((i["key"]["month"] // 1000)).strftime(('%Y-%m'))
-            month_index = results["months"].index(months)
-            if i["key"]["format"] == "DATA":
-                results["downloads"][month_index] += i["unique_doc_count"]["value"]
-            elif i["key"]["format"] == "METADATA":
-                results["views"][month_index] += i["unique_doc_count"]["value"]
-            else:
-                pass
-
-        for months in citationDict:
-            if months in results["months"]:
-                month_index = results["months"].index(months)
-                results["citations"][month_index] = citationDict[months]
-            else:
-                results["months"].append(months)
-                results["views"].append(0)
-                results["downloads"].append(0)
-                results["citations"][month_index] = citationDict[months]
+        # Every month of the date range, followed by the months that only have citations
+        results, totalDownloads, totalViews = periodformatter.formatBuckets(
+            period, data["aggregations"]["pid_list"]["buckets"], start, end, citationDict)
+        del results["country"]
 
         return results, resultDetails
 
 
-    def getMetricsPerGroup(self, groupPIDArray):
+    def getMetricsPerGroup(self, context, groupPIDArray):
         """
             Retrieves the metrics stats per user
             Uses set of dataset identifiers as userID for now
+            :param context: MetricsRequestContext of the request being processed
             :param: requestPIDArray - set of dataset identifiers that belongs to the user
             :return:
                 Formatted Metrics Resonse object in JSON format
@@ -1093,16 +1595,16 @@ class MetricsReader:
         t_resolve_start = time.time() - t_start
 
         combinedPIDs = []
-        combinedPIDs = self.getDatasetIdentifierFamily("group", grouPID)
+        combinedPIDs = self.getDatasetIdentifierFamily(context, "group", grouPID)
 
         t_resolve_end = time.time() - t_start
 
 
 
-        if (len(self.response["metricsRequest"]["filterBy"]) > 1):
-            if (self.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" and
-                        self.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
-                start_date = self.response["metricsRequest"]["filterBy"][1]["values"][0]
+        if (len(context.response["metricsRequest"]["filterBy"]) > 1):
+            if (context.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" and
+                        context.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
+                start_date = context.response["metricsRequest"]["filterBy"][1]["values"][0]
             else:
                 start_date = "01/01/2012"
         else:
@@ -1111,8 +1613,6 @@ class MetricsReader:
 
 
         # Setting the query for the user profile
-        metrics_elastic_search = MetricsElasticSearch()
-        metrics_elastic_search.connect()
         search_body = [
             {
                 "term": {"event.key": "read"}
@@ -1174,21 +1674,23 @@ class MetricsReader:
 
         t_es_start = time.time() - t_start
 
-        data = metrics_elastic_search.iterate_composite_aggregations(search_query=search_body,
-                                                                     aggregation_query=aggregation_body,
-                                                                     start_date=datetime.strptime(start_date,
-                                                                                                  '%m/%d/%Y'),
-                                                                     end_date=datetime.strptime(end_date, '%m/%d/%Y'))
+        userId = hashlib.sha1("\n".join(sorted(combinedPIDs)).encode("utf-8")).hexdigest()
+        data = self.getCompositeAggregations(metrics_elastic_search, "user", userId,
+                                             search_query=search_body,
+                                             aggregation_query=aggregation_body,
+                                             start_date=datetime.strptime(start_date, '%m/%d/%Y'),
+                                             end_date=datetime.strptime(end_date, '%m/%d/%Y'))
 
         t_es_end = time.time() - t_start
 
-        self.response["resolve_time"] = t_resolve_end - t_resolve_start
-        self.response["es_time"] = t_es_end - t_es_start
-        self.response["combined_pids_length"] = len(combinedPIDs)
+        context.response["resolve_time"] = t_resolve_end - t_resolve_start
+        context.response["es_time"] = t_es_end - t_es_start
+        context.response["combined_pids_length"] = len(combinedPIDs)
 
         return (self.formatDataPerGroup(data, combinedPIDs, start_date, end_date))
 
 
+    @timing.timed(timing.STAGE_FORMAT)
     def formatDataPerGroup(self, data, citation_pids, start_date, end_date):
         """
         Formats the results retrieved from the Elastic Search and returns it as a HTTP response
@@ -1199,66 +1701,28 @@ class MetricsReader:
         :return:
             A tuple of formatted JSON response objects containing the metrics corresponding metadata.
         """
-        results = {
-            "months": [],
-            "downloads": [],
-            "views": [],
-            "citations": [],
-        }
-
-        # Getting the months between the two given dates:
         start = datetime.strptime(start_date, "%m/%d/%Y")
         end = datetime.strptime(end_date, "%m/%d/%Y")
 
-        # Getting a list of all the months possible for the user
-        # And initializing the corresponding metrics array
-        results["months"] = list(
-            OrderedDict(((start + timedelta(_)).strftime('%Y-%m'), None) for _ in range((end - start).days)).keys())
-        results["downloads"] = [0] * len(results["months"])
-        results["views"] = [0] * len(results["months"])
-        results["citations"] = [0] * len(results["months"])
-
         # Gathering Citations
         resultDetails = {}
-        resultDetails["citations"] = []
-        citationDict = {}
         totalCitations, resultDetails["citations"] = self.gatherCitations(citation_pids)
+        period = periodformatter.PERIODS["month"]
+        citationDict = periodformatter.countCitationLabels(period, resultDetails["citations"])
 
-        for citationObject in resultDetails["citations"]:
-            if (citationObject["link_publication_date"][:7] in citationDict):
-                citationDict[citationObject["link_publication_date"][:7]] = citationDict[
-                                                                                citationObject["link_publication_date"][
-                                                                                :7]] + 1
-            else:
-                citationDict[citationObject["link_publication_date"][:7]] = 1
-
-        # Formatting the response from ES
-        for i in data["aggregations"]["pid_list"]["buckets"]:
-            months = datetime.utcfromtimestamp((i["key"]["month"] // 1000)).strftime(('%Y-%m'))
-            month_index = results["months"].index(months)
-            if i["key"]["format"] == "DATA":
-                results["downloads"][month_index] += i["unique_doc_count"]["value"]
-            elif i["key"]["format"] == "METADATA":
-                results["views"][month_index] += i["unique_doc_count"]["value"]
-            else:
-                pass
-
-        for months in citationDict:
-            if months in results["months"]:
-                month_index = results["months"].index(months)
-                results["citations"][month_index] = citationDict[months]
-            else:
-                results["months"].append(months)
-                results["views"].append(0)
-                results["downloads"].append(0)
-                results["citations"][month_index] = citationDict[months]
+        # Every month of the date range, followed by the months that only have citations
+        results, totalDownloads, totalViews = periodformatter.formatBuckets(
+            period, data["aggregations"]["pid_list"]["buckets"], start, end, citationDict)
+        del results["country"]
 
         return results, resultDetails
 
 
-    def getDatasetIdentifierFamily(self, filter_type, filter_type_identifier):
+    @timing.timed(timing.STAGE_RESOLVE)
+    def getDatasetIdentifierFamily(self, context, filter_type, filter_type_identifier):
         """
         A method to query the new ES `identifiers-*` index
+        :param context: MetricsRequestContext of the request being processed
         :param filter_type:
         :param filter_type_identifier:
         :return:
@@ -1325,7 +1789,7 @@ class MetricsReader:
             # Try searching the identifiers index for the datasetIdentifierFamily
             results = metrics_elastic_search.getDatasetIdentifierFamily(search_query)
 
-            self.response["hits"] = len(results[0])
+            context.response["hits"] = len(results[0])
 
             if len(results) > 0:
                 combinedPIDs = []
@@ -1343,6 +1807,7 @@ class MetricsReader:
                 return (pid_resolution.getResolvePIDs(temp_array))
 
 
+    @timing.timed(timing.STAGE_RESOLVE)
     def getPortalDatasetIdentifierFamily(self, portal_pids):
         """
             Gets the dataset identifier family for PIDs that belong to a specific potal
@@ -1383,9 +1848,10 @@ class MetricsReader:
         return(datasetIdentifierFamily, results[1])
 
 
-    def getMetricsPerPortal(self, portalLabel, collectionQueryFilterObject=None):
+    def getMetricsPerPortal(self, context, portalLabel, collectionQueryFilterObject=None):
         """
             Handles the Metrics generation for a given indexed portal
+            :param context: MetricsRequestContext of the request being processed
             :param: portal label
             :returns:
                 Metrics Service response for the Metrics filter type 'portal'
@@ -1400,11 +1866,11 @@ class MetricsReader:
 
         # Setting flags abse don the query params
         includeCitations, includeDownloads, includeViews = False, False, False
-        if "citations" in self.response["metricsRequest"]["metrics"]:
+        if "citations" in context.response["metricsRequest"]["metrics"]:
             includeCitations = True
-        if "downloads" in self.response["metricsRequest"]["metrics"]:
+        if "downloads" in context.response["metricsRequest"]["metrics"]:
             includeDownloads = True
-        if "views" in self.response["metricsRequest"]["metrics"]:
+        if "views" in context.response["metricsRequest"]["metrics"]:
             includeViews = True
 
         # Defaulting date to beginnning and end timestamps
@@ -1412,24 +1878,17 @@ class MetricsReader:
         end_date = datetime.today().strftime('%m/%d/%Y')
 
         # update the date range if supplied in the query
-        if (len(self.response["metricsRequest"]["filterBy"]) > 0):
-            if ((self.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" or
-                         self.response["metricsRequest"]["filterBy"][1]["filterType"] == "day" or
-                         self.response["metricsRequest"]["filterBy"][1]["filterType"] == "year") and
-                        self.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
-                start_date = self.response["metricsRequest"]["filterBy"][1]["values"][0]
-                end_date = self.response["metricsRequest"]["filterBy"][1]["values"][1]
+        if (len(context.response["metricsRequest"]["filterBy"]) > 0):
+            if ((context.response["metricsRequest"]["filterBy"][1]["filterType"] == "month" or
+                         context.response["metricsRequest"]["filterBy"][1]["filterType"] == "day" or
+                         context.response["metricsRequest"]["filterBy"][1]["filterType"] == "year") and
+                        context.response["metricsRequest"]["filterBy"][1]["interpretAs"] == "range"):
+                start_date = context.response["metricsRequest"]["filterBy"][1]["values"][0]
+                end_date = context.response["metricsRequest"]["filterBy"][1]["values"][1]
 
                 # Get the aggregation Type
                 # default it to months
-                aggType = "month"
-                if (len(self.response["metricsRequest"]["groupBy"]) > 0):
-                    if "months" in self.response["metricsRequest"]["groupBy"]:
-                        aggType = "month"
-                    elif "days" in self.response["metricsRequest"]["groupBy"]:
-                        aggType = "day"
-                    elif "years" in self.response["metricsRequest"]["groupBy"]:
-                        aggType = "year"
+                aggType = periodformatter.getAggregationType(context.response["metricsRequest"]["groupBy"])
                 self.logger.debug('aggType: %s', aggType)
 
         t_portal_dataset_identifier_family = time.time()
@@ -1499,7 +1958,7 @@ class MetricsReader:
             }
 
             # if the aggregation is requested by country, add country object to groupBy
-            if ("country" in self.response["metricsRequest"]["groupBy"]):
+            if ("country" in context.response["metricsRequest"]["groupBy"]):
                 countryObject = {
                     "country": {
                         "terms": {
@@ -1517,20 +1976,21 @@ class MetricsReader:
 
             # Query the ES with the designed Search and Aggregation body
             # uses the start_date and the end_date for the time range of data retrieval
-            data = metrics_elastic_search.iterate_composite_aggregations(search_query=search_body,
-                                                                         aggregation_query=aggregation_body,
-                                                                         start_date=datetime.strptime(start_date,
-                                                                                                      '%m/%d/%Y'),
-                                                                         end_date=datetime.strptime(end_date,
-                                                                                                    '%m/%d/%Y'))
+            # The range is sliced by time and the slices are aggregated concurrently
+            data = self.getCompositeAggregations(metrics_elastic_search, "portal", portalSeriesId,
+                                                 search_query=search_body,
+                                                 aggregation_query=aggregation_body,
+                                                 start_date=datetime.strptime(start_date, '%m/%d/%Y'),
+                                                 end_date=datetime.strptime(end_date, '%m/%d/%Y'))
 
         requestMetadata = {}
         requestMetadata["collectionDetails"] = resultDetails
         return (
-        self.formatElasticSearchResults(data, pdif, start_date, end_date, aggregationType=aggType, objectType="portal",
+        self.formatElasticSearchResults(context, data, pdif, start_date, end_date, aggregationType=aggType, objectType="portal",
                                         requestMetadata=requestMetadata))
 
 
+    @timing.timed(timing.STAGE_CITATIONS)
     def getPortalCitationPIDs(self, seriesId):
         """
         Retrieves the cited datasets for a given portal series ID
@@ -1540,36 +2000,38 @@ class MetricsReader:
         t_0 = time.time()
         self.logger.debug("enter getPortalCitationPIDs")
         metrics_database = MetricsDatabase()
-        metrics_database.connect()
-        csr = metrics_database.getCursor()
-        sql = "SELECT target_id, origin, title, datePublished, dateUploaded, dateModified FROM citation_metadata WHERE '" + seriesId + "' = ANY (portal_id);"
-
-        results = []
-        target_citation_metadata = {}
-        citationCount = 0
-        try:
-            csr.execute(sql)
-            rows = csr.fetchall()
-            for i in rows:
-                results.append(i[0])
-                target_citation_metadata[i[0]] = {}
-                target_citation_metadata[i[0]]["origin"] = i[1]
-                target_citation_metadata[i[0]]["title"] = i[2]
-                target_citation_metadata[i[0]]["datePublished"] = i[3]
-                target_citation_metadata[i[0]]["dateUploaded"] = i[4]
-                target_citation_metadata[i[0]]["dateModified"] = i[5]
-        except Exception as e:
-            print('Database error!\n{0}', e)
-        finally:
-            pass
+        with metrics_database.pooledConnection():
+            csr = metrics_database.getCursor()
+            sql = "SELECT target_id, origin, title, datePublished, dateUploaded, dateModified FROM citation_metadata WHERE '" + seriesId + "' = ANY (portal_id);"
+
+            results = []
+            target_citation_metadata = {}
+            citationCount = 0
+            try:
+                csr.execute(sql)
+                rows = csr.fetchall()
+                for i in rows:
+                    results.append(i[0])
+                    target_citation_metadata[i[0]] = {}
+                    target_citation_metadata[i[0]]["origin"] = i[1]
+                    target_citation_metadata[i[0]]["title"] = i[2]
+                    target_citation_metadata[i[0]]["datePublished"] = i[3]
+                    target_citation_metadata[i[0]]["dateUploaded"] = i[4]
+                    target_citation_metadata[i[0]]["dateModified"] = i[5]
+            except Exception as e:
+                print('Database error!\n{0}', e)
+            finally:
+                pass
         self.logger.debug("exit getPortalCitationPIDs, elapsed=%fsec", time.time() - t_0)
         return results, target_citation_metadata
 
 
-    def formatElasticSearchResults(self, data, PIDList, start_date, end_date, aggregationType="month", objectType=None, requestMetadata={}):
+    @timing.timed(timing.STAGE_FORMAT)
+    def formatElasticSearchResults(self, context, data, PIDList, start_date, end_date, aggregationType="month", objectType=None, requestMetadata={}):
         """
         Formats the ES response to the Metrics Service response
         Checks for groupBy requirements and utilzes appropriate functions.
+        :param context: MetricsRequestContext of the request being processed
         :param: data - Dictionary object retreieved as a response from ES
         :param: PIDList - List of identifiers associated with this request
         :param: start_date
@@ -1581,62 +2043,39 @@ class MetricsReader:
             resultDetails - Dictionary object for additional information about the  Metrics Response
         """
 
-        if aggregationType == "month":
-            return (self.formatElasticSearchResultsByMonth(data, PIDList, start_date, end_date, objectType, requestMetadata))
-
-        elif aggregationType == "day":
-            return (self.formatElasticSearchResultsByDay(data, PIDList, start_date, end_date, objectType, requestMetadata))
-
-        elif aggregationType == "year":
-            return (self.formatElasticSearchResultsByYear(data, PIDList, start_date, end_date, objectType, requestMetadata))
+        if aggregationType in periodformatter.PERIODS:
+            return (self.formatElasticSearchResultsByPeriod(context, data, PIDList, start_date, end_date,
+                                                            periodformatter.PERIODS[aggregationType],
+                                                            objectType, requestMetadata))
 
         return {}, {}
 
 
-    def formatElasticSearchResultsByMonth(self, data, PIDList, start_date, end_date, objectType=None, requestMetadata={}):
+    @timing.timed(timing.STAGE_FORMAT)
+    def formatElasticSearchResultsByPeriod(self, context, data, PIDList, start_date, end_date, period, objectType=None, requestMetadata={}):
         """
-        Formats the ES response to the Metrics Service response aggregated by month
+        Formats the ES response to the Metrics Service response aggregated by a period
+        :param context: MetricsRequestContext of the request being processed
         :param: data - Dictionary object retreieved as a response from ES
         :param: PIDList - List of identifiers associated with this request
         :param: start_date
         :param: end_date
+        :param: period - periodformatter.Period of the aggregation
         :param: objectType - Type of filter object (node, portal, user, group)
         :param: requestMetadata - additional metadata assoicated with the request.
         :return:
             results - Dictionary object for Metrics Response
             resultDetails - Dictionary object for additional information about the  Metrics Response
         """
-        results = {
-            "months": [],
-            "downloads": [],
-            "views": [],
-            "citations": [],
-            "country": [],
-        }
-
         # Setting flags to filter out metrics based on the request
-        if "citations" in self.response["metricsRequest"]["metrics"]:
-            includeCitations = True
-        else:
-            includeCitations = False
-
-        if "downloads" in self.response["metricsRequest"]["metrics"]:
-            includeDownloads = True
-        else:
-            includeDownloads = False
-
-        if "views" in self.response["metricsRequest"]["metrics"]:
-            includeViews = True
-        else:
-            includeViews = False
+        includeCitations = "citations" in context.response["metricsRequest"]["metrics"]
+        includeDownloads = "downloads" in context.response["metricsRequest"]["metrics"]
+        includeViews = "views" in context.response["metricsRequest"]["metrics"]
 
-        # Getting the months between the two given dates:
+        # Setting the start date and end date provided
         start_dt = datetime.strptime(start_date, "%m/%d/%Y")
         end_dt = datetime.strptime(end_date, "%m/%d/%Y")
 
-        # append totals to resultDetails object
-        totalCitations, totalDownloads, totalViews = 0, 0, 0
-
         # Gathering Citations
         resultDetails = {}
         resultDetails["citations"] = []
@@ -1652,135 +2091,20 @@ class MetricsReader:
                 citation_pids, target_citation_metadata = self.getPortalCitationPIDs(PIDList[0])
 
             totalCitationObjects, citationDetails = self.gatherCitations(citation_pids)
+            citationDict, resultDetailsCitationObject = periodformatter.countCitations(period, citationDetails,
+                                                                                      start_dt, end_dt)
 
-            for citationObject in citationDetails:
-                citation_link_pub_date = citationObject["link_publication_date"][:7]
+        buckets = []
+        if includeViews or includeDownloads or data:
+            buckets = data["aggregations"]["pid_list"]["buckets"]
 
-                # If citations publish date is not available, assign most recent month to it.
-                if (citation_link_pub_date == None) or (citation_link_pub_date == "NULL"):
-                    citation_link_pub_date = datetime.strftime(end_dt, "%Y-%m")
-
-                # Check if the citations falls within the given time range.
-                citation_pub_date = datetime.strptime(citation_link_pub_date, "%Y-%m")
-
-                if (citation_pub_date > start_dt) and (citation_pub_date < end_dt):
-                    resultDetailsCitationObject.append(citationObject)
-                    totalCitations += 1
-                    if (citation_link_pub_date in citationDict):
-                        citationDict[citation_link_pub_date] = citationDict[citation_link_pub_date] + 1
-                    else:
-                        citationDict[citation_link_pub_date] = 1
-
-        # Check if the request is for grouping by country
-        if ("country" in self.response["metricsRequest"]["groupBy"]):
-            # resultDetails["data"] = data["aggregations"]
-            records = {}
-
-            if includeDownloads or includeViews or data:
-                # Combine metrics into a single dictionary
-                for i in data["aggregations"]["pid_list"]["buckets"]:
-                    month = datetime.utcfromtimestamp((i["key"]["month"] // 1000)).strftime(('%Y-%m'))
-
-                    # handling cases where country is null
-                    if (i["key"]["country"] is None) or (i["key"]["country"] == "null"):
-                        i["key"]["country"] = "US"
-
-                    if month not in records:
-                        records[month] = {}
-                    if i["key"]["country"] not in records[month]:
-                        records[month][i["key"]["country"]] = {}
-                    if (i["key"]["format"] == "DATA") and includeDownloads:
-                        totalDownloads += i["unique_doc_count"]["value"]
-                        records[month][i["key"]["country"]]["downloads"] = i["unique_doc_count"]["value"]
-                    if (i["key"]["format"] == "METADATA") and includeViews:
-                        totalViews += i["unique_doc_count"]["value"]
-                        records[month][i["key"]["country"]]["views"] = i["unique_doc_count"]["value"]
-                    pass
-
-            # Parse the dictionary to form the expected output in the form of lists
-            for months in records:
-                for country in records[months]:
-                    results["months"].append(months)
-                    results["country"].append(country)
-                    if includeDownloads:
-                        if "downloads" in records[months][country]:
-                            results["downloads"].append(records[months][country]["downloads"])
-                        else:
-                            results["downloads"].append(0)
-
-                    # Views for the given time period.
-                    if includeViews:
-                        if "views" in records[months][country]:
-                            results["views"].append(records[months][country]["views"])
-                        else:
-                            results["views"].append(0)
-
-                    if includeCitations:
-                        if (months in citationDict):
-                            results["citations"].append(citationDict[months])
-                        else:
-                            results["citations"].append(0)
-
-            if includeCitations:
-                for months in citationDict:
-                    if months not in results["months"]:
-                        results["months"].append(months)
-
-                        if includeViews:
-                            results["views"].append(0)
-
-                        if includeDownloads:
-                            results["downloads"].append(0)
-
-                        results["country"].append('US')
-                        results["citations"].append(citationDict[months])
-
-        # Proceed with the month facet by default for groupBy
-        else:
-
-            # Getting a list of all the months possible for the repo
-            # And initializing the corresponding metrics array
-            results["months"] = list(OrderedDict(
-                ((start_dt + timedelta(_)).strftime('%Y-%m'), None) for _ in range((end_dt - start_dt).days)).keys())
-
-            if includeDownloads:
-                results["downloads"] = [0] * len(results["months"])
-
-            if includeViews:
-                results["views"] = [0] * len(results["months"])
-
-            if includeCitations:
-                results["citations"] = [0] * len(results["months"])
-
-            if includeViews or includeDownloads or data:
-                # Formatting the response from ES
-                for i in data["aggregations"]["pid_list"]["buckets"]:
-                    months = datetime.utcfromtimestamp((i["key"]["month"] // 1000)).strftime(('%Y-%m'))
-                    month_index = results["months"].index(months)
-                    if i["key"]["format"] == "DATA" and includeDownloads:
-                        totalDownloads += i["unique_doc_count"]["value"]
-                        results["downloads"][month_index] += i["unique_doc_count"]["value"]
-                    elif i["key"]["format"] == "METADATA" and includeViews:
-                        totalViews += i["unique_doc_count"]["value"]
-                        results["views"][month_index] += i["unique_doc_count"]["value"]
-                    else:
-                        pass
-
-            if includeCitations:
-                for months in citationDict:
-                    if months in results["months"]:
-                        month_index = results["months"].index(months)
-                        results["citations"][month_index] = citationDict[months]
-                    else:
-                        results["months"].append(months)
-
-                        if includeDownloads:
-                            results["downloads"].append(0)
-
-                        if includeViews:
-                            results["views"].append(0)
-
-                        results["citations"][month_index] = citationDict[months]
+        # Fold the buckets and the citations into the series of the response
+        results, totalDownloads, totalViews = periodformatter.formatBuckets(
+            period, buckets, start_dt, end_dt, citationDict,
+            include_downloads=includeDownloads,
+            include_views=includeViews,
+            include_citations=includeCitations,
+            by_country="country" in context.response["metricsRequest"]["groupBy"])
 
         try:
             if includeCitations:
@@ -1808,462 +2132,147 @@ class MetricsReader:
             self.logger.error(e)
 
         # append totals to the resultDetails object
-        resultDetails["totalCitations"] = totalCitations
+        resultDetails["totalCitations"] = len(resultDetailsCitationObject)
         resultDetails["totalDownloads"] = totalDownloads
         resultDetails["totalViews"] = totalViews
-        resultDetails["aggType"] = "months"
+        resultDetails["aggType"] = period.plural
 
         return results, resultDetails
 
 
-    def formatElasticSearchResultsByDay(self, data, PIDList, start_date, end_date, objectType=None, requestMetadata={}):
-        """
-        Formats the ES response to the Metrics Service response aggregated by days
-        :param: data - Dictionary object retreieved as a response from ES
-        :param: PIDList - List of identifiers associated with this request
-        :param: start_date
-        :param: end_date
-        :param: objectType - Type of filter object (node, portal, user, group)
-        :param: requestMetadata - additional metadata assoicated with the request.
-        :return:
-            results - Dictionary object for Metrics Response
-            resultDetails - Dictionary object for additional information about the  Metrics Response
-        """
-        results = {
-            "days": [],
-            "downloads": [],
-            "views": [],
-            "citations": [],
-            "country": [],
-        }
-
-        # Setting flags to filter out metrics based on the request
-        if "citations" in self.response["metricsRequest"]["metrics"]:
-            includeCitations = True
-        else:
-            includeCitations = False
-
-        if "downloads" in self.response["metricsRequest"]["metrics"]:
-            includeDownloads = True
-        else:
-            includeDownloads = False
-
-        if "views" in self.response["metricsRequest"]["metrics"]:
-            includeViews = True
-        else:
-            includeViews = False
-
-        # Setting the start date and end date provided
-        start_dt = datetime.strptime(start_date, "%m/%d/%Y")
-        end_dt = datetime.strptime(end_date, "%m/%d/%Y")
-
-        # append totals to resultDetails object
-        totalCitations, totalDownloads, totalViews = 0, 0, 0
-
-        # Gathering Citations
-        resultDetails = {}
-        resultDetails["citations"] = []
-        citationDict = {}
-        resultDetailsCitationObject = []
-
-        if includeCitations:
-            if objectType == "repository":
-                citation_pids, target_citation_metadata = self.getRepositoryCitationPIDs(PIDList[0])
-
-            if objectType == "portal":
-                resultDetails["collectionDetails"] = requestMetadata["collectionDetails"]
-                citation_pids, target_citation_metadata = self.getPortalCitationPIDs(PIDList[0])
-
-            totalCitationObjects, citationDetails = self.gatherCitations(citation_pids)
-
-            for citationObject in citationDetails:
-                citation_link_pub_date = citationObject["link_publication_date"]
-
-                # If citations publish date is not available, assign most recent days to it.
-                if (citation_link_pub_date == None) or (citation_link_pub_date == "NULL"):
-                    citation_link_pub_date = datetime.strftime(end_dt, "%Y-%m-%d")
-
-                # Check if the citations falls within the given time range.
-                citation_pub_date = datetime.strptime(citation_link_pub_date, "%Y-%m-%d")
-                if (citation_pub_date > start_dt) and (citation_pub_date < end_dt):
-                    resultDetailsCitationObject.append(citationObject)
-                    totalCitations += 1
-                    if (citation_link_pub_date in citationDict):
-                        citationDict[citation_link_pub_date] = citationDict[citation_link_pub_date] + 1
-                    else:
-                        citationDict[citation_link_pub_date] = 1
-
-        # Check if the request is for grouping by country
-        if ("country" in self.response["metricsRequest"]["groupBy"]):
-            # resultDetails["data"] = data["aggregations"]
-            records = {}
-
-            if includeDownloads or includeViews or data:
-                # Combine metrics into a single dictionary
-                for i in data["aggregations"]["pid_list"]["buckets"]:
-                    days = datetime.utcfromtimestamp((i["key"]["day"] // 1000)).strftime(('%Y-%m-%d'))
-
-                    # handling cases where country is null
-                    if (i["key"]["country"] is None) or (i["key"]["country"] == "null"):
-                        i["key"]["country"] = "US"
-
-                    if days not in records:
-                        records[days] = {}
-                    if i["key"]["country"] not in records[days]:
-                        records[days][i["key"]["country"]] = {}
-                    if (i["key"]["format"] == "DATA") and includeDownloads:
-                        totalDownloads += i["unique_doc_count"]["value"]
-                        records[days][i["key"]["country"]]["downloads"] = i["unique_doc_count"]["value"]
-                    if (i["key"]["format"] == "METADATA") and includeViews:
-                        totalViews += i["unique_doc_count"]["value"]
-                        records[days][i["key"]["country"]]["views"] = i["unique_doc_count"]["value"]
-                    pass
-
-            # Parse the dictionary to form the expected output in the form of lists
-            for days in records:
-                for country in records[days]:
-                    results["days"].append(days)
-                    results["country"].append(country)
-                    if includeDownloads:
-                        if "downloads" in records[days][country]:
-                            results["downloads"].append(records[days][country]["downloads"])
-                        else:
-                            results["downloads"].append(0)
-
-                    # Views for the given time period.
-                    if includeViews:
-                        if "views" in records[days][country]:
-                            results["views"].append(records[days][country]["views"])
-                        else:
-                            results["views"].append(0)
-
-                    if includeCitations:
-                        if (days in citationDict):
-                            results["citations"].append(citationDict[days])
-                        else:
-                            results["citations"].append(0)
-
-            if includeCitations:
-                for days in citationDict:
-                    if days not in results["days"]:
-                        results["days"].append(days)
-
-                        if includeViews:
-                            results["views"].append(0)
-
-                        if includeDownloads:
-                            results["downloads"].append(0)
-
-                        results["country"].append('US')
-                        results["citations"].append(citationDict[days])
-
-        # Proceed with the days facet by default for groupBy
-        else:
-
-            # Getting a list of all the days possible for the repo
-            # And initializing the corresponding metrics array
-            results["days"] = list(OrderedDict(
-                ((start_dt + timedelta(_)).strftime('%Y-%m-%d'), None) for _ in range((end_dt - start_dt).days)).keys())
-
-            if includeDownloads:
-                results["downloads"] = [0] * len(results["days"])
-
-            if includeViews:
-                results["views"] = [0] * len(results["days"])
-
-            if includeCitations:
-                results["citations"] = [0] * len(results["days"])
-
-            if includeViews or includeDownloads or data:
-                # Formatting the response from ES
-                for i in data["aggregations"]["pid_list"]["buckets"]:
-                    days = datetime.utcfromtimestamp((i["key"]["day"] // 1000)).strftime(('%Y-%m-%d'))
-                    day_index = results["days"].index(days)
-                    if i["key"]["format"] == "DATA" and includeDownloads:
-                        totalDownloads += i["unique_doc_count"]["value"]
-                        results["downloads"][day_index] += i["unique_doc_count"]["value"]
-                    elif i["key"]["format"] == "METADATA" and includeViews:
-                        totalViews += i["unique_doc_count"]["value"]
-                        results["views"][day_index] += i["unique_doc_count"]["value"]
-                    else:
-                        pass
-
-            if includeCitations:
-                for days in citationDict:
-                    if days in results["days"]:
-                        day_index = results["days"].index(days)
-                        results["citations"][day_index] = citationDict[days]
-                    else:
-                        results["days"].append(days)
-
-                        if includeDownloads:
-                            results["downloads"].append(0)
-
-                        if includeViews:
-                            results["views"].append(0)
-
-                        results["citations"][day_index] = citationDict[days]
-
-        try:
-            if includeCitations:
-                # Returning citations and dataset links in resultDetails object
-                targetSourceDict = {}
-                for i in resultDetailsCitationObject:
-                    if i["source_id"] not in targetSourceDict:
-                        targetSourceDict[i["source_id"]] = {}
-                        targetSourceDict[i["source_id"]]["target_id"] = []
-                        targetSourceDict[i["source_id"]]["target_id"].append(i["target_id"])
-                    else:
-                        targetSourceDict[i["source_id"]]["target_id"].append(i["target_id"])
-                    for k, v in i.items():
-                        if k != "target_id":
-                            targetSourceDict[i["source_id"]][k] = v
-                    targetSourceDict[i["source_id"]]["citationMetadata"] = {}
-
-                for source_id in targetSourceDict:
-                    for each_target in targetSourceDict[source_id]["target_id"]:
-                        targetSourceDict[source_id]["citationMetadata"][each_target] = {}
-                        targetSourceDict[source_id]["citationMetadata"][each_target] = target_citation_metadata[
-                            each_target]
-                resultDetails["citations"] = targetSourceDict
-        except Exception as e:
-            resultDetails["citations"] = {}
-            self.logger.error(e)
+class MetricsBatchReader:
+    """
+    Evaluates a batch of metricsRequests in one call. The body of the POST request is an
+    array of metricsRequest objects, or an object with that array as "metricsRequests".
+    The response has the metricsResponses in the same order.
+    """
 
-        # append totals to the resultDetails object
-        resultDetails["totalCitations"] = totalCitations
-        resultDetails["totalDownloads"] = totalDownloads
-        resultDetails["totalViews"] = totalViews
-        resultDetails["aggType"] = "days"
+    telemetry_filter_type = "batch"
 
-        return results, resultDetails
+    def __init__(self, metrics_reader):
+        self._metrics_reader = metrics_reader
+        self._config = DEFAULT_REPORT_CONFIGURATION
+        self.logger = logging.getLogger('metrics_service.' + __name__)
 
 
-    def formatElasticSearchResultsByYear(self, data, PIDList, start_date, end_date, objectType=None, requestMetadata={}):
+    def on_post(self, req, resp):
         """
-        Formats the ES response to the Metrics Service response aggregated by years
-        :param: data - Dictionary object retreieved as a response from ES
-        :param: PIDList - List of identifiers associated with this request
-        :param: start_date
-        :param: end_date
-        :param: objectType - Type of filter object (node, portal, user, group)
-        :param: requestMetadata - additional metadata assoicated with the request.
-        :return:
-            results - Dictionary object for Metrics Response
-            resultDetails - Dictionary object for additional information about the  Metrics Response
+        The method assigned to the post end point
+        :param req: HTTP Request object
+        :param resp: HTTP Response object
+        :return: HTTP Response object
         """
-        results = {
-            "years": [],
-            "downloads": [],
-            "views": [],
-            "citations": [],
-            "country": [],
-        }
-
-        # Setting flags to filter out metrics based on the request
-        if "citations" in self.response["metricsRequest"]["metrics"]:
-            includeCitations = True
-        else:
-            includeCitations = False
-
-        if "downloads" in self.response["metricsRequest"]["metrics"]:
-            includeDownloads = True
-        else:
-            includeDownloads = False
-
-        if "views" in self.response["metricsRequest"]["metrics"]:
-            includeViews = True
-        else:
-            includeViews = False
-
-        # Setting the start date and end date provided
-        start_dt = datetime.strptime(start_date, "%m/%d/%Y")
-        end_dt = datetime.strptime(end_date, "%m/%d/%Y")
-
-        # append totals to resultDetails object
-        totalCitations, totalDownloads, totalViews = 0, 0, 0
-
-        # Gathering Citations
-        resultDetails = {}
-        resultDetails["citations"] = []
-        citationDict = {}
-        resultDetailsCitationObject = []
-
-        if includeCitations:
-            if objectType == "repository":
-                citation_pids, target_citation_metadata = self.getRepositoryCitationPIDs(PIDList[0])
-
-            if objectType == "portal":
-                resultDetails["collectionDetails"] = requestMetadata["collectionDetails"]
-                citation_pids, target_citation_metadata = self.getPortalCitationPIDs(PIDList[0])
-
-            totalCitationObjects, citationDetails = self.gatherCitations(citation_pids)
-
-            for citationObject in citationDetails:
-                citation_link_pub_date = citationObject["link_publication_date"][:4]
-
-                # If citations publish date is not available, assign most recent years to it.
-                if (citation_link_pub_date == None) or (citation_link_pub_date == "NULL"):
-                    citation_link_pub_date = datetime.strftime(end_dt, "%Y")
-
-                # Check if the citations falls within the given time range.
-                citation_pub_date = datetime.strptime(citation_link_pub_date, "%Y")
-                if (citation_pub_date > start_dt) and (citation_pub_date < end_dt):
-                    resultDetailsCitationObject.append(citationObject)
-                    totalCitations += 1
-                    if (citation_link_pub_date in citationDict):
-                        citationDict[citation_link_pub_date] = citationDict[citation_link_pub_date] + 1
-                    else:
-                        citationDict[citation_link_pub_date] = 1
-
-        # Check if the request is for grouping by country
-        if ("country" in self.response["metricsRequest"]["groupBy"]):
-            # resultDetails["data"] = data["aggregations"]
-            records = {}
-
-            if includeDownloads or includeViews or data:
-                # Combine metrics into a single dictionary
-                for i in data["aggregations"]["pid_list"]["buckets"]:
-                    years = datetime.utcfromtimestamp((i["key"]["year"] // 1000)).strftime(('%Y'))
-
-                    # handling cases where country is null
-                    if (i["key"]["country"] is None) or (i["key"]["country"] == "null"):
-                        i["key"]["country"] = "US"
-
-                    if years not in records:
-                        records[years] = {}
-                    if i["key"]["country"] not in records[years]:
-                        records[years][i["key"]["country"]] = {}
-                    if (i["key"]["format"] == "DATA") and includeDownloads:
-                        totalDownloads += i["unique_doc_count"]["value"]
-                        records[years][i["key"]["country"]]["downloads"] = i["unique_doc_count"]["value"]
-                    if (i["key"]["format"] == "METADATA") and includeViews:
-                        totalViews += i["unique_doc_count"]["value"]
-                        records[years][i["key"]["country"]]["views"] = i["unique_doc_count"]["value"]
-                    pass
-
-            # Parse the dictionary to form the expected output in the form of lists
-            for years in records:
-                for country in records[years]:
-                    results["years"].append(years)
-                    results["country"].append(country)
-                    if includeDownloads:
-                        if "downloads" in records[years][country]:
-                            results["downloads"].append(records[years][country]["downloads"])
-                        else:
-                            results["downloads"].append(0)
+        self.logger.debug("enter on_post")
+        request_string = req.stream.read().decode('utf8')
 
-                    # Views for the given time period.
-                    if includeViews:
-                        if "views" in records[years][country]:
-                            results["views"].append(records[years][country]["views"])
-                        else:
-                            results["views"].append(0)
+        batch_request = json.loads(request_string)
+        metrics_requests = batch_request
+        if isinstance(batch_request, dict):
+            metrics_requests = batch_request.get("metricsRequests")
+        if not isinstance(metrics_requests, list):
+            raise falcon.HTTPBadRequest("Invalid batch", "Expected an array of metricsRequest objects")
+        if len(metrics_requests) > self._config["batch_max_requests"]:
+            raise falcon.HTTPBadRequest("Invalid batch", "A batch is limited to {0} metricsRequests".format(
+                self._config["batch_max_requests"]))
+
+        resp.data = self._metrics_reader.process_batch(metrics_requests)
+        resp.status = falcon.HTTP_200
+        self.logger.debug("exit on_post")
 
-                    if includeCitations:
-                        if (years in citationDict):
-                            results["citations"].append(citationDict[years])
-                        else:
-                            results["citations"].append(0)
 
-            if includeCitations:
-                for years in citationDict:
-                    if years not in results["years"]:
-                        results["years"].append(years)
+class MetricsJobReader:
+    """
+    Status of a metricsRequest processed in the background. Answers 202 while the job is
+    running and the MetricsResponse once it completed.
+    """
 
-                        if includeViews:
-                            results["views"].append(0)
+    # Polls are not added to the stage histograms
+    timing_exempt = True
 
-                        if includeDownloads:
-                            results["downloads"].append(0)
+    def __init__(self, metrics_reader):
+        self._metrics_reader = metrics_reader
+        self.logger = logging.getLogger('metrics_service.' + __name__)
 
-                        results["country"].append('US')
-                        results["citations"].append(citationDict[years])
 
-        # Proceed with the years facet by default for groupBy
+    def on_get(self, req, resp, job_id):
+        """
+        The method assigned to the GET end point
+        :param req: HTTP Request object
+        :param resp: HTTP Response object
+        :param job_id: id of the job
+        :return: HTTP Response object
+        """
+        self.logger.debug("enter on_get")
+        job = self._metrics_reader.getJob(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound(description="No job " + job_id)
+
+        if job["status"] == metricsjobs.JOB_DONE:
+            resp.status = job["http_status"]
+            resp.data = job["body"]
+            expiry_time, secs = responsecache.getCacheExpiry()
+            resp.set_headers({"Expires": expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")})
+        elif job["status"] == metricsjobs.JOB_FAILED:
+            resp.status = falcon.HTTP_500
+            resp.data = responsewriter.dumps({"jobId": job_id, "status": job["status"]})
         else:
+            resp.status = falcon.HTTP_202
+            resp.set_headers({"Retry-After": "5"})
+            resp.data = responsewriter.dumps({"jobId": job_id, "status": job["status"]})
+        self.logger.debug("exit on_get")
 
-            # Getting a list of all the years possible for the repo
-            # And initializing the corresponding metrics array
-            results["years"] = list(OrderedDict(
-                ((start_dt + timedelta(_)).strftime('%Y'), None) for _ in range((end_dt - start_dt).days)).keys())
-
-            if includeDownloads:
-                results["downloads"] = [0] * len(results["years"])
-
-            if includeViews:
-                results["views"] = [0] * len(results["years"])
 
-            if includeCitations:
-                results["citations"] = [0] * len(results["years"])
-
-            if includeViews or includeDownloads or data:
-                # Formatting the response from ES
-                for i in data["aggregations"]["pid_list"]["buckets"]:
-                    years = datetime.utcfromtimestamp((i["key"]["year"] // 1000)).strftime(('%Y'))
-                    year_index = results["years"].index(years)
-                    if i["key"]["format"] == "DATA" and includeDownloads:
-                        totalDownloads += i["unique_doc_count"]["value"]
-                        results["downloads"][year_index] += i["unique_doc_count"]["value"]
-                    elif i["key"]["format"] == "METADATA" and includeViews:
-                        totalViews += i["unique_doc_count"]["value"]
-                        results["views"][year_index] += i["unique_doc_count"]["value"]
-                    else:
-                        pass
-
-            if includeCitations:
-                for years in citationDict:
-                    if years in results["years"]:
-                        year_index = results["years"].index(years)
-                        results["citations"][year_index] = citationDict[years]
-                    else:
-                        results["years"].append(years)
+class PrometheusReader:
+    """
+    The metrics of the worker answering the request, in the Prometheus text exposition format.
+    """
 
-                        if includeDownloads:
-                            results["downloads"].append(0)
+    timing_exempt = True
 
-                        if includeViews:
-                            results["views"].append(0)
+    def on_get(self, req, resp):
+        """
+        The method assigned to the GET end point
+        :param req: HTTP Request object
+        :param resp: HTTP Response object
+        :return: HTTP Response object
+        """
+        resp.content_type = telemetry.CONTENT_TYPE
+        resp.data = telemetry.REGISTRY.render().encode("utf-8")
+        resp.status = falcon.HTTP_200
 
-                        results["citations"][year_index] = citationDict[years]
 
-        try:
-            if includeCitations:
-                # Returning citations and dataset links in resultDetails object
-                targetSourceDict = {}
-                for i in resultDetailsCitationObject:
-                    if i["source_id"] not in targetSourceDict:
-                        targetSourceDict[i["source_id"]] = {}
-                        targetSourceDict[i["source_id"]]["target_id"] = []
-                        targetSourceDict[i["source_id"]]["target_id"].append(i["target_id"])
-                    else:
-                        targetSourceDict[i["source_id"]]["target_id"].append(i["target_id"])
-                    for k, v in i.items():
-                        if k != "target_id":
-                            targetSourceDict[i["source_id"]][k] = v
-                    targetSourceDict[i["source_id"]]["citationMetadata"] = {}
+class MetricsStatsReader:
+    """
+    Operational counters of the worker answering the request: depth and waits of the
+    admission lanes, coalesced requests, response cache usage and, when given the
+    histograms of the ServerTimingMiddleware, the durations of the request stages.
+    """
 
-                for source_id in targetSourceDict:
-                    for each_target in targetSourceDict[source_id]["target_id"]:
-                        targetSourceDict[source_id]["citationMetadata"][each_target] = {}
-                        targetSourceDict[source_id]["citationMetadata"][each_target] = target_citation_metadata[
-                            each_target]
-                resultDetails["citations"] = targetSourceDict
-        except Exception as e:
-            resultDetails["citations"] = {}
-            self.logger.error(e)
+    timing_exempt = True
 
-        # append totals to the resultDetails object
-        resultDetails["totalCitations"] = totalCitations
-        resultDetails["totalDownloads"] = totalDownloads
-        resultDetails["totalViews"] = totalViews
-        resultDetails["aggType"] = "years"
+    def __init__(self, metrics_reader, stage_histograms=None):
+        self._metrics_reader = metrics_reader
+        self._stage_histograms = stage_histograms
+        self.logger = logging.getLogger('metrics_service.' + __name__)
 
-        return results, resultDetails
 
+    def on_get(self, req, resp):
+        """
+        The method assigned to the GET end point
+        :param req: HTTP Request object
+        :param resp: HTTP Response object
+        :return: HTTP Response object
+        """
+        stats = self._metrics_reader.stats()
+        if self._stage_histograms is not None:
+            stats["stages"] = self._stage_histograms.stats()
+        resp.data = responsewriter.dumps(stats)
+        resp.status = falcon.HTTP_200
 
 if __name__ == "__main__":
     mr = MetricsReader()
     # mr.resolvePIDs(["doi:10.5065/D6BG2KW9"])
-    mr.getDatasetIdentifierFamily("user", "http://orcid.org/0000-0002-0381-3766")
+    user_id = "http://orcid.org/0000-0002-0381-3766"
+    context = MetricsRequestContext({"filterBy": [{"filterType": "user", "values": [user_id]}]})
+    mr.getDatasetIdentifierFamily(context, "user", user_id)
 
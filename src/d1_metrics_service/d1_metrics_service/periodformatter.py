@@ -0,0 +1,403 @@
+"""
+Period Formatter module
+
+Formats the composite aggregation buckets retrieved from Elastic Search into the
+period series of the metrics response (months, days, years, weeks or quarters).
+
+Bucket keys are epoch milliseconds at the start of a period in UTC. They are converted
+to period ordinals with integer arithmetic, once per distinct key, instead of formatting
+a datetime for every bucket. A period ordinal is a consecutive integer per period, so
+the position of a bucket in the series is its ordinal less the ordinal of the first
+period of the request.
+"""
+from array import array
+from datetime import datetime, timedelta
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def civilFromDays(days):
+    """
+    Calendar date of a day, http://howardhinnant.github.io/date_algorithms.html
+    :param days: days since 1970-01-01
+    :return: tuple of (year, month, day)
+    """
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    mp = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    year = year_of_era + era * 400
+    if month <= 2:
+        year += 1
+    return year, month, day
+
+
+def daysFromDatetime(date):
+    """
+    :param date: naive datetime, UTC
+    :return: days since 1970-01-01
+    """
+    return (date - EPOCH).days
+
+
+class Period(object):
+    """
+    A granularity of the period series.
+
+    Subclasses define the methods:
+
+    - ordinal(days): ordinal of the period containing a day, given in days since 1970-01-01
+    - label(ordinal): label of a period in the response
+    - startDays(ordinal): first day of a period, in days since 1970-01-01
+    """
+
+    def __init__(self, name, plural, citation_prefix, citation_format):
+        # name of the date_histogram interval and of the composite source
+        self.name = name
+        # name of the series in the response and of the groupBy value
+        self.plural = plural
+        # length and format of the part of the link_publication_date of citations that is used
+        self.citation_prefix = citation_prefix
+        self.citation_format = citation_format
+
+
+    def start(self, ordinal):
+        """
+        :return: datetime of the first day of the period
+        """
+        return EPOCH + timedelta(self.startDays(ordinal))
+
+
+    def ordinalOf(self, date):
+        return self.ordinal(daysFromDatetime(date))
+
+
+    def citationOrdinal(self, link_publication_date, end_dt):
+        """
+        Period of a citation. Citations without a publication date are assigned the most recent period.
+        :param link_publication_date: publication date of the citation link
+        :param end_dt: end of the date range of the request
+        :return: ordinal of the period
+        """
+        if (link_publication_date is None) or (link_publication_date == "NULL"):
+            return self.ordinalOf(end_dt)
+        date = link_publication_date
+        if self.citation_prefix is not None:
+            date = date[:self.citation_prefix]
+        return self.ordinalOf(datetime.strptime(date, self.citation_format))
+
+
+class DayPeriod(Period):
+
+    def ordinal(self, days):
+        return days
+
+
+    def label(self, ordinal):
+        return "%04d-%02d-%02d" % civilFromDays(ordinal)
+
+
+    def startDays(self, ordinal):
+        return ordinal
+
+
+class WeekPeriod(Period):
+    """
+    Weeks start on Monday, as the week interval of Elastic Search. Labeled with the ISO week.
+    """
+
+    def ordinal(self, days):
+        # 1970-01-01 is a Thursday
+        return (days + 3) // 7
+
+
+    def label(self, ordinal):
+        year, week, weekday = self.start(ordinal).isocalendar()
+        return "%04d-W%02d" % (year, week)
+
+
+    def startDays(self, ordinal):
+        return ordinal * 7 - 3
+
+
+class MonthPeriod(Period):
+
+    def ordinal(self, days):
+        year, month, day = civilFromDays(days)
+        return year * 12 + month - 1
+
+
+    def label(self, ordinal):
+        return "%04d-%02d" % (ordinal // 12, ordinal % 12 + 1)
+
+
+    def startDays(self, ordinal):
+        return daysFromDatetime(datetime(ordinal // 12, ordinal % 12 + 1, 1))
+
+
+class QuarterPeriod(Period):
+
+    def ordinal(self, days):
+        year, month, day = civilFromDays(days)
+        return year * 4 + (month - 1) // 3
+
+
+    def label(self, ordinal):
+        return "%04d-Q%d" % (ordinal // 4, ordinal % 4 + 1)
+
+
+    def startDays(self, ordinal):
+        return daysFromDatetime(datetime(ordinal // 4, (ordinal % 4) * 3 + 1, 1))
+
+
+class YearPeriod(Period):
+
+    def ordinal(self, days):
+        return civilFromDays(days)[0]
+
+
+    def label(self, ordinal):
+        return "%04d" % ordinal
+
+
+    def startDays(self, ordinal):
+        return daysFromDatetime(datetime(ordinal, 1, 1))
+
+
+# Periods by the name of their date_histogram interval
+PERIODS = {
+    "day": DayPeriod("day", "days", None, "%Y-%m-%d"),
+    "week": WeekPeriod("week", "weeks", 10, "%Y-%m-%d"),
+    "month": MonthPeriod("month", "months", 7, "%Y-%m"),
+    "quarter": QuarterPeriod("quarter", "quarters", 10, "%Y-%m-%d"),
+    "year": YearPeriod("year", "years", 4, "%Y"),
+}
+
+# Periods by their groupBy value, in order of precedence when several are requested
+GROUP_BY_PERIODS = ["months", "days", "years", "weeks", "quarters"]
+
+
+def getAggregationType(group_by, default="month"):
+    """
+    Interval of the aggregation requested by the groupBy of a metricsRequest
+    :param group_by: list of groupBy values
+    :param default: interval when no period is requested
+    :return: name of a period of PERIODS
+    """
+    for plural in GROUP_BY_PERIODS:
+        if plural in group_by:
+            return plural[:-1]
+    return default
+
+
+def getOrdinals(period, timestamps):
+    """
+    Period ordinals of bucket keys
+    :param period: Period
+    :param timestamps: iterable of epoch milliseconds
+    :return: dictionary of timestamp to ordinal, each distinct timestamp is converted once
+    """
+    ordinal = period.ordinal
+    return {timestamp: ordinal(timestamp // MS_PER_DAY) for timestamp in set(timestamps)}
+
+
+class PeriodIndex(object):
+    """
+    The periods covered by the days from start_dt up to, excluding, end_dt, and the
+    positions of the aggregation buckets in them.
+    """
+
+    def __init__(self, period, start_dt, end_dt):
+        self.period = period
+        self.first = period.ordinalOf(start_dt)
+        if end_dt > start_dt:
+            self.count = period.ordinalOf(end_dt - timedelta(1)) - self.first + 1
+        else:
+            self.count = 0
+        self.labels = [period.label(self.first + position) for position in range(self.count)]
+
+
+    def __len__(self):
+        return self.count
+
+
+    def positions(self, timestamps):
+        """
+        Positions of bucket keys in the periods
+        :param timestamps: iterable of epoch milliseconds
+        :return: dictionary of timestamp to position
+        """
+        positions = {}
+        for timestamp, ordinal in getOrdinals(self.period, timestamps).items():
+            position = ordinal - self.first
+            if position < 0 or position >= self.count:
+                raise ValueError("Bucket {0} is outside of the requested periods".format(timestamp))
+            positions[timestamp] = position
+        return positions
+
+
+    def iterPositions(self, buckets):
+        """
+        Places buckets in the periods
+        :param buckets: composite aggregation buckets with a source named after the period
+        :return: generator of (position, bucket)
+        """
+        name = self.period.name
+        positions = self.positions(bucket["key"][name] for bucket in buckets)
+        for bucket in buckets:
+            yield positions[bucket["key"][name]], bucket
+
+
+def countCitations(period, citations, start_dt, end_dt):
+    """
+    Counts the citations of the periods of a date range
+    :param period: Period
+    :param citations: citation objects as returned by gatherCitations
+    :param start_dt: begin of the date range, excluded
+    :param end_dt: end of the date range, excluded
+    :return: tuple of (dictionary of period label to count, list of the citations within the range)
+    """
+    citation_counts = {}
+    in_range = []
+    for citation in citations:
+        ordinal = period.citationOrdinal(citation["link_publication_date"], end_dt)
+
+        # Check if the citations falls within the given time range.
+        citation_pub_date = period.start(ordinal)
+        if (citation_pub_date > start_dt) and (citation_pub_date < end_dt):
+            in_range.append(citation)
+            label = period.label(ordinal)
+            citation_counts[label] = citation_counts.get(label, 0) + 1
+    return citation_counts, in_range
+
+
+def countCitationLabels(period, citations):
+    """
+    Counts all the citations by the period prefix of their publication date, whatever the date range,
+    as the user and group profiles report them
+    :param period: Period with a citation_prefix
+    :param citations: citation objects as returned by gatherCitations
+    :return: dictionary of period label to count
+    """
+    citation_counts = {}
+    for citation in citations:
+        label = citation["link_publication_date"][:period.citation_prefix]
+        citation_counts[label] = citation_counts.get(label, 0) + 1
+    return citation_counts
+
+
+def formatBuckets(period, buckets, start_dt, end_dt, citation_counts, include_downloads=True,
+                  include_views=True, include_citations=True, by_country=False):
+    """
+    Folds composite aggregation buckets and citation counts into the series of the metrics response.
+
+    Without by_country, the response has an entry for every period of the date range. With by_country,
+    it has an entry for every period and country that have events, followed by the periods that only
+    have citations, assigned to US.
+    :param period: Period
+    :param buckets: composite aggregation buckets, keyed by the period, format and optionally country
+    :param start_dt: begin of the date range
+    :param end_dt: end of the date range
+    :param citation_counts: dictionary of period label to number of citations
+    :param include_downloads: add the downloads series
+    :param include_views: add the views series
+    :param include_citations: add the citations series
+    :param by_country: group the series by country
+    :return: tuple of (results dictionary, total downloads, total views)
+    """
+    plural = period.plural
+    results = {
+        plural: [],
+        "downloads": [],
+        "views": [],
+        "citations": [],
+        "country": [],
+    }
+    total_downloads, total_views = 0, 0
+
+    if by_country:
+        ordinals = getOrdinals(period, (bucket["key"][period.name] for bucket in buckets))
+        labels = {}
+        records = {}
+        for bucket in buckets:
+            timestamp = bucket["key"][period.name]
+            label = labels.get(timestamp)
+            if label is None:
+                label = labels[timestamp] = period.label(ordinals[timestamp])
+
+            # handling cases where country is null
+            country = bucket["key"]["country"]
+            if (country is None) or (country == "null"):
+                country = "US"
+
+            record = records.setdefault(label, {}).setdefault(country, {})
+            if (bucket["key"]["format"] == "DATA") and include_downloads:
+                total_downloads += bucket["unique_doc_count"]["value"]
+                record["downloads"] = bucket["unique_doc_count"]["value"]
+            if (bucket["key"]["format"] == "METADATA") and include_views:
+                total_views += bucket["unique_doc_count"]["value"]
+                record["views"] = bucket["unique_doc_count"]["value"]
+
+        # Parse the dictionary to form the expected output in the form of lists
+        for label, countries in records.items():
+            for country, record in countries.items():
+                results[plural].append(label)
+                results["country"].append(country)
+                if include_downloads:
+                    results["downloads"].append(record.get("downloads", 0))
+                if include_views:
+                    results["views"].append(record.get("views", 0))
+                if include_citations:
+                    results["citations"].append(citation_counts.get(label, 0))
+
+        if include_citations:
+            for label, count in citation_counts.items():
+                if label not in records:
+                    results[plural].append(label)
+                    if include_views:
+                        results["views"].append(0)
+                    if include_downloads:
+                        results["downloads"].append(0)
+                    results["country"].append('US')
+                    results["citations"].append(count)
+        return results, total_downloads, total_views
+
+    index = PeriodIndex(period, start_dt, end_dt)
+    results[plural] = list(index.labels)
+
+    # Counts are accumulated in integer arrays
+    downloads = array('l', [0]) * len(index)
+    views = array('l', [0]) * len(index)
+    for position, bucket in index.iterPositions(buckets):
+        if bucket["key"]["format"] == "DATA" and include_downloads:
+            total_downloads += bucket["unique_doc_count"]["value"]
+            downloads[position] += bucket["unique_doc_count"]["value"]
+        elif bucket["key"]["format"] == "METADATA" and include_views:
+            total_views += bucket["unique_doc_count"]["value"]
+            views[position] += bucket["unique_doc_count"]["value"]
+
+    if include_downloads:
+        results["downloads"] = downloads.tolist()
+    if include_views:
+        results["views"] = views.tolist()
+    if include_citations:
+        results["citations"] = [0] * len(index)
+        label_positions = {label: position for position, label in enumerate(index.labels)}
+        for label, count in citation_counts.items():
+            position = label_positions.get(label)
+            if position is None:
+                results[plural].append(label)
+                if include_downloads:
+                    results["downloads"].append(0)
+                if include_views:
+                    results["views"].append(0)
+                results["citations"].append(count)
+            else:
+                results["citations"][position] = count
+    return results, total_downloads, total_views
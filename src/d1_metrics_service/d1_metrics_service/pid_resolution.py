@@ -10,7 +10,10 @@ import logging
 import requests
 import json
 import asyncio
+import itertools
 from aiohttp import ClientSession
+from d1_metrics import telemetry
+from d1_metrics import timing
 from d1_metrics.solrclient import SolrClient
 from d1_metrics.metricselasticsearch import MetricsElasticSearch
 import concurrent.futures
@@ -123,6 +126,7 @@ def _getIdsFromSolrResponse(response_text, pids=[]):
   return pids
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def pidsAndSid(IDs, solr_url=None):
   '''
   For each provided ID, determine if it is a PID or a SID
@@ -204,6 +208,7 @@ def pidsAndSid(IDs, solr_url=None):
   return results
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def getObsolescenceChain(IDs, solr_url=None, max_depth=20):
   '''
   Get the obsolecence chains for pids in IDs
@@ -282,6 +287,7 @@ def getObsolescenceChain(IDs, solr_url=None, max_depth=20):
   return results
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def getResolvePIDs(PIDs, solr_url=None, use_mm_params=True):
   '''
   Implements same functionality as metricsreader.resolvePIDs, except works asynchronously for input pids
@@ -318,6 +324,7 @@ def getResolvePIDs(PIDs, solr_url=None, use_mm_params=True):
 
     Returns: response object
     """
+    next(solr_calls)
     if use_mm:
       return session.post(url, files=params)
     paramsd = {key:value[1] for (key,value) in params.items()}
@@ -400,6 +407,8 @@ def getResolvePIDs(PIDs, solr_url=None, use_mm_params=True):
 
   _L, t_0 = _getLogger()
   results = {}
+  # counts the solr requests made, next() on a count is thread safe
+  solr_calls = itertools.count()
   _L.debug("Enter")
   # In a multithreading environment such as under gunicorn, the new thread created by
   # gevent may not provide an event loop. Create a new one if necessary.
@@ -412,6 +421,7 @@ def getResolvePIDs(PIDs, solr_url=None, use_mm_params=True):
 
   future = asyncio.ensure_future(_work(PIDs))
   loop.run_until_complete( future )
+  telemetry.SOLR_CALLS_PER_RESOLVE.observe(next(solr_calls))
   _L.debug("elapsed:%fsec", time.time()-t_0)
   return results
 
@@ -422,6 +432,7 @@ def getResolvePIDs(PIDs, solr_url=None, use_mm_params=True):
 #####################################
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def getPortalCollectionQueryFromSolr(url = None, portalLabel = None):
     """
       Returns the collection query for the portal
@@ -455,6 +466,7 @@ def getPortalCollectionQueryFromSolr(url = None, portalLabel = None):
     return colelctionQuery
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def getPortalSeriesId(url = None, portalLabel = None,):
     """
       Returns the collection query for the portal
@@ -488,6 +500,7 @@ def getPortalSeriesId(url = None, portalLabel = None,):
     return seriesId
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def resolveCollectionQueryFromSolr(url = None, collectionQuery = "*:*"):
   """
     Uses d1_metrics SolrClient to resolve a collection Query.
@@ -521,6 +534,7 @@ def resolveCollectionQueryFromSolr(url = None, collectionQuery = "*:*"):
   return resolved_collection_identifier
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def getResolvedTargetCitationMetadata(PIDs, solr_url=None, use_mm_params=True):
   '''
   Resolves the Citaion metadata for target identifier
@@ -650,6 +664,7 @@ def getResolvedTargetCitationMetadata(PIDs, solr_url=None, use_mm_params=True):
   return results
 
 
+@timing.timed(timing.STAGE_RESOLVE)
 def getAsyncPortalDatasetIdentifierFamilyByBatches(portal_pids):
   """
   Resolving Portal Dataset Identifier Family asynchronously
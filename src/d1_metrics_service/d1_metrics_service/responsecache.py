@@ -0,0 +1,182 @@
+"""
+Response Cache module
+
+In-process cache of serialized metrics responses. Entries are keyed by the canonical
+form of the metricsRequest and expire at the same time as the HTTP cache headers set
+by the service, which is the next 07:00.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from d1_metrics import telemetry
+
+# Format of the dates in the range filters of a metricsRequest
+REQUEST_DATE_FORMAT = "%m/%d/%Y"
+
+# Filter types for which the order of the values determines the order of the results
+ORDERED_FILTER_TYPES = ["catalog", "package"]
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+def getCacheExpiry(current_time=None):
+    """
+    Time at which cached responses expire, the next 07:00 local time.
+    :param current_time: defaults to now
+    :return: tuple of (expiry datetime, seconds until expiry)
+    """
+    if current_time is None:
+        current_time = datetime.now()
+    tomorrow = current_time + timedelta(1)
+
+    # Setting the GMT offset to get the local time in Pacific
+    # Note: Day Light Savings time difference is not set
+    midnight = datetime(year=tomorrow.year, month=tomorrow.month, day=tomorrow.day, hour=7, minute=0, second=0)
+    secs = ((midnight - current_time).seconds)
+    return current_time + timedelta(seconds=secs), secs
+
+
+def _normalizeDate(value):
+    try:
+        return datetime.strptime(value, REQUEST_DATE_FORMAT).strftime(REQUEST_DATE_FORMAT)
+    except (TypeError, ValueError):
+        return value
+
+
+def _sortedValues(values):
+    try:
+        return sorted(values)
+    except TypeError:
+        return values
+
+
+def canonicalMetricsRequest(metrics_request):
+    """
+    Canonical string for a metricsRequest, used as the cache key.
+
+    metricsPage is ignored, the dates of range filters are normalized and the values of list
+    filters, metrics and groupBy are sorted. The values of catalog and package filters keep their
+    order since it determines the order of the results.
+    :param metrics_request: metricsRequest dictionary
+    :return: string
+    """
+    canonical = {}
+    for key, value in metrics_request.items():
+        if key == "metricsPage":
+            continue
+        canonical[key] = value
+
+    filter_by = []
+    for filter_object in canonical.get("filterBy", []):
+        filter_object = dict(filter_object)
+        values = filter_object.get("values", [])
+        interpret_as = str(filter_object.get("interpretAs", "")).lower()
+        if interpret_as == "range":
+            values = [_normalizeDate(value) for value in values]
+        elif str(filter_object.get("filterType", "")).lower() not in ORDERED_FILTER_TYPES:
+            values = _sortedValues(values)
+        filter_object["values"] = values
+        filter_by.append(filter_object)
+    if "filterBy" in canonical:
+        canonical["filterBy"] = filter_by
+
+    for key in ("metrics", "groupBy"):
+        if isinstance(canonical.get(key), list):
+            canonical[key] = _sortedValues(canonical[key])
+
+    return json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+
+
+class ResponseCache(object):
+    """
+    Thread safe LRU cache of serialized responses with per entry expiry.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=256 * 1024 * 1024):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, key):
+        """
+        Retrieve a cached response
+        :param key: canonical request
+        :return: tuple of (status, body) or None if not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                telemetry.recordCache("response", misses=1)
+                return None
+            status, body, expires = entry
+            if expires <= time.time():
+                self._remove(key)
+                self.misses += 1
+                telemetry.recordCache("response", misses=1)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            telemetry.recordCache("response", hits=1)
+            return status, body
+
+
+    def put(self, key, status, body, expires):
+        """
+        Add a response to the cache
+        :param key: canonical request
+        :param status: HTTP status of the response
+        :param body: serialized response, bytes
+        :param expires: epoch seconds at which the entry expires
+        :return: None
+        """
+        if len(body) > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (status, body, expires)
+            self._size += len(body)
+            while len(self._entries) > self._max_entries or self._size > self._max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+    def stats(self):
+        """
+        Cache statistics
+        :return: dictionary
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+    def _remove(self, key):
+        status, body, expires = self._entries.pop(key)
+        self._size -= len(body)
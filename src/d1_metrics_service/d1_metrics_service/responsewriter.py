@@ -0,0 +1,113 @@
+"""
+Response Writer module
+
+Serializes metrics responses to JSON. Large responses are written as a stream: the
+arrays of the results are encoded a chunk of items at a time, so the full serialized
+response is never held in memory and the first bytes are sent before the whole
+response is encoded.
+
+orjson is used for encoding when it is installed, the standard json module otherwise.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Separators between the parts written by the streaming encoder
+ITEM_SEPARATOR = b", "
+KEY_SEPARATOR = b": "
+
+
+def dumps(value):
+    """
+    Serializes a value to JSON
+    :param value: JSON serializable value
+    :return: UTF-8 encoded bytes
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            # e.g. integers larger than 64 bits or non string keys
+            pass
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def countResultItems(metrics_response):
+    """
+    Size of the results of a metrics response
+    :param metrics_response: MetricsResponse dictionary
+    :return: total number of items of the arrays of the results
+    """
+    results = metrics_response.get("results")
+    if not isinstance(results, dict):
+        return 0
+    return sum(len(value) for value in results.values() if isinstance(value, list))
+
+
+def _iterList(values, chunk_items):
+    yield b"["
+    for start in range(0, len(values), chunk_items):
+        if start > 0:
+            yield ITEM_SEPARATOR
+        # The brackets of the encoded slice are replaced by those of the whole list
+        yield dumps(values[start:start + chunk_items])[1:-1]
+    yield b"]"
+
+
+def _iterObject(value, chunk_items):
+    yield b"{"
+    for position, (key, item) in enumerate(value.items()):
+        if position > 0:
+            yield ITEM_SEPARATOR
+        yield dumps(key) + KEY_SEPARATOR
+        if isinstance(item, list):
+            yield from _iterList(item, chunk_items)
+        else:
+            yield dumps(item)
+    yield b"}"
+
+
+def iterResponse(metrics_response, chunk_items=1000):
+    """
+    Serializes a metrics response incrementally. The arrays of the results are
+    encoded chunk_items at a time, the other members are encoded whole.
+    :param metrics_response: MetricsResponse dictionary
+    :param chunk_items: number of array items encoded at a time
+    :return: generator of UTF-8 encoded JSON fragments
+    """
+    yield b"{"
+    for position, (key, value) in enumerate(metrics_response.items()):
+        if position > 0:
+            yield ITEM_SEPARATOR
+        yield dumps(key) + KEY_SEPARATOR
+        if key == "results" and isinstance(value, dict):
+            yield from _iterObject(value, chunk_items)
+        else:
+            yield dumps(value)
+    yield b"}"
+
+
+def tee(fragments, max_bytes, on_complete):
+    """
+    Passes fragments through while keeping a copy of them, up to max_bytes in total.
+    :param fragments: iterable of bytes
+    :param max_bytes: maximum number of bytes to keep
+    :param on_complete: called with the joined bytes when all the fragments were consumed
+        and they fit in max_bytes
+    :return: generator of the fragments
+    """
+    kept = []
+    size = 0
+    for fragment in fragments:
+        if kept is not None:
+            size += len(fragment)
+            if size > max_bytes:
+                kept = None
+            else:
+                kept.append(fragment)
+        yield fragment
+    if kept is not None:
+        on_complete(b"".join(kept))
@@ -0,0 +1,79 @@
+"""
+Server Timing module
+
+Falcon middleware recording the stages of every request with d1_metrics.timing. The
+durations are sent to the client in a Server-Timing header and accumulated in the rolling
+histograms served by /metrics/_stats. The request duration by filterType and the number of
+ES pages fetched are also added to the Prometheus metrics of d1_metrics.telemetry.
+"""
+import logging
+
+from d1_metrics import telemetry
+from d1_metrics import timing
+
+# Key of the recorder in the request context
+CONTEXT_KEY = "timing"
+
+# Key of the filterType of the metricsRequest in the request context
+FILTER_TYPE_KEY = "filter_type"
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+def setFilterType(req, metrics_request):
+    """
+    Keeps the filterType of a metricsRequest for labelling the metrics of the request
+    :param req: HTTP Request object
+    :param metrics_request: metricsRequest object
+    :return: None
+    """
+    try:
+        req.context[FILTER_TYPE_KEY] = metrics_request["filterBy"][0]["filterType"]
+    except (KeyError, IndexError, TypeError):
+        pass
+
+
+class ServerTimingMiddleware(object):
+    """
+    Binds a span recorder to the thread handling a request. Resources with a true
+    timing_exempt attribute, like the stats endpoint itself, are not added to the histograms.
+    Requests without a filterType are labelled with the telemetry_filter_type attribute of
+    their resource.
+    """
+
+    def __init__(self, stage_histograms):
+        self._stage_histograms = stage_histograms
+
+
+    def process_request(self, req, resp):
+        recorder = timing.SpanRecorder()
+        req.context[CONTEXT_KEY] = (recorder, timing.bind(recorder))
+
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        """
+        Falcon hook called after the resource responder
+        :param req: HTTP Request object
+        :param resp: HTTP Response object
+        :param resource: resource the request was routed to, may be None
+        :param req_succeeded: whether the responder completed without raising
+        :return: None
+        """
+        recorded = req.context.pop(CONTEXT_KEY, None)
+        if recorded is None:
+            return
+        recorder, token = recorded
+        timing.restore(token)
+        resp.set_header("Server-Timing", recorder.serverTiming())
+        if resource is None or getattr(resource, "timing_exempt", False):
+            return
+        self._stage_histograms.observeRecorder(recorder)
+
+        filter_type = req.context.get(FILTER_TYPE_KEY, getattr(resource, "telemetry_filter_type", None))
+        filter_type = telemetry.getFilterTypeLabel(filter_type)
+        telemetry.REQUEST_SECONDS.observe(recorder.elapsed(), filter_type=filter_type)
+        pages = sum(1 for name, seconds in recorder.spans() if name == timing.STAGE_ES)
+        telemetry.REQUEST_COMPOSITE_PAGES.observe(pages, filter_type=filter_type)
+        _getLogger().debug("process_response: %s", recorder.serverTiming())
@@ -0,0 +1,99 @@
+"""
+Single Flight module
+
+Coalesces concurrent identical calls so that only one of them does the work and the
+others wait for, and share, its result.
+"""
+import logging
+import threading
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+class _Call(object):
+    """
+    A call in flight.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time. Callers arriving while a call for the same
+    key is running wait for it to complete, up to wait_timeout seconds, and return its
+    result. A waiter that times out runs the call itself.
+    """
+
+    def __init__(self, wait_timeout=120):
+        self._wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs), or wait for the result of the running call with the same key.
+        :param key: hashable identifying the call
+        :param function: the function to call
+        :return: result of the function
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            _getLogger().debug("Waiting for the call in flight for the same request")
+            if call.done.wait(self._wait_timeout):
+                if call.exception is not None:
+                    raise call.exception
+                return call.result
+            with self._lock:
+                self.timeouts += 1
+            _getLogger().warning("Timed out after %ss waiting for the call in flight, running it again",
+                                 self._wait_timeout)
+            return function(*args, **kwargs)
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.waiters > 0:
+                _getLogger().info("Coalesced %d requests into one", call.waiters + 1)
+
+
+    def stats(self):
+        """
+        Counters of the calls made
+        :return: dictionary
+        """
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+            }
@@ -0,0 +1,111 @@
+"""
+Version Token module
+
+Cheap version of the data behind the responses of the service, used for the ETag of
+the responses and to answer conditional requests with 304 Not Modified.
+
+The version is made of:
+
+  * the dateLogged watermark of the last sessionization run and the time of the last
+    portal re-tagging, recorded in db_metadata by the batch jobs that change events,
+  * the change counters of the citations and citation_metadata tables,
+  * the date at which cached responses expire, so that ETags roll over with the
+    Expires header even when nothing else changed.
+
+Reading the version takes a few small queries. It is cached in-process and read again
+at most every VERSION_CHECK_SECONDS.
+"""
+import hashlib
+import logging
+import threading
+import time
+
+from d1_metrics import metricsdatabase
+from d1_metrics.metricsdatabase import MetricsDatabase
+from d1_metrics_service import citationindex
+from d1_metrics_service import responsecache
+
+# Minimum number of seconds between reads of the data version
+VERSION_CHECK_SECONDS = 30
+
+
+def _getLogger():
+    return logging.getLogger('metrics_service.' + __name__)
+
+
+class DataVersion(object):
+    """
+    Version of the data served from a set of citation tables.
+    """
+
+    def __init__(self, tables=("citations",), check_seconds=VERSION_CHECK_SECONDS):
+        self._tables = tables
+        self._check_seconds = check_seconds
+        self._version = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+
+    def _readVersion(self):
+        metrics_database = MetricsDatabase()
+        with metrics_database.pooledConnection():
+            version = [
+                metrics_database.getMetadataValue(metricsdatabase.METADATA_SESSION_WATERMARK),
+                metrics_database.getMetadataValue(metricsdatabase.METADATA_PORTAL_INDEX_UPDATED),
+            ]
+            csr = metrics_database.getCursor()
+            for table in self._tables:
+                version.append(citationindex.getTableVersion(csr, table))
+        return tuple(version)
+
+
+    def get(self):
+        """
+        The current data version
+        :return: string, None if the version could not be read
+        """
+        now = time.time()
+        with self._lock:
+            if self._version is not None and now - self._checked < self._check_seconds:
+                version = self._version
+            else:
+                try:
+                    version = self._readVersion()
+                except Exception as e:
+                    _getLogger().warning("Unable to read the data version: %s", e)
+                    return None
+                self._version = version
+                self._checked = now
+        expiry_time, secs = responsecache.getCacheExpiry()
+        return repr(version + (expiry_time.strftime("%Y-%m-%d"),))
+
+
+def getETag(request_key, data_version):
+    """
+    Entity tag of a response
+    :param request_key: canonical form of the request
+    :param data_version: value returned by DataVersion.get()
+    :return: quoted entity tag
+    """
+    digest = hashlib.sha1((data_version + "\n" + request_key).encode("utf-8")).hexdigest()
+    return '"' + digest + '"'
+
+
+def matchesETag(if_none_match, etag):
+    """
+    Whether the If-None-Match header of a request matches an entity tag, using the weak comparison
+    :param if_none_match: value of the If-None-Match header, may be None
+    :param etag: quoted entity tag
+    :return: boolean
+    """
+    if if_none_match is None or etag is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
@@ -0,0 +1,197 @@
+"""
+Regression tests of the period formatter against the formatting loops it replaced.
+
+The legacy functions below are copies of the former formatElasticSearchResultsByMonth /
+ByDay / ByYear methods and of the user and group formatters of MetricsReader, reduced
+to the formatting of the buckets and citations. The legacy user and group formatters
+assigned the citations of months outside the date range to a stale position; the copy
+appends them, as the periodic formatters did.
+
+Usage:
+
+  python -m pytest tests
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pytest
+
+from d1_metrics_service import periodformatter
+
+PERIOD_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+START_DT = datetime(2018, 11, 17)
+END_DT = datetime(2020, 2, 10)
+
+
+def legacyFormat(buckets, citations, start_dt, end_dt, key_name, by_country):
+    period_format = PERIOD_FORMATS[key_name]
+    plural = key_name + "s"
+    prefix = periodformatter.PERIODS[key_name].citation_prefix
+    results = {plural: [], "downloads": [], "views": [], "citations": [], "country": []}
+    totalDownloads, totalViews = 0, 0
+
+    citationDict = {}
+    for citationObject in citations:
+        citation_link_pub_date = citationObject["link_publication_date"][:prefix]
+        if (citation_link_pub_date == None) or (citation_link_pub_date == "NULL"):
+            citation_link_pub_date = datetime.strftime(end_dt, period_format)
+        citation_pub_date = datetime.strptime(citation_link_pub_date, period_format)
+        if (citation_pub_date > start_dt) and (citation_pub_date < end_dt):
+            citationDict[citation_link_pub_date] = citationDict.get(citation_link_pub_date, 0) + 1
+
+    if by_country:
+        records = {}
+        for i in buckets:
+            period = datetime.utcfromtimestamp((i["key"][key_name] // 1000)).strftime((period_format))
+            if (i["key"]["country"] is None) or (i["key"]["country"] == "null"):
+                i["key"]["country"] = "US"
+            if period not in records:
+                records[period] = {}
+            if i["key"]["country"] not in records[period]:
+                records[period][i["key"]["country"]] = {}
+            if i["key"]["format"] == "DATA":
+                totalDownloads += i["unique_doc_count"]["value"]
+                records[period][i["key"]["country"]]["downloads"] = i["unique_doc_count"]["value"]
+            if i["key"]["format"] == "METADATA":
+                totalViews += i["unique_doc_count"]["value"]
+                records[period][i["key"]["country"]]["views"] = i["unique_doc_count"]["value"]
+        for period in records:
+            for country in records[period]:
+                results[plural].append(period)
+                results["country"].append(country)
+                results["downloads"].append(records[period][country].get("downloads", 0))
+                results["views"].append(records[period][country].get("views", 0))
+                results["citations"].append(citationDict.get(period, 0))
+        for period in citationDict:
+            if period not in results[plural]:
+                results[plural].append(period)
+                results["views"].append(0)
+                results["downloads"].append(0)
+                results["country"].append('US')
+                results["citations"].append(citationDict[period])
+        return results, totalDownloads, totalViews
+
+    results[plural] = list(OrderedDict(
+        ((start_dt + timedelta(_)).strftime(period_format), None) for _ in range((end_dt - start_dt).days)).keys())
+    results["downloads"] = [0] * len(results[plural])
+    results["views"] = [0] * len(results[plural])
+    results["citations"] = [0] * len(results[plural])
+    for i in buckets:
+        period = datetime.utcfromtimestamp((i["key"][key_name] // 1000)).strftime((period_format))
+        period_index = results[plural].index(period)
+        if i["key"]["format"] == "DATA":
+            totalDownloads += i["unique_doc_count"]["value"]
+            results["downloads"][period_index] += i["unique_doc_count"]["value"]
+        elif i["key"]["format"] == "METADATA":
+            totalViews += i["unique_doc_count"]["value"]
+            results["views"][period_index] += i["unique_doc_count"]["value"]
+    for period in citationDict:
+        if period in results[plural]:
+            results["citations"][results[plural].index(period)] = citationDict[period]
+        else:
+            results[plural].append(period)
+            results["downloads"].append(0)
+            results["views"].append(0)
+            results["citations"].append(citationDict[period])
+    return results, totalDownloads, totalViews
+
+
+def legacyFormatPerUser(buckets, citations, start_dt, end_dt):
+    results = {"months": [], "downloads": [], "views": [], "citations": []}
+    results["months"] = list(OrderedDict(
+        ((start_dt + timedelta(_)).strftime('%Y-%m'), None) for _ in range((end_dt - start_dt).days)).keys())
+    results["downloads"] = [0] * len(results["months"])
+    results["views"] = [0] * len(results["months"])
+
+    citationDict = {}
+    for citationObject in citations:
+        months = citationObject["link_publication_date"][:7]
+        citationDict[months] = citationDict.get(months, 0) + 1
+
+    for i in buckets:
+        months = datetime.utcfromtimestamp((i["key"]["month"] // 1000)).strftime(('%Y-%m'))
+        month_index = results["months"].index(months)
+        if i["key"]["format"] == "DATA":
+            results["downloads"][month_index] += i["unique_doc_count"]["value"]
+        elif i["key"]["format"] == "METADATA":
+            results["views"][month_index] += i["unique_doc_count"]["value"]
+
+    results["citations"] = [0] * len(results["months"])
+    for months in citationDict:
+        if months in results["months"]:
+            month_index = results["months"].index(months)
+            results["citations"][month_index] = citationDict[months]
+        else:
+            results["months"].append(months)
+            results["views"].append(0)
+            results["downloads"].append(0)
+            results["citations"].append(citationDict[months])
+    return results
+
+
+def timestamp(dt):
+    return int((dt - periodformatter.EPOCH).total_seconds()) * 1000
+
+
+def makeBuckets(key_name):
+    """
+    Buckets of a few periods of the date range, with repeated periods and countries
+    """
+    period = periodformatter.PERIODS[key_name]
+    index = periodformatter.PeriodIndex(period, START_DT, END_DT)
+    countries = ["US", "CA", None, "null", "DE"]
+    buckets = []
+    for position in range(0, len(index), max(1, len(index) // 7)):
+        start = max(period.start(index.first + position), START_DT)
+        for number, country in enumerate(countries):
+            for format in ("DATA", "METADATA", "RESOURCE"):
+                buckets.append({
+                    "key": {key_name: timestamp(start), "format": format, "country": country},
+                    "doc_count": 1,
+                    "unique_doc_count": {"value": position * 10 + number + 1},
+                })
+    return buckets
+
+
+def makeCitations():
+    """
+    Citations within the periods of the buckets, within the date range in periods
+    without buckets, outside of the date range and without publication date
+    """
+    dates = [
+        "2018-11-20", "2018-12-05", "2018-12-05",
+        "2019-06-01", "2019-06-30", "2019-09-14",
+        "2020-02-03", "2017-03-01", "2021-01-15",
+        "2020-05-01", "NULL",
+    ]
+    return [{"link_publication_date": date, "source_id": str(number), "target_id": "pid"}
+            for number, date in enumerate(dates)]
+
+
+@pytest.mark.parametrize("by_country", [False, True])
+@pytest.mark.parametrize("key_name", ["day", "month", "year"])
+def test_formatBuckets(key_name, by_country):
+    period = periodformatter.PERIODS[key_name]
+    citations = makeCitations()
+    expected = legacyFormat(makeBuckets(key_name), citations, START_DT, END_DT, key_name, by_country)
+
+    citation_counts, in_range = periodformatter.countCitations(period, citations, START_DT, END_DT)
+    actual = periodformatter.formatBuckets(period, makeBuckets(key_name), START_DT, END_DT, citation_counts,
+                                           by_country=by_country)
+    assert actual == expected
+    assert len(in_range) == sum(citation_counts.values())
+
+
+def test_formatBucketsPerUser():
+    period = periodformatter.PERIODS["month"]
+    buckets = [bucket for bucket in makeBuckets("month") if bucket["key"]["country"] == "US"]
+    citations = [citation for citation in makeCitations() if citation["link_publication_date"] != "NULL"]
+    expected = legacyFormatPerUser(buckets, citations, START_DT, END_DT)
+
+    citation_counts = periodformatter.countCitationLabels(period, citations)
+    actual, total_downloads, total_views = periodformatter.formatBuckets(period, buckets, START_DT, END_DT,
+                                                                         citation_counts)
+    del actual["country"]
+    assert actual == expected
+    assert actual["months"][-3:] == ["2017-03", "2021-01", "2020-05"]
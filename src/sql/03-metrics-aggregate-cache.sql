@@ -0,0 +1,15 @@
+/*
+ * aggregate_month_cache -- Elastic Search composite aggregation buckets of closed months,
+ * see d1_metrics.aggregatecache
+ */
+CREATE TABLE aggregate_month_cache (
+    cache_key TEXT NOT NULL,              -- hash of the entity type and the ES search and aggregation bodies
+    entity_type TEXT NOT NULL,            -- repository, portal, user
+    entity_id TEXT,                       -- node identifier, portal seriesId, hash of the user PIDs
+    month DATE NOT NULL,                  -- first day of the cached month
+    buckets TEXT NOT NULL,                -- JSON list of the composite aggregation buckets of the month
+    computed_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (cache_key, month)
+);
+CREATE INDEX aggregate_month_cache_entity_idx ON aggregate_month_cache (entity_type, entity_id);
+CREATE INDEX aggregate_month_cache_month_idx ON aggregate_month_cache (month);
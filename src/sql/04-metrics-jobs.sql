@@ -0,0 +1,14 @@
+/*
+ * metrics_jobs -- metricsRequests processed in the background at the request of the client,
+ * see d1_metrics_service.metricsjobs
+ */
+CREATE TABLE metrics_jobs (
+    job_id TEXT PRIMARY KEY,              -- hash of the canonical metricsRequest and the expiry date
+    status TEXT NOT NULL,                 -- pending, done, failed
+    http_status TEXT,                     -- HTTP status of the response, once completed
+    body BYTEA,                           -- serialized MetricsResponse, once completed
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    completed_at TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL         -- the result is kept until the response cache expires
+);
+CREATE INDEX metrics_jobs_expires_idx ON metrics_jobs (expires_at);
@@ -0,0 +1,9 @@
+/*
+ * session_id_allocator -- next free sessionId of each event index, reserved in ranges by
+ * the sessionizer processes, see d1_metrics.sessionizer
+ */
+CREATE TABLE session_id_allocator (
+    index_name TEXT PRIMARY KEY,          -- name of the Elastic Search event index
+    next_id BIGINT NOT NULL,              -- first sessionId not reserved yet
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+);